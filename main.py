@@ -13,13 +13,18 @@
 # limitations under the License.
 
 import random
+import time
+import concurrent.futures
+import logging
+import multiprocessing
+import statistics
 
 import numpy as np
 import pytest
 import argparse
 import torch
 import torch_npu
-from utils.base_utils import set_device_info
+from utils.base_utils import set_device_info, set_prof_config, set_acc_config, prof_config, acc_config
 
 
 def set_seed(seed=0):
@@ -42,8 +47,8 @@ def get_parser():
         "--scope",
         type=str,
         default="all",
-        choices=["acc", "prof", "all", "single"],
-        help="Test the case marked prof/acc.",
+        choices=["acc", "prof", "sweep", "all", "single"],
+        help="Test the case marked prof/acc/sweep.",
     )
     parser.add_argument(
         "--device",
@@ -58,6 +63,132 @@ def get_parser():
         default=0,
         help="ID of the test case, only used when the scope is single.",
     )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=3,
+        help="Number of warmup steps before timing a prof case.",
+    )
+    parser.add_argument(
+        "--iters",
+        type=int,
+        default=20,
+        help="Number of measured steps of a prof case.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=20,
+        help="Number of recent history records used as the prof baseline.",
+    )
+    parser.add_argument(
+        "--breakdown",
+        action="store_true",
+        help="Record per-submodule forward/backward time of each prof case.",
+    )
+    parser.add_argument(
+        "--profiler",
+        action="store_true",
+        help="Run each prof case under the profiler and save trace/top-k operators/op shapes.",
+    )
+    parser.add_argument(
+        "--memory_threshold",
+        type=float,
+        default=0.1,
+        help="Allowed relative growth of the peak allocated memory of a prof case.",
+    )
+    parser.add_argument(
+        "--cpu_affinity",
+        type=str,
+        default=None,
+        help="CPUs the prof worker is pinned to, e.g. '0-7' or '0,2,4'.",
+    )
+    parser.add_argument(
+        "--intra_threads",
+        type=int,
+        default=None,
+        help="Intra-op thread count of the prof worker.",
+    )
+    parser.add_argument(
+        "--interop_threads",
+        type=int,
+        default=None,
+        help="Inter-op thread count of the prof worker.",
+    )
+    parser.add_argument(
+        "--load_threshold",
+        type=float,
+        default=None,
+        help="Wait before timing a prof case while the 1-min load average per CPU is above this value.",
+    )
+    parser.add_argument(
+        "--golden_cache",
+        action="store_true",
+        help="Cache the cpu outputs and gradients of acc cases on disk and reuse them.",
+    )
+    parser.add_argument(
+        "--golden_cache_size",
+        type=float,
+        default=10,
+        help="Max size(GB) of the cpu golden cache, least recently used entries are evicted.",
+    )
+    parser.add_argument(
+        "--dump_cache_size",
+        type=float,
+        default=4,
+        help="Max size(GB) of the real data dumps cached in each test process.",
+    )
+    parser.add_argument(
+        "--device_compare",
+        action="store_true",
+        help="Compute the acc metrics on the device under test and only copy scalars back to the host.",
+    )
+    parser.add_argument(
+        "--collect_all",
+        action="store_true",
+        help="Do not stop at the first acc failure, record all metrics of every tensor to the acc report.",
+    )
+    parser.add_argument(
+        "--acc_report_dir",
+        type=str,
+        default="./data/acc_report",
+        help="Directory of the acc report written in collect_all mode.",
+    )
+    parser.add_argument(
+        "--acc_report_format",
+        type=str,
+        default="json",
+        choices=["json", "parquet"],
+        help="Format of the acc report, parquet needs pandas and pyarrow installed.",
+    )
+    parser.add_argument(
+        "--locate_divergence",
+        action="store_true",
+        help="Capture every submodule on cpu and npu in acc cases and report the first one exceeding the threshold.",
+    )
+    parser.add_argument(
+        "--offload_buffer_size",
+        type=float,
+        default=2,
+        help="Host memory(GB) for the submodule intermediates of --locate_divergence, the rest is spilled to disk.",
+    )
+    parser.add_argument(
+        "--offload_capture",
+        action="store_true",
+        help="Detach the outputs and grads saved by the acc hooks and copy them to pinned host memory asynchronously.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes running acc cases in parallel, 1 runs all cases in this process.",
+    )
+    parser.add_argument(
+        "--mem_budget",
+        type=float,
+        default=16,
+        help="Device memory(GB) shared by the parallel acc cases, used with the recorded peak memory.",
+    )
 
     return parser
 
@@ -79,20 +210,157 @@ test_cases = [
 ]
 
 
+class CollectPlugin:
+    def __init__(self):
+        self.node_ids = []
+
+    def pytest_collection_modifyitems(self, items):
+        self.node_ids = [item.nodeid for item in items]
+
+
+def collect_cases(marker):
+    plugin = CollectPlugin()
+    pytest.main(["-m", marker, "--collect-only", "-q", "./testcase/"], plugins=[plugin])
+    return plugin.node_ids
+
+
+def init_worker(device, config, config_acc):
+    set_device_info(device)
+    set_prof_config(**config)
+    set_acc_config(**config_acc)
+
+
+def init_prof_worker(device, config, config_acc):
+    init_worker(device, config, config_acc)
+    from utils.prof_utils import apply_run_settings
+    # 线程数和亲和性需要在执行任何算子之前设置
+    apply_run_settings(config['cpu_affinity'], config['intra_threads'], config['interop_threads'])
+    set_seed()
+
+
+def run_case(node_id):
+    """在worker进程中执行一个用例，返回(node_id, exit_code, 耗时(s), device峰值内存)"""
+    # 每个用例重新设置随机种子，输入和用例在哪个worker中、之前执行过哪些用例无关
+    set_seed()
+    torch.npu.reset_peak_memory_stats()
+    time_start = time.perf_counter()
+    exit_code = pytest.main(["-s", "-p", "no:cacheprovider", node_id])
+    return node_id, int(exit_code), time.perf_counter() - time_start, torch.npu.max_memory_allocated()
+
+
+def get_case_costs(node_ids, device, window):
+    """从性能历史记录中读取用例最近window次的耗时和峰值内存的中位数，没有记录时为None"""
+    from utils.perf_history import get_perf_history
+    history = get_perf_history()
+    costs = {}
+    for node_id in node_ids:
+        durations = history.query(node_id, 'duration(s)', device_info=device, limit=window)
+        peaks = history.query(node_id, 'peak_allocated_bytes', device_info=device, limit=window)
+        costs[node_id] = (statistics.median(durations) if durations else None,
+                          statistics.median(peaks) if peaks else None)
+    return costs
+
+
+def run_parallel_acc(node_ids, args):
+    """
+    在进程池中并行执行精度用例，按历史耗时从长到短排序，
+    同时运行的用例的历史峰值内存之和不超过mem_budget，没有历史记录的用例最先执行
+    """
+    from utils.perf_history import get_perf_history
+    history = get_perf_history()
+    costs = get_case_costs(node_ids, args.device, args.window)
+    pending = sorted(node_ids, key=lambda n: -costs[n][0] if costs[n][0] is not None else -float('inf'))
+    mem_budget = args.mem_budget * 1024 ** 3
+    running = {}
+    failed = []
+    context = multiprocessing.get_context('spawn')
+    initargs = (args.device, dict(prof_config), dict(acc_config))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+                                                initializer=init_worker, initargs=initargs) as executor:
+        while pending or running:
+            mem_used = sum(running.values())
+            for node_id in list(pending):
+                if len(running) >= args.workers:
+                    break
+                peak = costs[node_id][1] or 0
+                # 没有正在执行的用例时，即使超过预算也执行，避免卡住
+                if running and mem_used + peak > mem_budget:
+                    continue
+                running[executor.submit(run_case, node_id)] = peak
+                mem_used += peak
+                pending.remove(node_id)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                node_id, exit_code, duration, peak = future.result()
+                history.append(node_id, {'duration(s)': duration, 'peak_allocated_bytes': peak},
+                               device_info=args.device)
+                logging.info('{0} finished, exit_code={1}, duration={2:.2f}s, peak={3}'.format(
+                    node_id, exit_code, duration, peak))
+                if exit_code != 0:
+                    failed.append(node_id)
+    return failed
+
+
+# scope为all时，除性能用例外的所有用例(精度用例、没有标记的用例和unit用例)在主进程或进程池中执行
+NON_PROF_MARKER = "not prof and not sweep"
+
+
+def run_isolated_prof(marker, args):
+    """
+    性能用例在单独的worker进程中逐个执行，不和其他用例并行
+    worker按prof_config绑定CPU、设置线程数，计时期间关闭gc，机器繁忙时等待
+    """
+    context = multiprocessing.get_context('spawn')
+    initargs = (args.device, dict(prof_config), dict(acc_config))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_prof_worker,
+                                                initargs=initargs) as executor:
+        return executor.submit(pytest.main, ["-m", marker, "-s", "./testcase/"]).result()
+
+
+def run_with_workers(args):
+    logging.basicConfig(level=logging.INFO)
+    failed = []
+    if args.scope in ["acc", "all"]:
+        failed = run_parallel_acc(collect_cases(NON_PROF_MARKER if args.scope == "all" else "acc"), args)
+    if args.scope in ["prof", "all"]:
+        if run_isolated_prof("prof", args) != 0:
+            failed.append("prof cases")
+    for node_id in failed:
+        logging.error('FAILED {0}'.format(node_id))
+    return 1 if failed else 0
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
     set_device_info(args.device)
+    set_prof_config(warmup=args.warmup, iters=args.iters, window=args.window, breakdown=args.breakdown,
+                    profiler=args.profiler, memory_threshold=args.memory_threshold, cpu_affinity=args.cpu_affinity,
+                    intra_threads=args.intra_threads, interop_threads=args.interop_threads,
+                    load_threshold=args.load_threshold)
+    set_acc_config(golden_cache=args.golden_cache, golden_cache_size=args.golden_cache_size,
+                   dump_cache_size=args.dump_cache_size, device_compare=args.device_compare,
+                   collect_all=args.collect_all, acc_report_dir=args.acc_report_dir,
+                   acc_report_format=args.acc_report_format, locate_divergence=args.locate_divergence,
+                   offload_buffer_size=args.offload_buffer_size, offload_capture=args.offload_capture)
     set_seed()
+    if args.workers > 1 and args.scope in ["acc", "prof", "all"]:
+        return run_with_workers(args)
     if args.scope == "all":
-        pytest.main(["-s", "./testcase/"])
+        acc_exit_code = pytest.main(["-m", NON_PROF_MARKER, "-s", "./testcase/"])
+        prof_exit_code = run_isolated_prof("prof", args)
+        return 1 if acc_exit_code != 0 or prof_exit_code != 0 else 0
     elif args.scope == "acc":
-        pytest.main(["-m acc ", "-s", "./testcase/"])
+        return int(pytest.main(["-m acc ", "-s", "./testcase/"]))
     elif args.scope == "prof":
-        pytest.main(["-m prof ", "-s", "./testcase/"])
+        return int(run_isolated_prof("prof", args))
+    elif args.scope == "sweep":
+        return int(run_isolated_prof("sweep", args))
     elif args.scope == "single":
-        pytest.main(["-s", test_cases[args.case_id]])
+        return int(pytest.main(["-s", test_cases[args.case_id]]))
 
 
 if __name__ == "__main__":
-    main()
+    exit(main())
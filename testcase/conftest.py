@@ -0,0 +1,44 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+def pytest_sessionstart(session):
+    from utils.acc_report import get_acc_report
+    get_acc_report().begin_session()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # collect_all模式下用例不因精度失败，存在不满足阈值的tensor时session失败一次
+    from utils.acc_report import get_acc_report
+    from utils.base_utils import acc_config
+    report = get_acc_report()
+    if not acc_config['collect_all'] or not report.session_rows():
+        return
+    report.save(acc_config['acc_report_dir'], acc_config['acc_report_format'])
+    if report.failures():
+        session.exitstatus = 1
+
+
+def pytest_terminal_summary(terminalreporter):
+    from utils import dump_cache
+    from utils.acc_report import get_acc_report
+    from utils.base_utils import acc_config
+    if acc_config['collect_all'] and get_acc_report().session_rows():
+        for line in get_acc_report().summary().splitlines():
+            terminalreporter.write_line(line)
+    if dump_cache._dump_cache is None:
+        return
+    stats = dump_cache._dump_cache.stats()
+    terminalreporter.write_line('dump cache: hits={0}, misses={1}, evictions={2}, entries={3}, cached_bytes={4}'.format(
+        stats['hits'], stats['misses'], stats['evictions'], stats['entries'], stats['cached_bytes']))
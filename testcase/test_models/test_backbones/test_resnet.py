@@ -18,6 +18,7 @@ from mmdet.models.backbones.resnet import BasicBlock
 from mmdet.models.backbones import ResNet
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestResnetTestCase:
@@ -55,7 +56,7 @@ class TestResnetTestCase:
         model = ResNet(depth=18)
 
         pt_path = './data/pt_dump/backbones/resnet/resnet.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         resnet_model = self.base_util.set_params_from_config(model, config)
 
         if config['config']['thresholds']:
@@ -77,3 +78,10 @@ class TestResnetTestCase:
         input = torch.load('./data/pt_dump/backbones/resnet/Resnet_input.pt', map_location=torch.device('cpu'))
         prof_path = './data/prof_time_summary/backbones/resnet/resnet_prof_dump.csv'
         self.base_util.run_and_compare_prof(self.block, prof_path, 0.3, input)
+
+    @pytest.mark.sweep
+    def test_resnet_basic_block_prof_sweep(self):
+        self.block = BasicBlock(64, 64)
+        prof_path = './data/prof_time_summary/backbones/resnet/resnet_prof.csv'
+        self.base_util.run_prof_sweep(self.block, prof_path, lambda b, s: (torch.rand(b, 64, s, s),),
+                                      batch_sizes=[1, 2, 4], sizes=[28, 56, 112])
@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import CenterNetHead
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestCenterNetHeadTestCase:
@@ -45,7 +46,7 @@ class TestCenterNetHeadTestCase:
         comparison_hook.update_threshold_all_module('cos', 0.96)
 
         pt_path = './data/pt_dump/heads/centernet_head/centernet_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         centernet_head = self.base_util.set_params_from_config(centernet_head, config)
 
         if config['config']['thresholds']:
@@ -57,3 +58,10 @@ class TestCenterNetHeadTestCase:
         x = [torch.rand(2, 16, 3, 3) for _ in range(3)]
         prof_path = './data/prof_time_summary/heads/centernet_head/centernet_head_prof.csv'
         self.base_util.run_and_compare_prof(self.centernet_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_centernet_head_prof_sweep(self):
+        prof_path = './data/prof_time_summary/heads/centernet_head/centernet_head_prof.csv'
+        self.base_util.run_prof_sweep(self.centernet_head, prof_path,
+                                      lambda b, s: ([torch.rand(b, 16, s, s) for _ in range(3)],),
+                                      batch_sizes=[1, 2, 4], sizes=[32, 64, 128])
@@ -42,3 +42,10 @@ class TestFCOSHeadTestCase:
         x = [torch.rand(2, 16, 3, 3) for _ in range(3)]
         prof_path = './data/prof_time_summary/heads/fcos_head/fcos_head_prof.csv'
         self.base_util.run_and_compare_prof(self.fcos_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_fcos_head_prof_sweep(self):
+        prof_path = './data/prof_time_summary/heads/fcos_head/fcos_head_prof.csv'
+        self.base_util.run_prof_sweep(self.fcos_head, prof_path,
+                                      lambda b, s: ([torch.rand(b, 16, s // 2 ** i, s // 2 ** i) for i in range(3)],),
+                                      batch_sizes=[1, 2, 4], sizes=[20, 40, 80])
@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import RetinaHead
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestRetinaHeadTestCase:
@@ -41,7 +42,7 @@ class TestRetinaHeadTestCase:
     def test_retina_head_acc_real_data(self):
         retina_head = RetinaHead(11, 7)
         pt_path = './data/pt_dump/heads/retina_head/retina_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         retina_head = self.base_util.set_params_from_config(retina_head, config)
 
         if config['config']['thresholds']:
@@ -53,3 +54,10 @@ class TestRetinaHeadTestCase:
         x = torch.rand(2, 2, 7, 3, 3)
         prof_path = './data/prof_time_summary/heads/retina_head/retina_head_prof.csv'
         self.base_util.run_and_compare_prof(self.retina_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_retina_head_prof_sweep(self):
+        prof_path = './data/prof_time_summary/heads/retina_head/retina_head_prof.csv'
+        self.base_util.run_prof_sweep(self.retina_head, prof_path,
+                                      lambda b, s: ([torch.rand(b, 7, s // 2 ** i, s // 2 ** i) for i in range(2)],),
+                                      batch_sizes=[1, 2, 4], sizes=[8, 16, 32])
@@ -58,3 +58,13 @@ class TestShared2FCBBoxHeadTestCase:
         input = torch.rand(1, 256, 7, 7)
         prof_path = './data/prof_time_summary/heads/shared2FCB_box/shared2FCB_box_prof.csv'
         self.base_util.run_and_compare_prof(self.box_head, prof_path, 0.3, input)
+
+    @pytest.mark.sweep
+    def test_shared2FCB_box_prof_sweep(self):
+        # 全连接层的输入大小由roi_feat_size固定为7x7，只测试耗时随RoI个数的增长
+        def make_input(batch, size):
+            return (torch.rand(batch, 256, size, size),)
+
+        prof_path = './data/prof_time_summary/heads/shared2FCB_box/shared2FCB_box_prof.csv'
+        self.base_util.run_prof_sweep(self.box_head, prof_path, make_input,
+                                      batch_sizes=[1, 16, 256], sizes=[7])
@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import SOLOV2Head
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestSOLOV2HeadTestCase:
@@ -60,7 +61,7 @@ class TestSOLOV2HeadTestCase:
     def test_solov2_head_acc_real_data(self):
         import copy
         pt_path = './data/pt_dump/heads/solov2_head/solov2_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         comparison_hook.delete_comparison_hook('cos')  # value值差距很小, cos偏差较大
 
         solov2_head = copy.deepcopy(self.solov2_head)
@@ -74,3 +75,14 @@ class TestSOLOV2HeadTestCase:
         x = [torch.rand(2, 16, 24, 24), torch.rand(2, 16, 12, 12), torch.rand(2, 16, 12, 12)]
         prof_path = './data/prof_time_summary/heads/solov2_head/solov2_head_prof.csv'
         self.base_util.run_and_compare_prof(self.solov2_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_solov2_head_prof_sweep(self):
+        def make_input(batch, size):
+            # mask_feature_head会将level 1上采样2倍后和level 0相加
+            return ([torch.rand(batch, 16, size, size), torch.rand(batch, 16, size // 2, size // 2),
+                     torch.rand(batch, 16, size // 2, size // 2)],)
+
+        prof_path = './data/prof_time_summary/heads/solov2_head/solov2_head_prof.csv'
+        self.base_util.run_prof_sweep(self.solov2_head, prof_path, make_input,
+                                      batch_sizes=[1, 2, 4], sizes=[24, 48, 96])
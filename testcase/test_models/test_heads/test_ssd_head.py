@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import SSDHead
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestSSDHeadTestCase:
@@ -68,7 +69,7 @@ class TestSSDHeadTestCase:
                 ratios=[[2], [2, 3], [2, 3], [2, 3], [2], [2]]))
 
         pt_path = './data/pt_dump/heads/ssd_head/ssd_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         ssd_head = self.base_util.set_params_from_config(ssd_head, config)
 
         if config['config']['thresholds']:
@@ -85,3 +86,12 @@ class TestSSDHeadTestCase:
         )
         prof_path = './data/prof_time_summary/heads/ssd_head/ssd_head_prof.csv'
         self.base_util.run_and_compare_prof(self.ssd_head, prof_path, 0.3, feats)
+
+    @pytest.mark.sweep
+    def test_ssd_head_prof_sweep(self):
+        def make_input(batch, size):
+            return ((torch.rand((batch, 256, size, size)), torch.rand((batch, 256, size // 2, size // 2))),)
+
+        prof_path = './data/prof_time_summary/heads/ssd_head/ssd_head_prof.csv'
+        self.base_util.run_prof_sweep(self.ssd_head, prof_path, make_input,
+                                      batch_sizes=[1, 2, 4], sizes=[10, 19, 38])
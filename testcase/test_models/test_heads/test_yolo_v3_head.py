@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import YOLOV3Head
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestYOLOV3HeadTestCase:
@@ -44,7 +45,7 @@ class TestYOLOV3HeadTestCase:
         yolo_head = YOLOV3Head(3, (32, 16, 8))
 
         pt_path = './data/pt_dump/heads/yolo_v3_head/yolo_v3_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         yolo_head = self.base_util.set_params_from_config(yolo_head, config)
 
         if config['config']['thresholds']:
@@ -56,3 +57,13 @@ class TestYOLOV3HeadTestCase:
         x = [torch.rand(2, 32, 3, 3), torch.rand(2, 16, 3, 3), torch.rand(2, 8, 3, 3)]
         prof_path = './data/prof_time_summary/heads/yolo_v3_head/yolo_v3_head_prof.csv'
         self.base_util.run_and_compare_prof(self.yolo_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_yolo_head_prof_sweep(self):
+        def make_input(batch, size):
+            return ([torch.rand(batch, 32, size, size), torch.rand(batch, 16, size * 2, size * 2),
+                     torch.rand(batch, 8, size * 4, size * 4)],)
+
+        prof_path = './data/prof_time_summary/heads/yolo_v3_head/yolo_v3_head_prof.csv'
+        self.base_util.run_prof_sweep(self.yolo_head, prof_path, make_input,
+                                      batch_sizes=[1, 2, 4], sizes=[5, 10, 20])
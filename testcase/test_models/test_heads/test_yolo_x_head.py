@@ -18,6 +18,7 @@ import torch
 from mmdet.models.dense_heads import YOLOXHead
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestYOLOXHeadTestCase:
@@ -44,7 +45,7 @@ class TestYOLOXHeadTestCase:
         yolo_head = YOLOXHead(3, 11)
 
         pt_path = './data/pt_dump/heads/yolo_x_head/yolo_x_head.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         yolo_head = self.base_util.set_params_from_config(yolo_head, config)
 
         if config['config']['thresholds']:
@@ -56,3 +57,10 @@ class TestYOLOXHeadTestCase:
         x = [torch.rand(2, 16, 3, 3) for _ in range(3)]
         prof_path = './data/prof_time_summary/heads/yolo_x_head/yolo_x_head_prof.csv'
         self.base_util.run_and_compare_prof(self.yolo_head, prof_path, 0.3, x)
+
+    @pytest.mark.sweep
+    def test_yolo_head_prof_sweep(self):
+        prof_path = './data/prof_time_summary/heads/yolo_x_head/yolo_x_head_prof.csv'
+        self.base_util.run_prof_sweep(self.yolo_head, prof_path,
+                                      lambda b, s: ([torch.rand(b, 16, s // 2 ** i, s // 2 ** i) for i in range(3)],),
+                                      batch_sizes=[1, 2, 4], sizes=[20, 40, 80])
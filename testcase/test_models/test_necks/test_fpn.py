@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 import pytest
 import torch
 from mmdet.models.necks import FPN
 from utils.acc_utils import comparison_hook
 from utils.base_utils import BaseUtil
+from utils.dump_cache import load_cached_dump
 
 
 class TestFPNTestCase:
@@ -53,7 +56,7 @@ class TestFPNTestCase:
         fpn_model = FPN(in_channels=[1, 2, 3], out_channels=8, num_outs=5)
 
         pt_path = './data/pt_dump/necks/fpn/fpn.pth'
-        config = torch.load(pt_path, map_location=torch.device('cpu'))
+        config = load_cached_dump(pt_path)
         fpn_model = self.base_util.set_params_from_config(fpn_model, config)
 
         if config['config']['thresholds']:
@@ -70,3 +73,25 @@ class TestFPNTestCase:
         ]
         prof_path = './data/prof_time_summary/necks/fpn/fpn_prof.csv'
         self.base_util.run_and_compare_prof(self.fpn_model, prof_path, 0.3, feats)
+
+    @pytest.mark.prof
+    @pytest.mark.skipif(not os.path.exists('./data/stream_dump/necks/fpn'),
+                        reason='multi-iteration dump of FPN is not prepared.')
+    def test_fpn_real_data_replay(self):
+        fpn_model = FPN(in_channels=[1, 2, 3], out_channels=8, num_outs=5)
+        dump_dir = './data/stream_dump/necks/fpn'
+        prof_path = './data/prof_time_summary/necks/fpn/fpn_replay.csv'
+        self.base_util.run_real_data_replay(fpn_model, 'FPN', dump_dir, prof_path, 0.3)
+
+    @pytest.mark.sweep
+    def test_fpn_prof_sweep(self):
+        def make_input(batch, size):
+            feats = [
+                torch.rand(batch, self.in_channels[i], size // 2 ** i, size // 2 ** i)
+                for i in range(len(self.in_channels))
+            ]
+            return (feats,)
+
+        prof_path = './data/prof_time_summary/necks/fpn/fpn_prof.csv'
+        self.base_util.run_prof_sweep(self.fpn_model, prof_path, make_input,
+                                      batch_sizes=[1, 2, 4], sizes=[64, 128, 256])
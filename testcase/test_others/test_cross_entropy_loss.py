@@ -52,3 +52,13 @@ class TestCrossEntropyLossTestCase:
         label = torch.tensor([1, 0, 4, 8, 4, 7, 9, 3, 2, 5, 3, 6, 2, 7, 9])
         prof_path = './data/prof_time_summary/others/cross_entropy/cross_entropy_prof.csv'
         self.base_util.run_and_compare_prof(self.loss, prof_path, 0.3, cls_score, label)
+
+    @pytest.mark.sweep
+    def test_cross_entropy_prof_sweep(self):
+        # loss没有空间维度，只测试耗时随样本数的增长，size为类别数且固定
+        def make_input(batch, size):
+            return torch.rand([batch, size]), torch.randint(0, size, (batch,))
+
+        prof_path = './data/prof_time_summary/others/cross_entropy/cross_entropy_prof.csv'
+        self.base_util.run_prof_sweep(self.loss, prof_path, make_input,
+                                      batch_sizes=[15, 240, 3840], sizes=[10])
@@ -63,3 +63,18 @@ class TestMaxIoUAssignerTestCase:
         prof_path = './data/prof_time_summary/others/maxIoU_assigner/maxIoU_assigner_prof.csv'
 
         self.base_util.run_and_compare_prof(self.maxIoU_assigner, prof_path, 0.3, bboxes, gt_bboxes)
+
+    @pytest.mark.sweep
+    def test_maxIoU_assigner_prof_sweep(self):
+        # batch为候选框个数，gt框个数固定，size为图像大小，只影响框的坐标范围
+        def make_input(batch, size):
+            def random_bboxes(num):
+                xy = torch.rand(num, 2) * size
+                wh = torch.rand(num, 2) * size / 4 + 1
+                return torch.cat([xy, xy + wh], dim=1)
+
+            return random_bboxes(batch), random_bboxes(4)
+
+        prof_path = './data/prof_time_summary/others/maxIoU_assigner/maxIoU_assigner_prof.csv'
+        self.base_util.run_prof_sweep(self.maxIoU_assigner, prof_path, make_input,
+                                      batch_sizes=[4, 64, 1024], sizes=[64])
@@ -0,0 +1,71 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+from utils import acc_utils
+from utils.acc_utils import fused_metrics
+
+pytestmark = pytest.mark.unit
+
+NAMES = ['cos', 'value', 'rel', 'mismatch', 'worst', 'ulp', 'rel_hist']
+
+
+def to_python(metrics):
+    return {k: tuple(t.tolist() for t in v) if k == 'worst' else v.tolist() for k, v in metrics.items()}
+
+
+@pytest.mark.parametrize('shape, block', [
+    ((4, 300, 17, 9), 1 << 16),
+    ((4, 300, 17, 9), 128),
+    ((200001,), 1 << 16),
+    ((200001,), 1000),
+    ((3, 5), 1 << 16),
+    ((2, 7000, 3), 1000),
+])
+def test_fused_metrics_chunk_invariant(shape, block, monkeypatch):
+    monkeypatch.setitem(acc_utils.comparison_chunk, 'block', block)
+    torch.manual_seed(0)
+    outputs = torch.randn(shape)
+    outputs_expected = outputs + 1e-3 * torch.randn(shape)
+    outputs_expected.view(-1)[5] = 0
+
+    expected = to_python(fused_metrics(outputs, outputs_expected, NAMES, chunk_elements=1 << 30))
+    for chunk_elements in [1 << 20, 100000, 4096, 1000, 7, 1]:
+        if outputs.numel() // chunk_elements > 20000:
+            continue
+        assert to_python(fused_metrics(outputs, outputs_expected, NAMES, chunk_elements=chunk_elements)) == expected
+
+
+@pytest.mark.parametrize('shape', [(4, 300, 17, 9), (200001,), (3, 5)])
+def test_fused_metrics_match_reference(shape):
+    torch.manual_seed(0)
+    outputs = torch.randn(shape)
+    outputs_expected = outputs + 1e-3 * torch.randn(shape)
+    metrics = fused_metrics(outputs, outputs_expected, ['cos', 'value', 'mismatch', 'worst'], chunk_elements=1000)
+
+    diff = (outputs.double() - outputs_expected.double()).abs()
+    dim = 1 if outputs.ndim > 1 else 0
+    cos = torch.nn.functional.cosine_similarity(outputs.double(), outputs_expected.double(), dim=dim).min()
+    assert metrics['cos'].item() == pytest.approx(cos.item(), abs=1e-12)
+    assert metrics['value'].item() == diff.max().item()
+    assert metrics['mismatch'].item() == (~torch.isclose(outputs.double(), outputs_expected.double())).sum().item()
+    assert metrics['worst'][0][0].item() == diff.reshape(-1).argmax().item()
+
+
+def test_fused_metrics_empty():
+    metrics = fused_metrics(torch.zeros(0, 3), torch.zeros(0, 3), NAMES)
+    assert torch.isnan(metrics['cos'])
+    assert metrics['mismatch'].item() == 0
+    assert metrics['worst'][0].numel() == 0
@@ -0,0 +1,74 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import os
+
+import pytest
+import torch
+from utils.dump_cache import DumpCache
+from utils.tensor_store import LazyDict
+
+pytestmark = pytest.mark.unit
+
+
+def save_dump(path, numel):
+    dump = {'forward': {'inputs': [torch.randn(numel)]}, 'config': {'thresholds': 0.1}}
+    torch.save(dump, path)
+    return dump
+
+
+def test_hit_returns_isolated_views(tmp_path):
+    dump = save_dump(str(tmp_path / 'a.pth'), 16)
+    cache = DumpCache(1024 ** 2, str(tmp_path / 'cache'))
+    first = cache.get(str(tmp_path / 'a.pth'))
+    assert isinstance(first, LazyDict)
+    first['forward']['inputs'][0].add_(1)
+    second = cache.get(str(tmp_path / 'a.pth'))
+    assert torch.equal(second['forward']['inputs'][0], dump['forward']['inputs'][0])
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_reload_after_redump(tmp_path):
+    path = str(tmp_path / 'a.pth')
+    save_dump(path, 16)
+    cache = DumpCache(1024 ** 2, str(tmp_path / 'cache'))
+    cache.get(path)
+    dump = save_dump(path, 32)
+    os.utime(path, ns=(0, 10 ** 18))
+    assert torch.equal(cache.get(path)['forward']['inputs'][0], dump['forward']['inputs'][0])
+    assert cache.stats()['entries'] == 1
+
+
+def test_evict_converted_files(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    # 每个转换后的文件约4KB，上限只能保留两个
+    cache = DumpCache(10 * 1024, cache_dir)
+    paths = [str(tmp_path / '{0}.pth'.format(i)) for i in range(3)]
+    dumps = [save_dump(path, 1024) for path in paths]
+    converted = [cache.converted_path(cache.make_key(path)) for path in paths]
+    cache.get(paths[0])
+    cache.get(paths[1])
+    os.utime(converted[0], (0, 0))
+    os.utime(converted[1], (1, 1))
+    # 重新读取的文件变为最近使用，淘汰最久没有读取的paths[1]
+    cache.get(paths[0])
+    cache.get(paths[2])
+    assert sorted(glob.glob(os.path.join(cache_dir, '*.tstore'))) == sorted([converted[0], converted[2]])
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['cached_bytes'] <= 10 * 1024
+    # 被淘汰的文件重新转换
+    assert torch.equal(cache.get(paths[1])['forward']['inputs'][0], dumps[1]['forward']['inputs'][0])
+    assert cache.stats()['misses'] == 4
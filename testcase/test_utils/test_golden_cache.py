@@ -0,0 +1,70 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+import torch
+from utils.golden_cache import GoldenCache
+
+pytestmark = pytest.mark.unit
+
+
+class Assigner:
+    def __init__(self, pos_iou_thr, neg_iou_thr):
+        self.pos_iou_thr = pos_iou_thr
+        self.neg_iou_thr = neg_iou_thr
+        self.iou_calculator = torch.nn.functional.relu
+
+
+class AssignerModule(torch.nn.Module):
+    def __init__(self, pos_iou_thr=0.5, neg_iou_thr=0.5):
+        super().__init__()
+        self.assigner = Assigner(pos_iou_thr, neg_iou_thr)
+        self.fc = torch.nn.Linear(4, 4)
+
+    def forward(self, x):
+        return self.fc(x)
+
+
+def make_key(module, *input):
+    return GoldenCache().make_key(module, 'acc', *input)
+
+
+def test_key_stable():
+    torch.manual_seed(0)
+    module = AssignerModule()
+    x = torch.rand(2, 4)
+    assert make_key(module, x) == make_key(module, x)
+    torch.manual_seed(0)
+    assert make_key(AssignerModule(), x) == make_key(module, x)
+
+
+def test_key_depends_on_hparams_outside_modules():
+    torch.manual_seed(0)
+    module = AssignerModule()
+    x = torch.rand(2, 4)
+    key = make_key(module, x)
+    module.assigner.pos_iou_thr = 0.7
+    assert make_key(module, x) != key
+
+
+def test_key_depends_on_weights_and_inputs():
+    torch.manual_seed(0)
+    module = AssignerModule()
+    x = torch.rand(2, 4)
+    key = make_key(module, x)
+    assert make_key(module, x + 1) != key
+    with torch.no_grad():
+        module.fc.weight.add_(1)
+    assert make_key(module, x) != key
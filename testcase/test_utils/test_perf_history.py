@@ -0,0 +1,49 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import csv
+
+import pytest
+from utils.perf_history import PerfHistory
+
+pytestmark = pytest.mark.unit
+
+
+def test_query_column_added_by_other_connection(tmp_path):
+    db_path = str(tmp_path / 'perf_history.db')
+    history = PerfHistory(db_path)
+    history.append('case', {'one_step_time(s)': 1.0}, device_info='910B')
+    assert history.query('case', 'median(s)', device_info='910B') == []
+
+    # 另一个进程添加了新的列
+    other = PerfHistory(db_path)
+    other.append('case', {'one_step_time(s)': 2.0, 'median(s)': 1.5}, device_info='910B')
+    assert history.query('case', 'median(s)', device_info='910B') == [1.5]
+    assert history.query('case', 'one_step_time(s)', device_info='910B') == [1.0, 2.0]
+    assert history.query('case', 'one_step_time(s)', device_info='310P') == []
+
+
+def test_import_csv_once(tmp_path):
+    csv_path = str(tmp_path / 'fpn_prof.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', 'device_info', 'one_step_time(s)'])
+        for i in range(3):
+            writer.writerow(['2023-03-0{0} 10:00:00'.format(i + 1), '910B', 0.1 * (i + 1)])
+    history = PerfHistory(str(tmp_path / 'perf_history.db'))
+    assert not history.has_case('fpn')
+    assert history.import_csv(csv_path, 'fpn') == 3
+    assert history.import_csv(csv_path, 'fpn') == 0
+    assert history.query('fpn', 'one_step_time(s)', device_info='910B') == pytest.approx([0.1, 0.2, 0.3])
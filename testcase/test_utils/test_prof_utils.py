@@ -0,0 +1,75 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+
+import pytest
+from utils.prof_utils import MAD_SCALE, detect_regression, median_abs_deviation
+
+pytestmark = pytest.mark.unit
+
+BASELINE = [1.00, 1.01, 0.99, 1.02, 0.98, 1.00, 1.01]
+
+
+def test_median_abs_deviation():
+    assert median_abs_deviation([1.0, 2.0, 3.0, 4.0, 100.0]) == pytest.approx(1.0 * MAD_SCALE)
+    assert median_abs_deviation([2.0, 2.0, 2.0]) == 0.0
+
+
+def test_pass():
+    verdict = detect_regression([1.01, 1.00, 0.99], BASELINE)
+    assert verdict.status == 'pass'
+    assert verdict.baseline == 1.00 and verdict.current == 1.00
+
+
+def test_regression():
+    verdict = detect_regression([1.30, 1.31, 1.29], BASELINE)
+    assert verdict.status == 'regression'
+    assert verdict.gap == pytest.approx(0.30)
+    assert verdict.effect_size > 3.0
+
+
+def test_improvement():
+    verdict = detect_regression([0.70, 0.71, 0.69], BASELINE)
+    assert verdict.status == 'improvement'
+    assert verdict.gap == pytest.approx(-0.30)
+    assert verdict.effect_size < -3.0
+
+
+def test_noisy():
+    # 中位数的相对差距超过阈值，但样本波动很大，effect_size不足以判定为劣化
+    noisy_baseline = [0.5, 1.0, 1.5, 0.6, 1.4, 1.0, 0.8]
+    verdict = detect_regression([1.3, 0.4, 1.9, 1.2, 0.7], noisy_baseline)
+    assert verdict.gap > 0.1
+    assert verdict.effect_size <= 3.0
+    assert verdict.status == 'pass'
+
+
+def test_small_gap_not_regression():
+    # 样本没有波动时effect_size为无穷大，仍然需要相对差距超过阈值
+    verdict = detect_regression([1.05] * 3, [1.0] * 5)
+    assert verdict.effect_size == math.inf
+    assert verdict.status == 'pass'
+
+
+def test_no_baseline():
+    verdict = detect_regression([1.0, 2.0, 3.0], [])
+    assert verdict.status == 'pass' and verdict.baseline is None and verdict.current == 2.0
+
+
+def test_zero_baseline():
+    assert detect_regression([0.0, 0.0], [0.0, 0.0, 0.0]) == ('pass', 0.0, 0.0, 0.0, 0.0)
+    verdict = detect_regression([1.0, 1.0], [0.0, 0.0, 0.0])
+    assert verdict.status == 'regression' and verdict.gap == math.inf
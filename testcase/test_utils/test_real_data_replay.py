@@ -0,0 +1,86 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import os
+
+import pytest
+import torch
+from utils.base_utils import replay_checks_acc
+from utils.real_data_hook import stream_dump_hook, to_host
+from utils.tensor_store import load_dump
+
+pytestmark = pytest.mark.unit
+
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(4, 3)
+
+    def forward(self, x):
+        return self.fc(x)
+
+
+def train_with_stream_dump(save_dir, iterations=6, **kwargs):
+    torch.manual_seed(0)
+    model = stream_dump_hook(Net(), str(save_dir), dump_name_list=['fc'], max_pending=iterations, **kwargs)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    for _ in range(iterations):
+        optimizer.zero_grad()
+        model(torch.randn(2, 4, requires_grad=True)).sum().backward()
+        optimizer.step()
+    model.stream_dump.close()
+    paths = sorted(glob.glob(os.path.join(str(save_dir), 'fc', 'iter_*.tstore')))
+    return [load_dump(path) for path in paths]
+
+
+def test_replay_checks_first_iteration(tmp_path):
+    dumps = train_with_stream_dump(tmp_path)
+    assert [dump['iteration'] for dump in dumps] == list(range(6))
+    assert [replay_checks_acc(dump) for dump in dumps] == [True] + [False] * 5
+
+
+@pytest.mark.parametrize('start, every_k', [(2, 1), (0, 2), (3, 2)])
+def test_replay_skips_acc_after_weight_update(start, every_k, tmp_path):
+    # 第一个被采样的iteration之前权重已经更新，和config中的权重不同，不能比较精度
+    dumps = train_with_stream_dump(tmp_path, start=start, every_k=every_k)
+    iterations = [dump['iteration'] for dump in dumps]
+    assert iterations == list(range(start, 6, every_k))
+    assert [replay_checks_acc(dump) for dump in dumps] == [iteration == 0 for iteration in iterations]
+
+
+def test_replay_checks_with_state_dict(tmp_path):
+    dumps = train_with_stream_dump(tmp_path, start=2, state_dict=True)
+    assert all(replay_checks_acc(dump) for dump in dumps)
+    config = load_dump(os.path.join(str(tmp_path), 'fc', 'config.tstore'))
+    # 保存的state_dict是该iteration前向时的权重，和安装hook时的不同
+    assert not torch.equal(dumps[0]['state_dict']['weight'], config['config']['state_dict']['weight'])
+
+
+def test_config_written_at_install(tmp_path):
+    # config在安装hook时直接写入文件，之后的权重更新不影响config
+    torch.manual_seed(0)
+    initial = Net().fc.state_dict()
+    train_with_stream_dump(tmp_path)
+    config = load_dump(os.path.join(str(tmp_path), 'fc', 'config.tstore'))
+    for name, value in initial.items():
+        assert torch.equal(config['config']['state_dict'][name], value)
+
+
+def test_to_host_without_copy():
+    weight = torch.nn.Parameter(torch.randn(3))
+    assert to_host(weight, copy=False).data_ptr() == weight.data_ptr()
+    assert to_host(weight).data_ptr() != weight.data_ptr()
@@ -0,0 +1,92 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+
+import pytest
+import torch
+from utils.acc_utils import summary_comparison, summary_threshold, tensor_summary_comparison
+from utils.real_data_hook import SUMMARY_BINS, SUMMARY_SAMPLES, summarize, summarize_tensor
+
+pytestmark = pytest.mark.unit
+
+
+def test_summary_fields():
+    torch.manual_seed(0)
+    tensor = torch.randn(8, 100)
+    summary = summarize_tensor(tensor)
+    assert summary['type'] == 'tensor_summary'
+    assert summary['shape'] == [8, 100] and summary['dtype'] == 'float32' and summary['numel'] == 800
+    assert summary['min'] == tensor.min().item() and summary['max'] == tensor.max().item()
+    assert summary['mean'] == pytest.approx(tensor.mean().item(), abs=1e-6)
+    assert summary['std'] == pytest.approx(tensor.std().item(), rel=1e-5)
+    assert summary['l2'] == pytest.approx(tensor.norm().item(), rel=1e-5)
+    assert summary['nan'] == 0 and summary['inf'] == 0
+    assert summary['hist'].shape == (SUMMARY_BINS,) and summary['hist'].sum().item() == 800
+    assert torch.equal(summary['sample'], tensor.reshape(-1)[::800 // SUMMARY_SAMPLES][:SUMMARY_SAMPLES])
+
+
+def test_summary_nan_inf():
+    tensor = torch.tensor([1.0, float('nan'), 3.0, float('inf'), float('-inf'), float('nan'), -2.0])
+    summary = summarize_tensor(tensor)
+    assert summary['nan'] == 2 and summary['inf'] == 2
+    # 统计量只包含有限的元素
+    assert summary['min'] == -2.0 and summary['max'] == 3.0
+    assert summary['mean'] == pytest.approx(2.0 / 3)
+    assert summary['l2'] == pytest.approx(math.sqrt(14))
+    assert summary['hist'].sum().item() == 3
+
+
+def test_summary_all_nan_and_empty():
+    summary = summarize_tensor(torch.full((4,), float('nan')))
+    assert summary['nan'] == 4 and summary['inf'] == 0
+    assert summary['min'] == 0.0 and summary['max'] == 0.0 and summary['mean'] == 0.0
+    assert summary['hist'].sum().item() == 0
+    empty = summarize_tensor(torch.zeros(0, 3))
+    assert empty['numel'] == 0 and 'min' not in empty
+
+
+def test_summarize_nested():
+    summary = summarize({'outputs': (torch.ones(2), [torch.zeros(3, dtype=torch.float16)]), 'scale': 2})
+    assert summary['outputs'][0]['shape'] == [2]
+    assert summary['outputs'][1][0]['dtype'] == 'float16'
+    assert summary['scale'] == 2
+
+
+def test_summary_comparison_pass():
+    torch.manual_seed(0)
+    tensor = torch.randn(1000)
+    expected = summarize({'forward': [tensor]})
+    summary_comparison(summarize({'forward': [tensor + 1e-5 * torch.randn(1000)]}), expected, 'm')
+
+
+@pytest.mark.parametrize('perturb', [
+    lambda x: x * 1.1,
+    lambda x: x + 0.5,
+    lambda x: x.flip(0),
+    lambda x: torch.cat([x[:-1], torch.tensor([float('nan')])]),
+    lambda x: torch.cat([x[:-1], torch.tensor([float('inf')])]),
+])
+def test_summary_comparison_fail(perturb):
+    torch.manual_seed(0)
+    tensor = torch.randn(1000)
+    with pytest.raises(AssertionError):
+        summary_comparison(summarize({'forward': [perturb(tensor)]}), summarize({'forward': [tensor]}), 'm')
+
+
+def test_summary_comparison_shape_mismatch():
+    with pytest.raises(AssertionError, match='shape'):
+        tensor_summary_comparison(summarize_tensor(torch.ones(2, 3)), summarize_tensor(torch.ones(3, 2)),
+                                  summary_threshold, 'm')
@@ -0,0 +1,197 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import io
+import os
+import pickle
+
+import pytest
+import torch
+from utils import tensor_store
+from utils.tensor_store import (ALIGNMENT, LazyDict, MetaUnpickler, ObjectStore, TensorMeta, TensorStore,
+                                load_dump, load_meta, load_tensors, read_header, save_tensors, shard_path)
+
+pytestmark = pytest.mark.unit
+
+DTYPES = [torch.float64, torch.float32, torch.float16, torch.bfloat16, torch.int64, torch.int32, torch.int16,
+          torch.int8, torch.uint8, torch.bool]
+
+
+def make_dump():
+    torch.manual_seed(0)
+    return {
+        'forward': {'inputs': (torch.randn(2, 3, 5), None, [torch.arange(7), 3]), 'outputs': torch.randn(4, 1)},
+        'grads': {'conv.weight': torch.randn(8, 3, 3, 3), 'conv.bias': torch.nn.Parameter(torch.randn(8))},
+        'config': {'name': 'fpn', 'scale': 0.5, 'slice': slice(1, 3)},
+        'empty': torch.zeros(0, 4),
+    }
+
+
+def assert_equal(actual, expected):
+    assert type(actual) is type(expected)
+    if isinstance(expected, torch.Tensor):
+        assert actual.dtype == expected.dtype and actual.shape == expected.shape
+        assert torch.equal(actual, expected)
+    elif isinstance(expected, dict):
+        assert list(actual) == list(expected)
+        for key in expected:
+            assert_equal(actual[key], expected[key])
+    elif isinstance(expected, (list, tuple)):
+        assert len(actual) == len(expected)
+        for each_actual, each_expected in zip(actual, expected):
+            assert_equal(each_actual, each_expected)
+    else:
+        assert actual == expected
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('shape', [(), (1,), (3, 5), (2, 0, 3), (2, 3, 4, 5)])
+def test_round_trip_dtype_shape(dtype, shape, tmp_path):
+    tensor = (torch.randn(shape) * 10).to(dtype)
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors({'x': tensor, 'y': [tensor.t() if tensor.ndim == 2 else tensor]}, path)
+    loaded = load_tensors(path)
+    assert_equal(loaded['x'], tensor)
+    assert_equal(loaded['y'][0], tensor.t() if tensor.ndim == 2 else tensor)
+
+
+def test_round_trip_nested(tmp_path):
+    dump = make_dump()
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors(dump, path)
+    loaded = load_tensors(path)
+    assert_equal(loaded, dump)
+    assert loaded['grads']['conv.bias'].requires_grad
+    header, blob_start = read_header(path)
+    assert blob_start % ALIGNMENT == 0
+    offsets = [node['offset'] for node in header['root']['items'][1]['items']]
+    assert all(offset % ALIGNMENT == 0 for offset in offsets)
+
+
+def test_copy_on_write(tmp_path):
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors({'x': torch.ones(16)}, path)
+    loaded = load_tensors(path)
+    loaded['x'].add_(1)
+    assert torch.equal(load_tensors(path)['x'], torch.ones(16))
+
+
+def test_sharded(tmp_path):
+    dump = {'a{0}'.format(i): torch.randn(100) for i in range(10)}
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors(dump, path, max_shard_bytes=1000)
+    header, _ = read_header(path)
+    assert header['num_shards'] > 1
+    for shard in range(1, header['num_shards']):
+        assert os.path.getsize(shard_path(path, shard)) <= 1000
+    assert {node.get('shard', 0) for node in header['root']['items']} == set(range(header['num_shards']))
+    assert_equal(load_tensors(path), dump)
+
+
+def test_object_store_dedup(tmp_path):
+    objects = ObjectStore(str(tmp_path / 'objects'))
+    shared = torch.randn(32, 32)
+    first = {'x': shared, 'y': shared.clone(), 'z': torch.randn(3)}
+    second = {'x': shared.clone(), 'w': torch.randn(5)}
+    save_tensors(first, str(tmp_path / 'first.tstore'), objects=objects)
+    save_tensors(second, str(tmp_path / 'second.tstore'), objects=objects)
+    # shared的三份拷贝只保存一次
+    assert len(glob.glob(str(tmp_path / 'objects' / '*' / '*.raw'))) == 3
+    assert_equal(load_tensors(str(tmp_path / 'first.tstore')), first)
+    assert_equal(load_tensors(str(tmp_path / 'second.tstore')), second)
+
+
+def test_object_store_compression(tmp_path):
+    objects = ObjectStore(str(tmp_path / 'objects'), compression='zlib')
+    dump = {'x': torch.zeros(1024), 'y': torch.arange(10)}
+    save_tensors(dump, str(tmp_path / 'dump.tstore'), objects=objects)
+    files = glob.glob(str(tmp_path / 'objects' / '*' / '*.zlib'))
+    assert len(files) == 2
+    assert sum(os.path.getsize(f) for f in files) < 1024 * 4
+    assert_equal(load_tensors(str(tmp_path / 'dump.tstore')), dump)
+
+
+def test_lazy_dict(tmp_path, monkeypatch):
+    dump = make_dump()
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors(dump, path)
+    lazy = load_dump(path)
+    assert isinstance(lazy, LazyDict)
+    assert isinstance(lazy['grads'], LazyDict)
+    assert list(lazy) == list(dump) and len(lazy['grads']) == 2
+    assert 'missing' not in lazy
+    with pytest.raises(KeyError):
+        lazy['missing']
+    # 只有访问的tensor被读取
+    decoded = []
+    decode = TensorStore.decode
+    monkeypatch.setattr(TensorStore, 'decode', lambda self, node: decoded.append(node['type']) or decode(self, node))
+    assert_equal(lazy['grads']['conv.weight'], dump['grads']['conv.weight'])
+    assert decoded == ['tensor']
+    assert_equal(lazy['forward'].to_dict(), dump['forward'])
+    assert_equal(TensorStore(path).lazy('forward.inputs'), dump['forward']['inputs'])
+
+
+def test_load_dump_prefers_tstore(tmp_path):
+    dump = make_dump()
+    dump['config'].pop('slice')
+    pth_path = str(tmp_path / 'dump.pth')
+    torch.save(dump, pth_path)
+    assert_equal(load_dump(pth_path), dump)
+    tensor_store.convert_pth_dump(pth_path)
+    assert isinstance(load_dump(pth_path), LazyDict)
+    assert_equal(load_dump(pth_path).to_dict(), dump)
+
+
+def assert_meta(meta, dump):
+    if isinstance(dump, torch.Tensor):
+        assert isinstance(meta, TensorMeta)
+        assert meta.dtype == dump.dtype and meta.shape == list(dump.shape)
+        assert meta.nbytes == dump.numel() * dump.element_size()
+        assert meta.parameter == isinstance(dump, torch.nn.Parameter)
+    elif isinstance(dump, dict):
+        assert list(meta) == list(dump)
+        for key in dump:
+            assert_meta(meta[key], dump[key])
+    elif isinstance(dump, (list, tuple)):
+        assert type(meta) is type(dump) and len(meta) == len(dump)
+        for each_meta, each_dump in zip(meta, dump):
+            assert_meta(each_meta, each_dump)
+    else:
+        assert meta == dump
+
+
+def test_load_meta_tstore_without_blob(tmp_path, monkeypatch):
+    dump = make_dump()
+    dump['config'].pop('slice')
+    path = str(tmp_path / 'dump.tstore')
+    save_tensors(dump, path)
+    monkeypatch.setattr(tensor_store, 'open_blob', lambda *args: pytest.fail('tensor data should not be read'))
+    assert_meta(load_meta(path), dump)
+
+
+@pytest.mark.parametrize('zip_format', [True, False])
+def test_load_meta_pth_without_blob(zip_format, tmp_path, monkeypatch):
+    dump = make_dump()
+    path = str(tmp_path / 'dump.pth')
+    torch.save(dump, path, _use_new_zipfile_serialization=zip_format)
+    monkeypatch.setattr(torch, 'load', lambda *args, **kwargs: pytest.fail('torch.load should not be called'))
+    assert_meta(load_meta(path), dump)
+
+
+def test_meta_unpickler_pickled_tensor():
+    dump = {'x': torch.randn(3, 4).half(), 'y': [torch.arange(5)]}
+    assert_meta(MetaUnpickler(io.BytesIO(pickle.dumps(dump))).load(), dump)
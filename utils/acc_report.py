@@ -0,0 +1,154 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+collect_all模式下的精度报告:
+
+    python main.py --scope acc --collect_all --acc_report_dir ./data/acc_report
+
+每个被比较的tensor(前向输出、反向梯度、参数梯度)记录一行，包括所在的用例、module名称、tensor路径、shape、dtype
+和所有指标，用例中不再因为精度不满足阈值失败，session结束时写入报告并输出汇总，存在不满足阈值的tensor时失败一次
+"""
+import json
+import logging
+import math
+import os
+from collections import OrderedDict
+
+from utils.acc_utils import REL_HIST_BINS, REL_HIST_BINS_PER_DECADE, REL_HIST_MIN_EXP
+from utils.perf_history import now_str
+
+REL_PERCENTILES = [50, 90, 99]
+
+
+def rel_hist_upper(index):
+    """相对误差直方图第index个桶的上界"""
+    if index >= REL_HIST_BINS - 1:
+        return float('inf')
+    return 10 ** (REL_HIST_MIN_EXP + index / REL_HIST_BINS_PER_DECADE)
+
+
+def rel_percentile(hist, q):
+    """返回第q百分位所在桶的上界，误差不超过一个桶的宽度"""
+    count = sum(hist)
+    if count == 0:
+        return 0.0
+    rank = q / 100 * count
+    cumulative = 0
+    for index, bucket in enumerate(hist):
+        cumulative += bucket
+        if bucket and cumulative >= rank:
+            return rel_hist_upper(index)
+    return float('inf')
+
+
+def json_safe(value):
+    """json中不能出现NaN/Infinity: NaN转换为None，inf转换为字符串'inf'/'-inf'"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None if math.isnan(value) else ('inf' if value > 0 else '-inf')
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def current_case():
+    """pytest中执行时为当前用例的node id"""
+    return os.environ.get('PYTEST_CURRENT_TEST', '').split(' ')[0]
+
+
+class AccuracyReport:
+    def __init__(self):
+        self.rows = []
+        self.start = 0
+        self.path = None
+
+    def add(self, module_name, path, outputs, metrics, checks):
+        """
+        记录一个tensor的比较结果
+        :param metrics: compare_batch计算的指标
+        :param checks: dict, compare function名称 -> {'threshold', 'passed', 'metric'(可选), 'error'(不满足时)}
+        """
+        row = OrderedDict(case=current_case(), module_name=module_name, path=path, shape=list(outputs.shape),
+                          dtype=str(outputs.dtype).replace('torch.', ''), numel=outputs.numel())
+        if metrics is not None:
+            for name in ['cos', 'value', 'rel', 'ulp', 'mismatch']:
+                row[name] = metrics[name]
+            for q in REL_PERCENTILES:
+                row['rel_p{0}'.format(q)] = rel_percentile(metrics['rel_hist'], q)
+            row['mismatch_fraction'] = metrics['mismatch'] / max(outputs.numel(), 1)
+            row['worst'] = [list(each) for each in metrics['worst']]
+        row['checks'] = checks
+        row['passed'] = all(check['passed'] for check in checks.values())
+        self.rows.append(row)
+
+    def begin_session(self):
+        """同一个进程中执行多次pytest时，每次只汇总本次session的结果"""
+        self.start = len(self.rows)
+
+    def session_rows(self):
+        return self.rows[self.start:]
+
+    def failures(self):
+        return [row for row in self.session_rows() if not row['passed']]
+
+    def summary(self, top_k=20):
+        rows = self.session_rows()
+        failures = self.failures()
+        lines = ['accuracy report: {0} tensors in {1} cases, {2} failed in {3} cases, saved to {4}'.format(
+            len(rows), len(set(row['case'] for row in rows)), len(failures),
+            len(set(row['case'] for row in failures)), self.path)]
+        for row in failures[:top_k]:
+            lines.append('FAILED {0} {1} {2} shape={3} dtype={4}: {5}'.format(
+                row['case'], row['module_name'], row['path'], row['shape'], row['dtype'],
+                '; '.join('{0}: {1}'.format(name, check['error']) for name, check in row['checks'].items()
+                          if not check['passed'])))
+        if len(failures) > top_k:
+            lines.append('... {0} more failed tensors'.format(len(failures) - top_k))
+        return '\n'.join(lines)
+
+    def save(self, report_dir, fmt='json'):
+        """
+        把本进程的所有结果写入report_dir，每个进程一个文件，文件名在第一次写入时确定
+        :param fmt: json或parquet，parquet需要安装pandas和pyarrow，不可用时写入json
+        """
+        if fmt == 'parquet':
+            try:
+                import pandas
+                import pyarrow  # noqa: F401
+            except ImportError:
+                logging.warning('pandas or pyarrow is not installed, write accuracy report as json.')
+                fmt = 'json'
+        if self.path is None or not self.path.endswith('.' + fmt):
+            os.makedirs(report_dir, exist_ok=True)
+            name = 'acc_report_{0}_{1}.{2}'.format(now_str().replace(' ', '_').replace(':', '-'), os.getpid(), fmt)
+            self.path = os.path.join(report_dir, name)
+        if fmt == 'parquet':
+            rows = [dict(row, worst=json.dumps(json_safe(row.get('worst')), allow_nan=False),
+                         checks=json.dumps(json_safe(row['checks']), allow_nan=False)) for row in self.rows]
+            pandas.DataFrame(rows).to_parquet(self.path)
+        else:
+            with open(self.path, 'w') as f:
+                json.dump(json_safe({'date': now_str(), 'rows': self.rows}), f, indent=1, allow_nan=False)
+        return self.path
+
+
+_acc_report = None
+
+
+def get_acc_report():
+    global _acc_report
+    if _acc_report is None:
+        _acc_report = AccuracyReport()
+    return _acc_report
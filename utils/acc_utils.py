@@ -12,40 +12,222 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+from collections.abc import Mapping
+
 import torch
 import logging
 
 
-def cos_comparison(outputs, outputs_expected, cos_threshold, module_name):
-    assert isinstance(outputs, torch.Tensor)
-    assert isinstance(outputs_expected, torch.Tensor)
-    outputs, outputs_expected = outputs.float(), outputs_expected.float()
-    if outputs.ndim > 1 and outputs_expected.ndim > 1:
-        cos = torch.nn.CosineSimilarity(dim=1)
+# 统计与期望值不一致(不满足allclose)的元素个数时使用的容差，和torch.allclose的默认值相同
+mismatch_tolerance = {'rtol': 1e-5, 'atol': 1e-8}
+# 比较结果中保存的误差最大的元素个数
+NUM_WORST_ELEMENTS = 8
+
+# 流式计算指标时每个chunk的元素个数上限，决定计算过程中的峰值内存
+# 求和的维度按固定的block大小分块，各分块的部分和按固定的顺序相加，chunk大小不影响计算结果
+comparison_chunk = {'elements': 1 << 22, 'block': 1 << 16}
+# 相对误差的对数分桶: 第0个桶为小于10**REL_HIST_MIN_EXP(包括0)，之后每个10倍区间REL_HIST_BINS_PER_DECADE个桶，
+# 最后一个桶为不小于10**REL_HIST_MAX_EXP以及inf/NaN
+REL_HIST_MIN_EXP = -10
+REL_HIST_MAX_EXP = 4
+REL_HIST_BINS_PER_DECADE = 4
+REL_HIST_BINS = (REL_HIST_MAX_EXP - REL_HIST_MIN_EXP) * REL_HIST_BINS_PER_DECADE + 2
+
+_float64_supported = {}
+_float64_warned = set()
+
+
+def comparison_dtype(device):
+    """在device上计算指标使用的精度，支持float64时使用float64"""
+    if device.type not in _float64_supported:
+        try:
+            torch.ones(2, dtype=torch.float64, device=device).sum().item()
+            _float64_supported[device.type] = True
+        except (RuntimeError, TypeError):
+            _float64_supported[device.type] = False
+    return torch.float64 if _float64_supported[device.type] else torch.float32
+
+
+def device_supports_float64(device):
+    """
+    device_compare时只在支持float64的device上计算指标，保证和host上float64的结果一致，
+    不支持时输出一次warning并拷贝到host上计算
+    """
+    if comparison_dtype(device) == torch.float64:
+        return True
+    if device.type not in _float64_warned:
+        _float64_warned.add(device.type)
+        logging.warning('device {0} does not support float64, compute acc metrics on the host.'.format(device.type))
+    return False
+
+
+def comparison_view(tensor, dim):
+    """cos的行语义: dim=1时视为(A, C, B)，在C上求和，每个(a, b)为一行；dim=0时视为(1, numel, 1)"""
+    if dim == 1:
+        return tensor.reshape(tensor.shape[0], tensor.shape[1], -1)
+    return tensor.reshape(1, -1, 1)
+
+
+def iter_chunks(shape, chunk_elements, block):
+    """
+    按comparison_view得到的(A, C, B)遍历chunk
+    一行的C不超过chunk_elements时每个chunk包含若干完整的行，否则每个chunk为一行中的若干个完整的block
+    :return: 生成(a的切片, b的切片, C的切片列表)，C的切片的起点都是block的整数倍
+    """
+    num_a, num_c, num_b = shape
+    if num_c <= chunk_elements:
+        rows, piece = max(chunk_elements // max(num_c, 1), 1), max(num_c, 1)
     else:
-        cos = torch.nn.CosineSimilarity(dim=0)
-    max_value_of_output = outputs_expected.max()
-    if max_value_of_output < 1.0:
-        scale = 1.0 / max_value_of_output
-        outputs = outputs * scale
-        outputs_expected = outputs_expected * scale
-    cosine_tensor = cos(outputs, outputs_expected)
-    cosine_similarity = cosine_tensor.min()
-    if torch.isnan(cosine_similarity):
+        rows, piece = 1, max(chunk_elements // block, 1) * block
+    rows_b = max(min(num_b, rows), 1)
+    rows_a = max(min(num_a, rows // rows_b), 1)
+    c_slices = [slice(c, min(c + piece, num_c)) for c in range(0, num_c, piece)]
+    for a in range(0, num_a, rows_a):
+        for b in range(0, num_b, rows_b):
+            yield slice(a, min(a + rows_a, num_a)), slice(b, min(b + rows_b, num_b)), c_slices
+
+
+def running(reduce_fn, current, value):
+    return value if current is None else reduce_fn(current, value)
+
+
+def block_sums(value, block):
+    """
+    value为(a, c, b)，在c上按block大小分块求和，返回(a, b, 分块数)
+    先把c转换为连续的最后一维，每个分块都按同样的方式求和，部分和只和分块内的数据有关，和一次计算多少行、多少个分块无关
+    """
+    value = value.permute(0, 2, 1).contiguous()
+    num_c = value.shape[2]
+    full = num_c // block * block
+    sums = []
+    if full:
+        sums.append(value[..., :full].reshape(value.shape[0], value.shape[1], full // block, block).sum(-1))
+    if full < num_c:
+        sums.append(value[..., full:].sum(-1, keepdim=True))
+    return torch.cat(sums, -1)
+
+
+def fused_metrics(outputs, outputs_expected, names, dtype=None, chunk_elements=None):
+    """
+    按chunk流式计算names中的各项指标，每次只把一个chunk转换为dtype，峰值内存和tensor大小无关:
+    cos: 两个tensor都至少2维时在dim=1上逐行计算余弦相似度，否则展开为一维计算，取最小值；
+         期望值的最大值小于1时乘以1/max；全为0的行视为1；结果为NaN时跳过比较
+    value: 最大绝对误差; rel: 最大相对误差; mismatch: 不满足allclose的元素个数;
+    worst: 绝对误差最大的NUM_WORST_ELEMENTS个元素，(展开后的下标, 值, 期望值);
+    rel_hist: 相对误差的对数直方图(REL_HIST_BINS个桶); ulp: 以outputs的精度在期望值处的间距为单位的最大误差
+    :param dtype: 计算和累加使用的精度，默认为comparison_dtype(outputs.device)
+    :param chunk_elements: 每个chunk的元素个数上限，默认为comparison_chunk['elements']
+    :return: dict, 指标名称 -> tensor，worst为三个一维tensor的tuple
+    """
+    device = outputs.device
+    dtype = comparison_dtype(device) if dtype is None else dtype
+    chunk_elements = chunk_elements or comparison_chunk['elements']
+    dim = 1 if outputs.ndim > 1 and outputs_expected.ndim > 1 else 0
+    outputs, outputs_expected = torch.broadcast_tensors(outputs, outputs_expected)
+    if outputs.numel() == 0:
+        zero = torch.zeros((), dtype=dtype, device=device)
+        index = torch.zeros(0, dtype=torch.long, device=device)
+        metrics = dict(cos=torch.full((), float('nan'), dtype=dtype, device=device), value=zero, rel=zero,
+                       mismatch=zero.long(), worst=(index, zero[None][:0], zero[None][:0]), ulp=zero,
+                       rel_hist=torch.zeros(REL_HIST_BINS, dtype=torch.long, device=device))
+        return {name: metrics[name] for name in names}
+
+    x, y = comparison_view(outputs, dim), comparison_view(outputs_expected, dim)
+    _, num_c, num_b = x.shape
+    block = comparison_chunk['block']
+    chunks = list(iter_chunks(x.shape, chunk_elements, block))
+    scale = None
+    if 'cos' in names:
+        # 缩放不改变相似度，只作用于eps，先求出期望值的最大值，再作用在点积和范数上
+        max_value = None
+        for a, b, c_slices in chunks:
+            for c in c_slices:
+                max_value = running(torch.maximum, max_value, y[a, c, b].max())
+        max_value = max_value.to(dtype)
+        scale = torch.where(max_value < 1.0, 1.0 / max_value, torch.ones_like(max_value))
+    eps = 1e-8
+    compute_diff = any(name in names for name in ['value', 'rel', 'mismatch', 'worst', 'rel_hist', 'ulp'])
+    # 非浮点类型的outputs间距为1
+    finfo = torch.finfo(outputs.dtype) if outputs.is_floating_point() else None
+    cos_min = cos_nonzero_min = value = rel = ulp = None
+    mismatch = torch.zeros((), dtype=torch.long, device=device)
+    rel_hist = torch.zeros(REL_HIST_BINS, dtype=torch.long, device=device)
+    worst = []
+    for a, b, c_slices in chunks:
+        dot, norm, norm_expected = [], [], []
+        for c in c_slices:
+            xs, ys = x[a, c, b].to(dtype), y[a, c, b].to(dtype)
+            if scale is not None:
+                dot.append(block_sums(xs * ys, block))
+                norm.append(block_sums(xs * xs, block))
+                norm_expected.append(block_sums(ys * ys, block))
+            if not compute_diff:
+                continue
+            diff = (xs - ys).abs()
+            abs_expected = ys.abs()
+            value = running(torch.maximum, value, diff.max())
+            if 'rel' in names or 'rel_hist' in names:
+                # 期望值为0时，误差为0的相对误差为0，否则为inf
+                inf = torch.full_like(diff, float('inf'))
+                rel_error = torch.where(abs_expected > 0, diff / abs_expected,
+                                        torch.where(diff > 0, inf, torch.zeros_like(diff)))
+                rel = running(torch.maximum, rel, rel_error.max())
+                if 'rel_hist' in names:
+                    position = (rel_error.log10() - REL_HIST_MIN_EXP) * REL_HIST_BINS_PER_DECADE + 1
+                    position = position.clamp(0, REL_HIST_BINS - 1).nan_to_num(REL_HIST_BINS - 1)
+                    rel_hist += torch.bincount(position.long().reshape(-1), minlength=REL_HIST_BINS)
+            if 'ulp' in names:
+                spacing = torch.ones_like(abs_expected)
+                if finfo is not None:
+                    # 期望值在outputs的精度下相邻两个数的间距，非规格化数的间距固定
+                    exponent = abs_expected.log2().floor().clamp(min=math.log2(finfo.tiny))
+                    spacing = finfo.eps * torch.pow(2.0, exponent)
+                ulp = running(torch.maximum, ulp, (diff / spacing).max())
+            if 'mismatch' in names:
+                tolerance = mismatch_tolerance['atol'] + mismatch_tolerance['rtol'] * abs_expected
+                # NaN也计为不一致
+                mismatch += (~(diff <= tolerance)).sum()
+            if 'worst' in names:
+                _, index = diff.reshape(-1).topk(min(NUM_WORST_ELEMENTS, diff.numel()))
+                # chunk内的下标换算为展开后的下标
+                chunk_a, chunk_c, chunk_b = diff.shape
+                index_a = index // (chunk_c * chunk_b) + a.start
+                index_c = index // chunk_b % chunk_c + c.start
+                index_b = index % chunk_b + b.start
+                worst.append(((index_a * num_c + index_c) * num_b + index_b, diff.reshape(-1)[index],
+                              xs.reshape(-1)[index], ys.reshape(-1)[index]))
+        if scale is not None:
+            # 各分块的部分和按分块的顺序相加
+            dot = torch.cat(dot, -1).sum(-1) * scale * scale
+            norm = torch.cat(norm, -1).sum(-1).sqrt() * scale.abs()
+            norm_expected = torch.cat(norm_expected, -1).sum(-1).sqrt() * scale.abs()
+            cosine_tensor = dot / (norm.clamp(min=eps) * norm_expected.clamp(min=eps))
+            cos_min = running(torch.minimum, cos_min, cosine_tensor.min())
+            # outputs中存在一行完全为0，用1替换之后再取最小值
+            cos_nonzero_min = running(torch.minimum, cos_nonzero_min, torch.where(
+                cosine_tensor == 0, torch.ones_like(cosine_tensor), cosine_tensor).min())
+
+    metrics = {'value': value, 'rel': rel, 'mismatch': mismatch, 'ulp': ulp, 'rel_hist': rel_hist}
+    if scale is not None:
+        metrics['cos'] = torch.where(cos_min == 0, cos_nonzero_min, cos_min)
+    if 'worst' in names:
+        index, diff, worst_outputs, worst_expected = [torch.cat(each) for each in zip(*worst)]
+        _, selected = diff.topk(min(NUM_WORST_ELEMENTS, diff.numel()))
+        metrics['worst'] = (index[selected], worst_outputs[selected], worst_expected[selected])
+    return {name: metrics[name] for name in names}
+
+
+def check_cos(cosine_similarity, cos_threshold, module_name):
+    if math.isnan(cosine_similarity):
         return
-    if cosine_similarity == 0:
-        # outputs中存在一行完全为0，用1替换之后再进行相似度计算
-        cosine_similarity = torch.where(cosine_tensor == 0, torch.ones_like(cosine_tensor), cosine_tensor).min()
     logging.info('===>module_name={0}, cosine_similarity={1}, cos_threshold={2}'.
                  format(module_name, cosine_similarity, cos_threshold))
     assert cosine_similarity >= cos_threshold, \
         "cosine_similarity={0}, cos_threshold={1}".format(cosine_similarity, cos_threshold)
 
 
-def value_comparison(outputs, outputs_expected, value_threshold, module_name):
-    assert isinstance(outputs, torch.Tensor)
-    assert isinstance(outputs_expected, torch.Tensor)
-    value_similarity = (outputs - outputs_expected).to(torch.float).abs().max()
+def check_value(value_similarity, value_threshold, module_name):
     logging.info(
         '=====>module_name={0}, value_similarity={1}, value_threshold={2}'.
         format(module_name, value_similarity, value_threshold))
@@ -53,6 +235,29 @@ def value_comparison(outputs, outputs_expected, value_threshold, module_name):
         "value_similarity={0}, value_threshold={1}".format(value_similarity, value_threshold)
 
 
+def cos_comparison(outputs, outputs_expected, cos_threshold, module_name):
+    assert isinstance(outputs, torch.Tensor)
+    assert isinstance(outputs_expected, torch.Tensor)
+    check_cos(fused_metrics(outputs, outputs_expected, ['cos'])['cos'].item(), cos_threshold, module_name)
+
+
+def value_comparison(outputs, outputs_expected, value_threshold, module_name):
+    assert isinstance(outputs, torch.Tensor)
+    assert isinstance(outputs_expected, torch.Tensor)
+    check_value(fused_metrics(outputs, outputs_expected, ['value'])['value'].item(), value_threshold, module_name)
+
+
+def format_worst(metrics):
+    return ', '.join('[{0}] {1} vs {2}'.format(index, value, expected) for index, value, expected in metrics['worst'])
+
+
+# 注册为这些函数的compare function在compare_batch中合并计算，指标名称和检查阈值的函数
+FUSED_COMPARISON = {
+    cos_comparison: ('cos', check_cos),
+    value_comparison: ('value', check_value),
+}
+
+
 class ComparisonHook(object):
 
     def __init__(self):
@@ -104,32 +309,226 @@ class ComparisonHook(object):
         comparison_hook.register_comparison_hook('cos', cos_comparison, self.default_threshold['cos'])
         comparison_hook.register_comparison_hook('value', value_comparison, self.default_threshold['value'])
 
-    def compare(self, outputs, outputs_expected, module_name):
-        for name, each_compare in self.comparison_fn_map.items():
-            threshold = self.threshold[name]
-            if module_name is not None and name + '_' + module_name in self.threshold_module.keys():
-                threshold = self.threshold_module[name + '_' + module_name]
-            if outputs is None and outputs_expected is None:
-                logging.warning('when compare {0}-{1} , outputs is None.'.format(module_name, name))
-                continue
-            each_compare(outputs, outputs_expected, threshold, module_name)
-        logging.info(" ")
+    def get_threshold(self, name, module_name):
+        if module_name is not None and name + '_' + module_name in self.threshold_module.keys():
+            return self.threshold_module[name + '_' + module_name]
+        return self.threshold[name]
+
+    def compare_batch(self, pairs):
+        """
+        比较accuracy_comparison展开后的所有tensor
+        cos_comparison/value_comparison对应的指标以及相对误差、不一致元素个数和误差最大的元素在每对tensor上一次计算，
+        全部计算完成后一次拷贝到host，再按阈值检查；其他注册的compare function仍然逐个tensor调用
+        acc_config['device_compare']为True时期望值拷贝到被测tensor所在的device上计算，只有标量和少量元素拷贝回host，
+        device不支持float64时仍在host上计算
+        acc_config['collect_all']为True时额外计算相对误差的直方图和ULP误差，所有检查的结果记录到accuracy report中，不抛出异常
+        :param pairs: list of (module_name, tensor的路径, tensor, 期望tensor)
+        """
+        from utils.base_utils import acc_config
+        collect_all = acc_config['collect_all']
+        fused_names = {name: FUSED_COMPARISON[fn][0] for name, fn in self.comparison_fn_map.items()
+                       if fn in FUSED_COMPARISON}
+        metrics = [None] * len(pairs)
+        if (fused_names or collect_all) and pairs:
+            float_names = set(fused_names.values()) | {'value', 'rel'}
+            float_names = sorted(float_names | {'cos', 'ulp'} if collect_all else float_names)
+            hist_bins = REL_HIST_BINS if collect_all else 0
+            names = float_names + ['mismatch', 'worst'] + (['rel_hist'] if collect_all else [])
+            # 按device分组，每个device上的结果拼接后一次拷贝
+            packed = {}
+            for i, (_, _, outputs, outputs_expected) in enumerate(pairs):
+                if acc_config['device_compare'] and device_supports_float64(outputs.device):
+                    outputs_expected = outputs_expected.to(outputs.device)
+                else:
+                    outputs, outputs_expected = outputs.cpu(), outputs_expected.cpu()
+                each_metrics = fused_metrics(outputs, outputs_expected, names)
+                index, worst, worst_expected = each_metrics['worst']
+                float_part = torch.cat([torch.stack([each_metrics[name] for name in float_names]),
+                                        worst, worst_expected])
+                int_part = torch.cat([each_metrics['mismatch'].reshape(1),
+                                      each_metrics['rel_hist'] if collect_all else index[:0], index])
+                packed.setdefault(outputs.device, []).append((i, float_part, int_part, len(index)))
+
+            for device, parts in packed.items():
+                float_values = torch.cat([part[1] for part in parts]).cpu().double().tolist()
+                int_values = torch.cat([part[2] for part in parts]).cpu().tolist()
+                float_offset = int_offset = 0
+                for i, _, _, k in parts:
+                    each_metrics = dict(zip(float_names, float_values[float_offset:float_offset + len(float_names)]))
+                    float_offset += len(float_names)
+                    worst = float_values[float_offset:float_offset + k]
+                    worst_expected = float_values[float_offset + k:float_offset + 2 * k]
+                    float_offset += 2 * k
+                    each_metrics['mismatch'] = int_values[int_offset]
+                    each_metrics['rel_hist'] = int_values[int_offset + 1:int_offset + 1 + hist_bins]
+                    int_offset += 1 + hist_bins
+                    each_metrics['worst'] = list(zip(int_values[int_offset:int_offset + k], worst, worst_expected))
+                    int_offset += k
+                    metrics[i] = each_metrics
+
+        if collect_all:
+            self.collect_batch(pairs, metrics, fused_names)
+            return
+        for i, (module_name, _, outputs, outputs_expected) in enumerate(pairs):
+            for name, each_compare in self.comparison_fn_map.items():
+                threshold = self.get_threshold(name, module_name)
+                if name in fused_names:
+                    logging.debug('module_name={0}, rel={1}, mismatch={2}/{3}, worst elements: {4}'.format(
+                        module_name, metrics[i]['rel'], metrics[i]['mismatch'], outputs.numel(),
+                        format_worst(metrics[i])))
+                    try:
+                        FUSED_COMPARISON[each_compare][1](metrics[i][fused_names[name]], threshold, module_name)
+                    except AssertionError as e:
+                        raise AssertionError('{0}, rel={1}, mismatch={2}/{3}, worst elements: {4}'.format(
+                            e, metrics[i]['rel'], metrics[i]['mismatch'], outputs.numel(),
+                            format_worst(metrics[i]))) from None
+                else:
+                    each_compare(outputs.cpu(), outputs_expected.cpu(), threshold, module_name)
+            logging.info(" ")
+
+    def collect_batch(self, pairs, metrics, fused_names):
+        """collect_all模式下执行所有compare function，不满足阈值时只记录错误信息，结果写入accuracy report"""
+        from utils.acc_report import get_acc_report
+        report = get_acc_report()
+        for (module_name, path, outputs, outputs_expected), each_metrics in zip(pairs, metrics):
+            checks = {}
+            for name, each_compare in self.comparison_fn_map.items():
+                check = {'threshold': self.get_threshold(name, module_name), 'passed': True}
+                try:
+                    if name in fused_names:
+                        check['metric'] = each_metrics[fused_names[name]]
+                        FUSED_COMPARISON[each_compare][1](check['metric'], check['threshold'], module_name)
+                    else:
+                        each_compare(outputs.cpu(), outputs_expected.cpu(), check['threshold'], module_name)
+                except AssertionError as e:
+                    check.update(passed=False, error=str(e))
+                checks[name] = check
+            report.add(module_name, path, outputs, each_metrics, checks)
 
 
 comparison_hook = ComparisonHook()
 comparison_hook.reset_default_hook()
 
 
-def accuracy_comparison(outputs, outputs_expected, module_name=None):
+def flatten_pairs(outputs, outputs_expected, module_name=None, path=''):
+    """
+    按accuracy_comparison的规则展开嵌套的tensor/list/tuple
+    :param path: outputs的路径，展开后的tensor的路径为path加上各层的下标，例如forward.outputs[0][1]
+    :return: list of (module_name, tensor的路径, tensor, 期望tensor)
+    """
     assert type(outputs) == type(outputs_expected)
     if outputs is None and outputs_expected is None:
-        return
+        return []
     if isinstance(outputs, torch.Tensor):
-        comparison_hook.compare(outputs.cpu(), outputs_expected.cpu(), module_name)
+        return [(module_name, path, outputs, outputs_expected)]
     elif isinstance(outputs, list) or isinstance(outputs, tuple):
         assert len(outputs) == len(outputs_expected)
-        for each_output, each_output_expected in zip(outputs, outputs_expected):
-            accuracy_comparison(each_output, each_output_expected, module_name)
+        pairs = []
+        for i, (each_output, each_output_expected) in enumerate(zip(outputs, outputs_expected)):
+            pairs.extend(flatten_pairs(each_output, each_output_expected, module_name, '{0}[{1}]'.format(path, i)))
+        return pairs
     else:
         raise NotImplementedError(
             'Only supports Tensor/tuple and list of Tensor, type of outputs is {0}'.format(type(outputs)))
+
+
+def batch_comparison(items):
+    """
+    一次比较多组输出，例如前向输出和所有参数梯度
+    :param items: list of (outputs, outputs_expected, module_name)或(outputs, outputs_expected, module_name, 路径)，
+        路径用于accuracy report中区分同一个module的不同tensor，例如'forward.outputs'、'grads.conv.weight'
+    """
+    pairs = []
+    for outputs, outputs_expected, module_name, *path in items:
+        pairs.extend(flatten_pairs(outputs, outputs_expected, module_name, *path))
+    comparison_hook.compare_batch(pairs)
+
+
+def accuracy_comparison(outputs, outputs_expected, module_name=None, path=''):
+    batch_comparison([(outputs, outputs_expected, module_name, path)])
+
+
+# 比较两个统计信息dump(summarize_tensor)的阈值
+# stat: min/max/mean/std/l2的误差相对于期望值绝对值最大值的比例; sample_cos/sample_value: 采样元素的余弦相似度和最大误差
+# hist: 归一化直方图的total variation距离
+summary_threshold = {'stat': 0.01, 'sample_cos': 0.999, 'sample_value': 0.01, 'hist': 0.05}
+
+
+def is_tensor_summary(value):
+    return isinstance(value, Mapping) and value.get('type') == 'tensor_summary'
+
+
+def tensor_summary_comparison(summary, summary_expected, threshold, module_name):
+    """
+    比较两个tensor的统计信息，shape和NaN/Inf个数需要相同，统计量、采样元素和直方图的误差不超过阈值
+    :return: 各项误差
+    """
+    assert summary['shape'] == summary_expected['shape'], \
+        "shape={0}, expected shape={1}".format(summary['shape'], summary_expected['shape'])
+    if summary['numel'] == 0:
+        return {}
+    assert summary['nan'] == summary_expected['nan'] and summary['inf'] == summary_expected['inf'], \
+        "nan/inf={0}/{1}, expected nan/inf={2}/{3}".format(summary['nan'], summary['inf'], summary_expected['nan'],
+                                                           summary_expected['inf'])
+    scale = max(abs(summary_expected['min']), abs(summary_expected['max']), torch.finfo(torch.float32).tiny)
+    errors = {k: abs(summary[k] - summary_expected[k]) / scale for k in ['min', 'max', 'mean', 'std']}
+    errors['l2'] = abs(summary['l2'] - summary_expected['l2']) / max(summary_expected['l2'],
+                                                                     torch.finfo(torch.float32).tiny)
+    sample, sample_expected = summary['sample'].float(), summary_expected['sample'].float()
+    finite = torch.isfinite(sample) & torch.isfinite(sample_expected)
+    sample, sample_expected = sample[finite], sample_expected[finite]
+    sample_cos = 1.0
+    sample_value = 0.0
+    if sample.numel() > 0:
+        sample_value = (sample - sample_expected).abs().max().item()
+        if sample.norm() > 0 and sample_expected.norm() > 0:
+            sample_cos = torch.nn.functional.cosine_similarity(sample, sample_expected, dim=0).item()
+    hist, hist_expected = summary['hist'].float(), summary_expected['hist'].float()
+    hist_distance = 0.0
+    if hist.sum() > 0 and hist_expected.sum() > 0:
+        hist_distance = (hist / hist.sum() - hist_expected / hist_expected.sum()).abs().sum().item() / 2
+
+    logging.info('===>module_name={0}, stat_error={1}, sample_cos={2}, sample_value={3}, hist_distance={4}'.format(
+        module_name, errors, sample_cos, sample_value, hist_distance))
+    stat_error = max(errors.values())
+    assert stat_error <= threshold['stat'], "stat_error={0}, threshold={1}".format(errors, threshold['stat'])
+    assert sample_cos >= threshold['sample_cos'], \
+        "sample_cos={0}, threshold={1}".format(sample_cos, threshold['sample_cos'])
+    assert sample_value <= threshold['sample_value'], \
+        "sample_value={0}, threshold={1}".format(sample_value, threshold['sample_value'])
+    assert hist_distance <= threshold['hist'], "hist_distance={0}, threshold={1}".format(hist_distance,
+                                                                                         threshold['hist'])
+    return dict(errors, sample_cos=sample_cos, sample_value=sample_value, hist=hist_distance)
+
+
+def summary_comparison(outputs, outputs_expected, module_name=None, threshold=None):
+    """比较summarize得到的嵌套结构，例如NPU和CPU、两次训练之间的统计信息dump"""
+    threshold = dict(summary_threshold, **(threshold or {}))
+    if outputs is None and outputs_expected is None:
+        return
+    if is_tensor_summary(outputs):
+        assert is_tensor_summary(outputs_expected)
+        tensor_summary_comparison(outputs, outputs_expected, threshold, module_name)
+    elif isinstance(outputs, (list, tuple)):
+        assert len(outputs) == len(outputs_expected)
+        for each_output, each_output_expected in zip(outputs, outputs_expected):
+            summary_comparison(each_output, each_output_expected, module_name, threshold)
+    elif isinstance(outputs, Mapping):
+        assert set(outputs.keys()) == set(outputs_expected.keys())
+        for k in outputs:
+            summary_comparison(outputs[k], outputs_expected[k], module_name if module_name is None else
+                               '{0}.{1}'.format(module_name, k), threshold)
+    else:
+        raise NotImplementedError(
+            'Only supports tensor summary/tuple/list/dict of tensor summary, type of outputs is {0}'.format(
+                type(outputs)))
+
+
+def summary_dump_comparison(dump, dump_expected, threshold=None):
+    """比较两个统计信息dump的前向输入输出、反向输入输出和参数梯度"""
+    for mode in ['forward', 'backward']:
+        for k in ['inputs', 'outputs']:
+            if dump[mode][k] or dump_expected[mode][k]:
+                summary_comparison(dump[mode][k], dump_expected[mode][k],
+                                   '{0}.{1}.{2}'.format(dump['name'], mode, k), threshold)
+    summary_comparison(dump['grads'], dump_expected['grads'], '{0}.grads'.format(dump['name']), threshold)
@@ -13,12 +13,45 @@
 # limitations under the License.
 
 import torch
-import time
 import copy
+import glob
+import json
+import os
+import time
 from enum import IntEnum
 import logging
 
 device_info = 'UNKNOWN'
+prof_config = {
+    'warmup': 3,
+    'iters': 20,
+    'window': 20,
+    'z_threshold': 3.0,
+    'breakdown': False,
+    'profiler': False,
+    'profiler_iters': 5,
+    'memory_threshold': 0.1,
+    'disable_gc': True,
+    'cpu_affinity': None,
+    'intra_threads': None,
+    'interop_threads': None,
+    'load_threshold': None,
+    'load_wait': 300,
+}
+acc_config = {
+    'golden_cache': False,
+    'golden_cache_dir': './data/cpu_golden_cache',
+    'golden_cache_size': 10,
+    'dump_cache_size': 4,
+    'dump_cache_dir': './data/dump_cache',
+    'device_compare': False,
+    'collect_all': False,
+    'acc_report_dir': './data/acc_report',
+    'acc_report_format': 'json',
+    'locate_divergence': False,
+    'offload_buffer_size': 2,
+    'offload_capture': False,
+}
 
 
 def set_device_info(device_info_input):
@@ -26,6 +59,28 @@ def set_device_info(device_info_input):
     device_info = device_info_input
 
 
+def replay_checks_acc(dump):
+    """
+    回放时只有权重已知的iteration才能比较精度: 保存了state_dict，或为iteration 0(权重和安装hook时保存的config相同)
+    start > 0或every_k > 1时第一个被采样的iteration之前已经执行过优化器更新，权重已经变化
+    """
+    return 'state_dict' in dump or dump.get('iteration') == 0
+
+
+def set_prof_config(**kwargs):
+    for k, v in kwargs.items():
+        if k not in prof_config:
+            raise KeyError('[set_prof_config] unknown prof config {0}. '.format(k))
+        prof_config[k] = v
+
+
+def set_acc_config(**kwargs):
+    for k, v in kwargs.items():
+        if k not in acc_config:
+            raise KeyError('[set_acc_config] unknown acc config {0}. '.format(k))
+        acc_config[k] = v
+
+
 class BaseUtil:
     def __init__(self):
         self._device = 'NPU'
@@ -34,6 +89,11 @@ class BaseUtil:
         self.cpu_output_list = []
         self.npu_grad_list = []
         self.cpu_grad_list = []
+        self.capture_stats = self.new_capture_stats()
+
+    @staticmethod
+    def new_capture_stats():
+        return {'tensors': 0, 'bytes': 0, 'hook_time(s)': 0.0, 'sync_time(s)': 0.0}
 
     def set_device(self, device):
         self._device = device
@@ -43,9 +103,56 @@ class BaseUtil:
         self.cpu_output_list.clear()
         self.npu_grad_list.clear()
         self.cpu_grad_list.clear()
+        self.capture_stats = self.new_capture_stats()
+
+    def offload_value(self, value):
+        """detach并把device上的tensor异步拷贝到pinned host内存，返回的tensor在finish_capture之后才能读取"""
+        if isinstance(value, torch.Tensor):
+            self.capture_stats['tensors'] += 1
+            self.capture_stats['bytes'] += value.numel() * value.element_size()
+            value = value.detach()
+            if value.device.type == 'cpu':
+                return value
+            try:
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            except RuntimeError:
+                return value.cpu()
+            host.copy_(value, non_blocking=True)
+            return host
+        elif isinstance(value, list):
+            return [self.offload_value(each_value) for each_value in value]
+        elif isinstance(value, tuple):
+            return tuple(self.offload_value(each_value) for each_value in value)
+        return value
+
+    def capture_value(self, value):
+        """
+        hook中保存输出和梯度，acc_config['offload_capture']为True时立即detach并拷贝到host，
+        不再持有计算图和device内存，比较之前需要调用finish_capture
+        """
+        if not acc_config['offload_capture']:
+            return value
+        time_start = time.perf_counter()
+        value = self.offload_value(value)
+        self.capture_stats['hook_time(s)'] += time.perf_counter() - time_start
+        return value
+
+    def finish_capture(self, module_name):
+        """等待异步拷贝完成，输出本用例保存输出和梯度的开销"""
+        if not acc_config['offload_capture']:
+            return
+        from utils.prof_utils import synchronize
+        time_start = time.perf_counter()
+        synchronize()
+        self.capture_stats['sync_time(s)'] += time.perf_counter() - time_start
+        logging.info('module {0} capture overhead: tensors={1}, bytes={2}, hook_time={3:.6f}s, '
+                     'sync_time={4:.6f}s'.format(module_name, self.capture_stats['tensors'],
+                                                 self.capture_stats['bytes'], self.capture_stats['hook_time(s)'],
+                                                 self.capture_stats['sync_time(s)']))
 
     def base_hook_forward_fn(self, module, input, output):
         logging.debug('forward,use {0}: module={1}'.format(self._device, module))
+        output = self.capture_value(output)
         if self._device == 'npu':
             self.npu_output_list.append(output)
         elif self._device == 'cpu':
@@ -55,6 +162,7 @@ class BaseUtil:
 
     def base_hook_backward_fn(self, module, grad_in, grad_out):
         logging.debug('backward,use {0}: module={1}'.format(self._device, module))
+        grad_in = self.capture_value(grad_in)
         if self._device == 'npu':
             self.npu_grad_list.append(grad_in)
         elif self._device == 'cpu':
@@ -117,8 +225,26 @@ class BaseUtil:
             self.do_auto_backward(output)
         return output
 
+    def run_cpu_golden(self, cpu_module, module_name, kind, input, run_fn):
+        """
+        执行run_fn得到CPU标杆结果，开启golden_cache时优先从缓存中读取
+        :param kind: 标杆结果的类型，不同类型的结果分开缓存
+        """
+        if not acc_config['golden_cache']:
+            return run_fn()
+        from utils.golden_cache import get_golden_cache
+        cache = get_golden_cache(acc_config['golden_cache_dir'], int(acc_config['golden_cache_size'] * 1024 ** 3))
+        key = cache.make_key(cpu_module, kind, *input)
+        golden = cache.get(key)
+        if golden is not None:
+            logging.info('module {0} hit cpu golden cache {1}. '.format(module_name, key))
+            return golden
+        golden = run_fn()
+        cache.put(key, golden)
+        return golden
+
     def run_and_compare_with_cpu_acc(self, module, module_name, *input):
-        from utils.acc_utils import accuracy_comparison
+        from utils.acc_utils import batch_comparison
         cpu_module = module
         npu_module = copy.deepcopy(module).to('npu')
 
@@ -127,34 +253,137 @@ class BaseUtil:
         npu_module.register_forward_hook(self.base_hook_forward_fn)
         npu_module.register_backward_hook(self.base_hook_backward_fn)
 
-        self.set_device('cpu')
-        logging.info('module {0} start executing on the cpu. '.format(module_name))
-        self.run_step(cpu_module, True, *input)
+        def run_cpu():
+            self.set_device('cpu')
+            logging.info('module {0} start executing on the cpu. '.format(module_name))
+            self.run_step(cpu_module, True, *input)
+            return {'outputs': list(self.cpu_output_list), 'grads': list(self.cpu_grad_list)}
+
+        locator = None
+        if acc_config['locate_divergence']:
+            from utils.divergence import DivergenceLocator
+            locator = DivergenceLocator(cpu_module, npu_module, module_name,
+                                        int(acc_config['offload_buffer_size'] * 1024 ** 3))
+        try:
+            # 定位子module时需要CPU上的中间结果，不使用CPU标杆缓存
+            golden = self.run_cpu_golden(cpu_module, module_name, 'acc', input, run_cpu) if locator is None \
+                else run_cpu()
+            self.cpu_output_list[:] = golden['outputs']
+            self.cpu_grad_list[:] = golden['grads']
+
+            self.set_device('npu')
+            logging.info('module {0} start executing on the npu. '.format(module_name))
+            self.run_step(npu_module, True, *input)
+
+            self.finish_capture(module_name)
+            logging.info('start compare forward and backward, module_name={0}'.format(module_name))
+            divergence = locator.report() if locator is not None else None
+            try:
+                batch_comparison([(self.npu_output_list, self.cpu_output_list, module_name, 'forward.outputs'),
+                                  (self.npu_grad_list, self.cpu_grad_list, module_name, 'backward.grad_inputs')])
+            except AssertionError as e:
+                if divergence is None:
+                    raise
+                raise AssertionError('{0}\n{1}'.format(e, divergence)) from None
+        finally:
+            if locator is not None:
+                locator.close()
+
+    def run_and_compare_prof(self, module, prof_path, time_threshold, *input, warmup=None, iters=None,
+                             breakdown=None, profiler=None, memory_threshold=None):
+        from utils.prof_utils import save_time, compare_with_baseline, assert_no_regression, time_steps, \
+            summarize_time, profile_steps, artifact_dir_from_path, measure_memory, wait_for_idle, get_run_settings
+        warmup = prof_config['warmup'] if warmup is None else warmup
+        iters = prof_config['iters'] if iters is None else iters
+        breakdown = prof_config['breakdown'] if breakdown is None else breakdown
+        profiler = prof_config['profiler'] if profiler is None else profiler
+        memory_threshold = prof_config['memory_threshold'] if memory_threshold is None else memory_threshold
+        npu_module = copy.deepcopy(module).to('npu')
 
         self.set_device('npu')
-        logging.info('module {0} start executing on the npu. '.format(module_name))
-        self.run_step(npu_module, True, *input)
-
-        logging.info('start compare forward, module_name={0}'.format(module_name))
-        accuracy_comparison(self.npu_output_list, self.cpu_output_list, module_name)
-
-        logging.info('start compare backward, module_name={0}'.format(module_name))
-        accuracy_comparison(self.npu_grad_list, self.cpu_grad_list, module_name)
-
-    def run_and_compare_prof(self, module, prof_path, time_threshold, *input):
-        from utils.prof_utils import save_time, compare_with_mean_time
+        # 输入提前拷贝到device上，计时只包含module的前向和反向
+        input = self.set_value_to_device(input)
+        if prof_config['load_threshold'] is not None:
+            wait_for_idle(prof_config['load_threshold'], timeout=prof_config['load_wait'])
+        run_settings = get_run_settings()
+        time_list = time_steps(lambda: self.run_step(npu_module, True, *input), warmup=warmup, iters=iters,
+                               disable_gc=prof_config['disable_gc'])
+        time_stats = summarize_time(time_list)
+        run_settings['disable_gc'] = prof_config['disable_gc']
+        time_stats['run_settings'] = json.dumps(run_settings)
+        time_stats.update(measure_memory(lambda: self.run_step(npu_module, True, *input)))
+        logging.info('====> prof {0}: {1}'.format(prof_path, time_stats))
+
+        if breakdown:
+            # 计时hook会带来额外开销，在计时结束后单独执行
+            time_stats['breakdown'] = self.run_prof_breakdown(npu_module, prof_path, iters, *input)
+        if profiler:
+            time_stats['artifact_dir'] = profile_steps(lambda: self.run_step(npu_module, True, *input),
+                                                       artifact_dir_from_path(prof_path),
+                                                       iters=prof_config['profiler_iters'])
+            logging.info('====> profiler artifacts of {0} saved to {1}'.format(prof_path, time_stats['artifact_dir']))
+
+        # 先和历史基线比较再保存，避免当前样本进入自己的基线
+        verdict = compare_with_baseline(time_list, prof_path, time_threshold=time_threshold,
+                                        window=prof_config['window'], z_threshold=prof_config['z_threshold'])
+        memory_verdict = compare_with_baseline(time_stats['peak_allocated_bytes'], prof_path,
+                                               time_threshold=memory_threshold, window=prof_config['window'],
+                                               z_threshold=prof_config['z_threshold'], column='peak_allocated_bytes')
+        save_time(time_stats, prof_path)
+        assert_no_regression(verdict, time_threshold)
+        assert_no_regression(memory_verdict, memory_threshold, column='peak_allocated_bytes')
+
+    def run_prof_sweep(self, module, prof_path, make_input, batch_sizes, sizes, warmup=None, iters=None,
+                       super_linear_tolerance=0.15):
+        """
+        在batch_sizes x sizes的网格上测试module的耗时，拟合耗时随batch和分辨率的增长指数
+        :param make_input: make_input(batch, size)返回module的位置参数tuple
+        :return: 每个网格点的耗时列表以及fit_scaling的结果
+        """
+        from utils.prof_utils import save_time, time_steps, summarize_time, fit_scaling, format_scaling_table, \
+            get_run_settings
+        warmup = prof_config['warmup'] if warmup is None else warmup
+        iters = prof_config['iters'] if iters is None else iters
         npu_module = copy.deepcopy(module).to('npu')
 
-        time_start = time.time()
         self.set_device('npu')
-        self.run_step(npu_module, True, *input)
-        time_one_step = time.time() - time_start
-
-        save_time(time_one_step, prof_path)
-        compare_with_mean_time(time_one_step, prof_path, time_threshold=time_threshold)
+        rows = []
+        for batch in batch_sizes:
+            for size in sizes:
+                input = self.set_value_to_device(make_input(batch, size))
+                time_list = time_steps(lambda: self.run_step(npu_module, True, *input), warmup=warmup, iters=iters,
+                                       disable_gc=prof_config['disable_gc'])
+                row = {'batch': batch, 'size': size}
+                row.update(summarize_time(time_list))
+                rows.append(row)
+        scaling = fit_scaling(rows, super_linear_tolerance)
+        logging.info('====> sweep {0}: batch_exponent={1}, size_exponent={2}\n{3}'.format(
+            prof_path, scaling['batch_exponent'], scaling['size_exponent'], format_scaling_table(rows)))
+        if scaling['super_linear']:
+            logging.warning('sweep {0} scales super-linearly, tolerance={1}'.format(prof_path, super_linear_tolerance))
+
+        record = {k: v for k, v in scaling.items() if v is not None}
+        record['scaling_table'] = json.dumps(rows)
+        record['run_settings'] = json.dumps(get_run_settings())
+        save_time(record, os.path.splitext(prof_path)[0] + '_sweep.csv')
+        return rows, scaling
+
+    def run_prof_breakdown(self, npu_module, prof_path, iters, *input):
+        from utils.breakdown_hook import profile_breakdown, format_breakdown, diff_breakdown
+        from utils.prof_utils import load_last_breakdown
+        rows = profile_breakdown(npu_module, lambda: self.run_step(npu_module, True, *input), iters=iters)
+        logging.info('====> breakdown {0}:\n{1}'.format(prof_path, format_breakdown(rows)))
+
+        last_rows = load_last_breakdown(prof_path)
+        if last_rows:
+            diff_rows = diff_breakdown(rows, last_rows)[:10]
+            logging.info('====> breakdown diff with last run {0}:\n{1}'.format(
+                prof_path, '\n'.join('{0}: forward_self {1:+.4f}ms, backward_self {2:+.4f}ms'.format(
+                    r['name'], r['forward_self_delta'] * 1e3, r['backward_self_delta'] * 1e3) for r in diff_rows)))
+        return json.dumps(rows)
 
     def run_and_compare_with_cpu_parameters(self, module, module_name=None, *input):
-        from utils.acc_utils import accuracy_comparison
+        from utils.acc_utils import batch_comparison
 
         cpu_module = module
         npu_module = copy.deepcopy(module).to('npu')
@@ -164,28 +393,142 @@ class BaseUtil:
         npu_module.register_forward_hook(self.base_hook_forward_fn)
         npu_module.register_backward_hook(self.base_hook_backward_fn)
 
-        self.set_device('cpu')
-        logging.info('compare_parameters, module {0} start executing on the cpu. '.format(module_name))
-        self.run_step(cpu_module, True, *input)
+        def run_cpu():
+            self.set_device('cpu')
+            logging.info('compare_parameters, module {0} start executing on the cpu. '.format(module_name))
+            self.run_step(cpu_module, True, *input)
+            return {'params': {name: p.detach() for name, p in cpu_module.named_parameters()},
+                    'grads': {name: p.grad for name, p in cpu_module.named_parameters()}}
+
+        golden = self.run_cpu_golden(cpu_module, module_name, 'parameters', input, run_cpu)
 
         self.set_device('npu')
         logging.info('compare_parameters, module {0} start executing on the npu. '.format(module_name))
         self.run_step(npu_module, True, *input)
+        self.finish_capture(module_name)
 
-        for (npu_para_name, npu_para), (cpu_para_name, cpu_para) in \
-                zip(npu_module.named_parameters(), cpu_module.named_parameters()):
+        items = []
+        for (npu_para_name, npu_para), cpu_para_name in zip(npu_module.named_parameters(), golden['params']):
             logging.debug('compare_parameters, para_name={} '.format(npu_para_name))
             assert npu_para_name == cpu_para_name
-            accuracy_comparison(npu_para, cpu_para, module_name)
-            accuracy_comparison(npu_para.grad, cpu_para.grad, module_name)
+            items.append((npu_para.detach(), golden['params'][cpu_para_name], module_name,
+                          'params.' + npu_para_name))
+            items.append((npu_para.grad, golden['grads'][cpu_para_name], module_name, 'grads.' + npu_para_name))
+        batch_comparison(items)
 
     def set_params_from_config(self, module, input):
+        model_dict = input['config']['model_dict']
+        if 'hparams' in model_dict:
+            return self.set_params_from_capture(module, input['config'])
+        if hasattr(model_dict, 'to_dict'):
+            # load_dump按需读取的dump，需要转换为module可以修改的dict
+            model_dict = model_dict.to_dict()
         for k in module.__dict__:
-            if k in input['config']['model_dict']:
-                module.__dict__[k] = input['config']['model_dict'][k]
+            if k in model_dict:
+                module.__dict__[k] = model_dict[k]
         module.__dict__["_is_full_backward_hook"] = True
         return module
 
+    def set_params_from_capture(self, module, config):
+        """
+        按capture_module_config保存的超参数和state_dict恢复module，子module和参数保持不变，权重拷贝到原有的参数中
+        """
+        all_hparams = config['model_dict']['hparams']
+        if hasattr(all_hparams, 'to_dict'):
+            all_hparams = all_hparams.to_dict()
+        modules = dict(module.named_modules())
+        for name, hparams in all_hparams.items():
+            if name in modules:
+                modules[name].__dict__.update(hparams)
+            else:
+                logging.warning('[set_params_from_capture] submodule {0} not found, skip it. '.format(name))
+        state_dict = config['state_dict']
+        if state_dict:
+            result = module.load_state_dict(dict(state_dict), strict=False)
+            if result.missing_keys or result.unexpected_keys:
+                logging.warning('[set_params_from_capture] missing keys: {0}, unexpected keys: {1}. '.format(
+                    result.missing_keys, result.unexpected_keys))
+        return module
+
+    def run_real_data_replay(self, module, module_name, dump_dir, prof_path=None, time_threshold=0.1, warmup=None):
+        """
+        回放stream_dump_hook保存的多个iteration的real data，dump_dir为其中一个module的目录(config.tstore和iter_*.tstore)
+        每个iteration用记录的输入执行前向、用记录的输出梯度执行反向并计时，iteration中保存了state_dict时先加载权重，
+        再和记录的前向输出、参数梯度比较精度；没有保存state_dict的iteration(iteration 0除外)权重未知，只计时
+        :param prof_path: 不为None时耗时和吞吐量保存到性能历史记录中，并和历史基线比较
+        :return: 每个iteration的耗时和精度结果
+        """
+        from utils.acc_utils import batch_comparison
+        from utils.breakdown_hook import iter_tensors
+        from utils.prof_utils import synchronize, save_time, summarize_time, compare_with_baseline, \
+            assert_no_regression
+        from utils.tensor_store import load_dump
+        warmup = prof_config['warmup'] if warmup is None else warmup
+        iter_paths = sorted(glob.glob(os.path.join(dump_dir, 'iter_*.tstore')))
+        assert iter_paths, 'no iteration dump in {0}'.format(dump_dir)
+        module = self.set_params_from_config(module, load_dump(os.path.join(dump_dir, 'config.tstore')))
+        npu_module = copy.deepcopy(module).to('npu')
+        self.set_device('npu')
+
+        rows = []
+        failed = []
+        for index, iter_path in enumerate(iter_paths):
+            dump = load_dump(iter_path)
+            assert not dump.get('summary'), '{0} only contains statistics and can not be replayed'.format(iter_path)
+            check_acc = replay_checks_acc(dump)
+            if 'state_dict' in dump:
+                npu_module.load_state_dict(dict(dump['state_dict']))
+            # 输入和输出梯度提前拷贝到device上，计时只包含module的前向和反向
+            input = self.set_value_to_device(dump['forward']['inputs'])
+            backward_output = dump['backward']['outputs']
+            backward_output = self.set_value_to_device(backward_output) if backward_output else None
+
+            def step():
+                npu_module.zero_grad(set_to_none=True)
+                step_output = npu_module(*input)
+                if backward_output is not None:
+                    self.do_real_data_backward(step_output, backward_output)
+                return step_output
+
+            for _ in range(warmup if index == 0 else 0):
+                step()
+            synchronize()
+            time_start = time.perf_counter()
+            output = step()
+            synchronize()
+            row = {'iteration': dump.get('iteration', index), 'time(s)': time.perf_counter() - time_start,
+                   'batch': next((t.shape[0] for t in iter_tensors(input) if t.ndim > 0), 1), 'acc': None}
+
+            if check_acc:
+                items = [(output, dump['forward']['outputs'], module_name, 'forward.outputs')]
+                for name, p in npu_module.named_parameters():
+                    if p.grad is not None and dump['grads'].get(name) is not None:
+                        items.append((p.grad, dump['grads'][name], name, 'grads'))
+                try:
+                    batch_comparison(items)
+                    row['acc'] = 'pass'
+                except AssertionError as e:
+                    row['acc'] = 'fail: {0}'.format(e)
+                    failed.append(row['iteration'])
+            rows.append(row)
+            logging.info('====> replay {0} iteration {1}: time={2:.6f}s, batch={3}, acc={4}'.format(
+                module_name, row['iteration'], row['time(s)'], row['batch'], row['acc']))
+
+        time_list = [row['time(s)'] for row in rows]
+        time_stats = summarize_time(time_list)
+        time_stats['throughput(it/s)'] = len(rows) / sum(time_list)
+        time_stats['throughput(samples/s)'] = sum(row['batch'] for row in rows) / sum(time_list)
+        time_stats['replay_table'] = json.dumps(rows)
+        logging.info('====> replay {0}: {1}'.format(
+            module_name, {k: v for k, v in time_stats.items() if k != 'replay_table'}))
+        if prof_path is not None:
+            verdict = compare_with_baseline(time_list, prof_path, time_threshold=time_threshold,
+                                            window=prof_config['window'], z_threshold=prof_config['z_threshold'])
+            save_time(time_stats, prof_path)
+            assert_no_regression(verdict, time_threshold)
+        assert not failed, 'replay {0} failed at iterations {1}'.format(module_name, failed)
+        return rows
+
     def run_and_compare_with_real_data_acc(self, module, module_name, config):
         forward_input = config['forward']['inputs']
         backward_output = config['backward']['outputs']
@@ -194,23 +537,24 @@ class BaseUtil:
 
         assert forward_input
         assert target_forward_output
-        from utils.acc_utils import accuracy_comparison
+        from utils.acc_utils import comparison_hook, flatten_pairs
 
         self.set_device('npu')
         npu_module = copy.deepcopy(module).to('npu')
         logging.info('[real_data] module {0} start executing on the npu. '.format(module_name))
         output_npu = self.run_step(npu_module, False, *forward_input)
-        logging.info('start compare forward, module_name={0}'.format(module_name))
-        accuracy_comparison(output_npu, target_forward_output, module_name)
+        # 前向输出、反向的输入梯度和参数梯度展开后一次比较
+        pairs = flatten_pairs(output_npu, target_forward_output, module_name, 'forward.outputs')
 
         if backward_output:
-            logging.info('start compare backward, module_name={0}'.format(module_name))
             npu_module.register_full_backward_hook(self.base_hook_backward_fn)
             self.do_real_data_backward(output_npu, backward_output)
             if not self.npu_grad_list and target_backward_input[0] is None:
                 pass
             else:
-                accuracy_comparison(self.npu_grad_list[0], target_backward_input, module_name)
+                self.finish_capture(module_name)
+                pairs.extend(flatten_pairs(self.npu_grad_list[0], target_backward_input, module_name,
+                                           'backward.inputs'))
         else:
             logging.info('compare with real_data, backward_output is empty.')
             npu_module.register_full_backward_hook(self.base_hook_backward_fn)
@@ -220,9 +564,10 @@ class BaseUtil:
                 final_output.backward()
             else:
                 logging.warning('module {0} loss_func is empty.'.format(module_name))
-        # compare parameters
         for name, p in npu_module.named_parameters():
             if p.grad is not None and config['grads'][name] is not None:
-                accuracy_comparison(p.grad, config['grads'][name], name)
+                pairs.extend(flatten_pairs(p.grad, config['grads'][name], name, 'grads'))
             else:
                 logging.warning('tensor name {0} grads is None.'.format(name))
+        logging.info('start compare forward and backward, module_name={0}'.format(module_name))
+        comparison_hook.compare_batch(pairs)
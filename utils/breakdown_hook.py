@@ -0,0 +1,217 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+from collections import OrderedDict
+
+import torch
+
+ROOT_NAME = '(root)'
+
+
+def iter_tensors(value):
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for each_value in value:
+            yield from iter_tensors(each_value)
+    elif isinstance(value, dict):
+        for each_value in value.values():
+            yield from iter_tensors(each_value)
+
+
+def register_grad_hooks(value, hook_function):
+    """
+    在value中每个需要梯度的tensor上注册hook，用于标记module反向的跨度:
+    梯度到达module的输出为反向的起点，module的输入的梯度计算完成为反向的终点
+    """
+    for tensor in iter_tensors(value):
+        if tensor.requires_grad:
+            tensor.register_hook(hook_function)
+
+
+def register_parameter_hooks(module, hook_function, recurse=False):
+    """在module的参数上注册hook，参数的梯度计算完成也是module反向的终点，返回handle列表"""
+    return [p.register_hook(hook_function) for p in module.parameters(recurse=recurse) if p.requires_grad]
+
+
+def module_tree(model):
+    """返回{module名称: module}以及{module名称: 直接子module名称列表}"""
+    modules = OrderedDict()
+    for name, module in model.named_modules():
+        modules[name or ROOT_NAME] = module
+    module_names = {id(module): name for name, module in modules.items()}
+    children = OrderedDict()
+    for name, module in modules.items():
+        children[name] = [module_names[id(child)] for child in module.children() if id(child) in module_names]
+    return modules, children
+
+
+def select_tree(children, names):
+    """把module_tree返回的children限制在names中，每个module的子module为最近的在names中的后代"""
+    def nearest(name):
+        for child in children[name]:
+            if child in names:
+                yield child
+            else:
+                yield from nearest(child)
+
+    return OrderedDict((name, list(nearest(name))) for name in children if name in names)
+
+
+def merge_child_spans(spans, children):
+    """
+    父module的反向跨度包含子module的反向跨度，从最深的module开始向上合并
+    :param spans: {module名称: (start, end)}，没有记录的module视为空跨度
+    :param children: {module名称: 直接子module名称列表}，父module在子module之前
+    :return: 合并后每个module的(start, end)，空跨度为(inf, -inf)
+    """
+    merged = {}
+    for name in reversed(list(children)):
+        start, end = spans.get(name, (math.inf, -math.inf))
+        for child in children[name]:
+            child_start, child_end = merged[child]
+            start, end = min(start, child_start), max(end, child_end)
+        merged[name] = (start, end)
+    return merged
+
+
+class ModuleBreakdown:
+    """
+    在model的每个子module上注册计时hook，分别统计前向和反向耗时
+    前向: forward_pre_hook/forward_hook之间的耗时
+    反向: 从梯度到达module的输出开始，到module的输入和参数的梯度计算完成为止
+    同一个module在一个step中被多次调用(如多个level共享的head)时，反向耗时为这些调用的时间跨度
+    """
+
+    def __init__(self, model, sync=True):
+        from utils.prof_utils import synchronize
+        self._synchronize = synchronize if sync else (lambda: None)
+        self.modules, self.children = module_tree(model)
+        self.stats = {name: {'forward': 0, 'backward': 0, 'calls': 0} for name in self.modules}
+        self.steps = 0
+        self._forward_start = {name: [] for name in self.modules}
+        self._backward_span = {}
+        self._handles = []
+
+    def _now(self):
+        self._synchronize()
+        return time.perf_counter_ns()
+
+    def _mark_backward(self, name, is_start):
+        def hook_function(grad):
+            now = self._now()
+            start, end = self._backward_span.get(name, (math.inf, -math.inf))
+            self._backward_span[name] = (min(start, now), end) if is_start else (start, max(end, now))
+
+        return hook_function
+
+    def _forward_pre_hook(self, name):
+        def hook_function(module, inputs):
+            register_grad_hooks(inputs, self._mark_backward(name, is_start=False))
+            self._forward_start[name].append(self._now())
+
+        return hook_function
+
+    def _forward_hook(self, name):
+        def hook_function(module, inputs, outputs):
+            self.stats[name]['forward'] += self._now() - self._forward_start[name].pop()
+            self.stats[name]['calls'] += 1
+            register_grad_hooks(outputs, self._mark_backward(name, is_start=True))
+
+        return hook_function
+
+    def install(self):
+        for name, module in self.modules.items():
+            self._handles.append(module.register_forward_pre_hook(self._forward_pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._forward_hook(name)))
+            self._handles.extend(register_parameter_hooks(module, self._mark_backward(name, is_start=False)))
+        return self
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def step(self):
+        """一个step(前向+反向)结束后调用，累加各module的反向耗时"""
+        for name, (start, end) in merge_child_spans(self._backward_span, self.children).items():
+            if end > start:
+                self.stats[name]['backward'] += end - start
+        self._backward_span = {}
+        self.steps += 1
+
+    def report(self):
+        """
+        返回按self耗时(前向+反向)降序排列的列表，耗时单位为s，为每个step的平均值
+        """
+        steps = max(self.steps, 1)
+        rows = []
+        for name, module in self.modules.items():
+            row = OrderedDict(name=name, type=type(module).__name__, calls=self.stats[name]['calls'] / steps)
+            for mode in ['forward', 'backward']:
+                cumulative = self.stats[name][mode]
+                children_time = sum(self.stats[child][mode] for child in self.children[name])
+                row[mode + '_self'] = max(cumulative - children_time, 0) / steps / 1e9
+                row[mode + '_cum'] = cumulative / steps / 1e9
+            rows.append(row)
+        rows.sort(key=lambda r: r['forward_self'] + r['backward_self'], reverse=True)
+        return rows
+
+
+def profile_breakdown(model, step_fn, iters=10):
+    """
+    在model上安装计时hook后执行iters次step_fn，返回ModuleBreakdown.report()的结果
+    :param step_fn: 无参数的可调用对象，执行一次前向和反向
+    """
+    breakdown = ModuleBreakdown(model).install()
+    try:
+        for _ in range(iters):
+            step_fn()
+            breakdown.step()
+    finally:
+        breakdown.remove()
+    return breakdown.report()
+
+
+def format_breakdown(rows, top_k=None):
+    lines = ['{0:<48} {1:<24} {2:>6} {3:>12} {4:>12} {5:>12} {6:>12}'.format(
+        'name', 'type', 'calls', 'fwd_self(ms)', 'fwd_cum(ms)', 'bwd_self(ms)', 'bwd_cum(ms)')]
+    for row in rows[:top_k]:
+        lines.append('{0:<48} {1:<24} {2:>6.1f} {3:>12.4f} {4:>12.4f} {5:>12.4f} {6:>12.4f}'.format(
+            row['name'], row['type'], row['calls'], row['forward_self'] * 1e3, row['forward_cum'] * 1e3,
+            row['backward_self'] * 1e3, row['backward_cum'] * 1e3))
+    return '\n'.join(lines)
+
+
+def diff_breakdown(rows, rows_expected):
+    """
+    比较两次breakdown，返回按self耗时变化量降序排列的列表
+    :param rows: 本次的breakdown
+    :param rows_expected: 作为基线的breakdown
+    """
+    expected = {row['name']: row for row in rows_expected}
+    diff_rows = []
+    for row in rows:
+        base = expected.get(row['name'])
+        if base is None:
+            continue
+        diff_row = OrderedDict(name=row['name'], type=row['type'])
+        for key in ['forward_self', 'backward_self']:
+            diff_row[key + '_delta'] = row[key] - base[key]
+            diff_row[key + '_gap'] = (row[key] - base[key]) / base[key] if base[key] > 0 else 0.0
+        diff_rows.append(diff_row)
+    diff_rows.sort(key=lambda r: r['forward_self_delta'] + r['backward_self_delta'], reverse=True)
+    return diff_rows
@@ -0,0 +1,211 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+定位组合module(如FPN、SOLOV2Head、ResNet)中第一个出现精度问题的子module:
+
+    python main.py --scope acc --locate_divergence
+
+在CPU和NPU的同一次执行中记录每个子module的前向输出和输入的梯度，拷贝到host上的OffloadBuffer中，超过大小上限时写入磁盘
+比较时前向按NPU上子module执行完成的顺序，反向按NPU上梯度计算完成的顺序，输出误差随执行顺序的变化以及第一个超过阈值的子module
+"""
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import torch
+
+from utils.breakdown_hook import ROOT_NAME, iter_tensors, module_tree
+
+
+class OffloadBuffer:
+    """host内存中的tensor缓存，超过max_bytes时把最早放入的tensor写入spill_dir，读取时再从磁盘加载"""
+
+    def __init__(self, max_bytes=2 * 1024 ** 3, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self._own_dir = False
+        self.entries = OrderedDict()
+        self.spilled = {}
+        self.total_bytes = 0
+        self.spilled_bytes = 0
+
+    def _spill_path(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='offload_buffer_')
+            self._own_dir = True
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return os.path.join(self.spill_dir, '{0}.pt'.format(len(self.spilled)))
+
+    def put(self, key, tensor):
+        # CPU上的tensor也需要拷贝，否则之后的inplace操作会修改记录的结果
+        tensor = tensor.detach().to('cpu', copy=True)
+        self.entries[key] = tensor
+        self.total_bytes += tensor.numel() * tensor.element_size()
+        while self.total_bytes > self.max_bytes and self.entries:
+            spill_key, spill_tensor = self.entries.popitem(last=False)
+            nbytes = spill_tensor.numel() * spill_tensor.element_size()
+            path = self._spill_path()
+            torch.save(spill_tensor, path)
+            self.spilled[spill_key] = path
+            self.total_bytes -= nbytes
+            self.spilled_bytes += nbytes
+
+    def get(self, key):
+        if key in self.entries:
+            return self.entries[key]
+        return torch.load(self.spilled[key])
+
+    def close(self):
+        self.entries.clear()
+        self.spilled.clear()
+        self.total_bytes = 0
+        if self._own_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+class SubmoduleCapture:
+    """
+    记录model中每个子module每次调用的前向输出和输入的梯度
+    tensor在buffer中的key为(tag, module名称, 'forward'/'backward', 第几次调用, tensor下标)，
+    order按执行完成的顺序记录(module名称, 'forward'/'backward', 第几次调用)
+    """
+
+    def __init__(self, model, tag, buffer):
+        self.tag = tag
+        self.buffer = buffer
+        self.modules, _ = module_tree(model)
+        self.order = []
+        self.num_tensors = {}
+        self._calls = {name: 0 for name in self.modules}
+        self._running = {name: [] for name in self.modules}
+        self._handles = []
+        for name, module in self.modules.items():
+            self._handles.append(module.register_forward_pre_hook(self._forward_pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._forward_hook(name)))
+
+    def _put(self, name, kind, call, index, tensor):
+        entry = (name, kind, call)
+        if entry not in self.num_tensors:
+            self.order.append(entry)
+            self.num_tensors[entry] = set()
+        self.num_tensors[entry].add(index)
+        self.buffer.put((self.tag,) + entry + (index,), tensor)
+
+    def _grad_hook(self, name, call, index):
+        def hook_function(grad):
+            self._put(name, 'backward', call, index, grad)
+
+        return hook_function
+
+    def _forward_pre_hook(self, name):
+        def hook_function(module, inputs):
+            call = self._calls[name]
+            self._calls[name] += 1
+            self._running[name].append(call)
+            # 在输入上注册hook得到输入的梯度，不使用full backward hook，inplace的module也可以使用
+            for index, tensor in enumerate(iter_tensors(inputs)):
+                if tensor.requires_grad:
+                    tensor.register_hook(self._grad_hook(name, call, index))
+
+        return hook_function
+
+    def _forward_hook(self, name):
+        def hook_function(module, inputs, outputs):
+            call = self._running[name].pop()
+            for index, tensor in enumerate(iter_tensors(outputs)):
+                self._put(name, 'forward', call, index, tensor)
+
+        return hook_function
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+
+class DivergenceLocator:
+    """
+    在CPU和NPU的module上同时记录子module的中间结果，比较后给出第一个超过阈值的子module和误差变化曲线
+    :param buffer_size: 两个device的中间结果在host内存中的大小上限(bytes)，超过时写入磁盘
+    """
+
+    def __init__(self, cpu_module, npu_module, module_name, buffer_size=2 * 1024 ** 3, spill_dir=None):
+        self.module_name = module_name
+        self.buffer = OffloadBuffer(buffer_size, spill_dir)
+        self.capture_expected = SubmoduleCapture(cpu_module, 'cpu', self.buffer)
+        self.capture = SubmoduleCapture(npu_module, 'npu', self.buffer)
+
+    def compare(self):
+        """
+        按NPU上的执行顺序比较每个子module的每次调用，一次调用的多个tensor取最差的指标
+        :return: list of dict, 包括module名称、前向/反向、调用次数、cos、value、rel以及是否超过阈值
+        """
+        from utils.acc_utils import comparison_hook, fused_metrics
+        rows = []
+        for name, kind, call in self.capture.order:
+            entry = (name, kind, call)
+            if entry not in self.capture_expected.num_tensors:
+                logging.warning('{0} {1} call {2} is not executed on the cpu.'.format(name, kind, call))
+                continue
+            row = OrderedDict(order=len(rows), name=name, kind=kind, call=call, cos=1.0, value=0.0, rel=0.0)
+            for index in sorted(self.capture.num_tensors[entry] & self.capture_expected.num_tensors[entry]):
+                outputs = self.buffer.get(('npu',) + entry + (index,))
+                outputs_expected = self.buffer.get(('cpu',) + entry + (index,))
+                if outputs.shape != outputs_expected.shape or not outputs.is_floating_point():
+                    continue
+                metrics = fused_metrics(outputs, outputs_expected, ['cos', 'value', 'rel'])
+                metrics = {k: v.item() for k, v in metrics.items()}
+                # 余弦相似度为NaN(如期望值全为0)时不参与比较
+                if metrics['cos'] == metrics['cos']:
+                    row['cos'] = min(row['cos'], metrics['cos'])
+                row['value'] = max(row['value'], metrics['value'])
+                row['rel'] = max(row['rel'], metrics['rel'])
+            module_name = self.module_name if name == ROOT_NAME else name
+            row['exceeded'] = row['cos'] < comparison_hook.get_threshold('cos', module_name) or \
+                row['value'] > comparison_hook.get_threshold('value', module_name)
+            rows.append(row)
+        return rows
+
+    def report(self):
+        """比较并输出误差变化曲线，返回第一个超过阈值的前向和反向子module的描述"""
+        rows = self.compare()
+        lines = []
+        for kind in ['forward', 'backward']:
+            kind_rows = [row for row in rows if row['kind'] == kind]
+            first = next((row for row in kind_rows if row['exceeded']), None)
+            logging.info('{0} error growth of {1}:\n{2}'.format(kind, self.module_name,
+                                                                format_divergence(kind_rows, first)))
+            if first is not None:
+                lines.append('first {0} divergence: {1} (call {2}), cos={3}, value={4}, rel={5}'.format(
+                    kind, first['name'], first['call'], first['cos'], first['value'], first['rel']))
+        logging.info('offload buffer: {0} bytes in memory, {1} bytes spilled to disk'.format(
+            self.buffer.total_bytes, self.buffer.spilled_bytes))
+        return '\n'.join(lines) or 'no submodule exceeds the threshold'
+
+    def close(self):
+        self.capture_expected.remove()
+        self.capture.remove()
+        self.buffer.close()
+
+
+def format_divergence(rows, first=None):
+    lines = ['{0:>5} {1:<48} {2:>5} {3:>12} {4:>12} {5:>12}'.format('order', 'name', 'call', 'cos', 'value', 'rel')]
+    for row in rows:
+        lines.append('{0:>5} {1:<48} {2:>5} {3:>12.6f} {4:>12.6g} {5:>12.6g}{6}'.format(
+            row['order'], row['name'], row['call'], row['cos'], row['value'], row['rel'],
+            '  <-- first divergence' if row is first else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,143 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import glob
+import hashlib
+import logging
+import os
+
+from utils.base_utils import acc_config
+from utils.tensor_store import TensorStore, convert_pth_dump, is_tensor_store, tstore_path
+
+
+class DumpCache:
+    """
+    测试session内共享的real data dump缓存，只在内存中缓存tensor store的header，每次读取时重新以copy-on-write方式映射数据，
+    不拷贝tensor，用例修改读取到的数据不会影响缓存和其他用例
+    .pth在第一次读取时转换为cache_dir中的.tstore，之后的读取和.tstore相同
+    cache_dir中转换后的文件总大小超过max_bytes时按最近使用时间淘汰
+    """
+
+    def __init__(self, max_bytes=4 * 1024 ** 3, cache_dir='./data/dump_cache'):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(path):
+        """
+        返回(实际读取的文件, mtime, 大小)，和load_dump相同，同名的.tstore存在时优先读取.tstore
+        文件被重新dump后mtime和大小会变化，不会读到旧的数据
+        """
+        path = os.path.abspath(path)
+        if is_tensor_store(tstore_path(path)):
+            path = tstore_path(path)
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def converted_path(self, key):
+        """.pth转换后的.tstore的路径，由key决定，.pth变化后重新转换"""
+        name = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, '{0}.tstore'.format(name))
+
+    def load(self, key):
+        """返回TensorStore，.pth转换后的文件更新mtime，用于LRU淘汰"""
+        path = key[0]
+        if not is_tensor_store(path):
+            converted = self.converted_path(key)
+            if is_tensor_store(converted):
+                os.utime(converted)
+            else:
+                logging.info('dump cache convert {0} to {1}'.format(path, converted))
+                convert_pth_dump(path, converted)
+                self.evict(keep=converted)
+            path = converted
+        return TensorStore(path)
+
+    @staticmethod
+    def view(store):
+        return store.reopen().lazy()
+
+    def get(self, path):
+        key = self.make_key(path)
+        store = self.entries.get(key)
+        # 转换后的文件可能已经被其他进程淘汰
+        if store is not None and os.path.exists(store.path):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if store.path != key[0]:
+                os.utime(store.path)
+            return self.view(store)
+
+        self.misses += 1
+        # 同一个文件被重新dump后，旧的缓存不会再被读取
+        for stale_key in [k for k in self.entries if k[0] == key[0]]:
+            del self.entries[stale_key]
+        store = self.load(key)
+        self.entries[key] = store
+        return self.view(store)
+
+    def cached_files(self):
+        files = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.tstore')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self, keep=None):
+        """cache_dir中的文件总大小超过max_bytes时，从最久没有读取的文件开始删除，keep为刚转换的文件，不删除"""
+        files = self.cached_files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+            for stale_key in [k for k, store in self.entries.items() if store.path == path]:
+                del self.entries[stale_key]
+            logging.info('dump cache evict {0}'.format(path))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'cached_bytes': sum(size for _, size, _ in self.cached_files())}
+
+
+_dump_cache = None
+
+
+def get_dump_cache(max_bytes=4 * 1024 ** 3, cache_dir='./data/dump_cache'):
+    global _dump_cache
+    if _dump_cache is None:
+        _dump_cache = DumpCache(max_bytes, cache_dir)
+    _dump_cache.max_bytes = max_bytes
+    _dump_cache.cache_dir = cache_dir
+    return _dump_cache
+
+
+def load_cached_dump(path):
+    """代替load_dump读取real data的dump，同一个进程内重复读取时使用缓存"""
+    return get_dump_cache(int(acc_config['dump_cache_size'] * 1024 ** 3), acc_config['dump_cache_dir']).get(path)
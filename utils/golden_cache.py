@@ -0,0 +1,152 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import logging
+import os
+
+import torch
+
+from utils.perf_history import get_environment
+from utils.real_data_hook import MODULE_INTERNAL_KEYS
+from utils.tensor_store import save_tensors, load_tensors, tensor_to_numpy
+
+DEFAULT_CACHE_DIR = './data/cpu_golden_cache'
+
+
+def update_hash(hasher, value):
+    if isinstance(value, torch.Tensor):
+        hasher.update('tensor:{0}:{1}'.format(value.dtype, list(value.shape)).encode('utf-8'))
+        hasher.update(tensor_to_numpy(value).data)
+    elif isinstance(value, (list, tuple)):
+        hasher.update('{0}:{1}'.format(type(value).__name__, len(value)).encode('utf-8'))
+        for each_value in value:
+            update_hash(hasher, each_value)
+    elif isinstance(value, dict):
+        hasher.update('dict:{0}'.format(len(value)).encode('utf-8'))
+        for k, each_value in value.items():
+            hasher.update(str(k).encode('utf-8'))
+            update_hash(hasher, each_value)
+    else:
+        hasher.update(repr(value).encode('utf-8'))
+
+
+def config_state(value, depth=0):
+    """
+    把超参数转换为可以稳定hash的结构，普通对象(如MaxIoUAssigner)按类型和__dict__展开，
+    函数和类按名称，不使用默认的repr(包含对象地址)
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, torch.Tensor):
+        return 'tensor:{0}:{1}'.format(value.dtype, list(value.shape))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value
+        return [type(value).__name__] + [config_state(each_value, depth + 1) for each_value in items]
+    if isinstance(value, dict):
+        return {str(k): config_state(each_value, depth + 1) for k, each_value in value.items()}
+    name = getattr(value, '__qualname__', None)
+    if name is not None:
+        return '{0}.{1}'.format(getattr(value, '__module__', ''), name)
+    if hasattr(value, '__dict__') and depth < 8:
+        return {'type': type(value).__qualname__, 'attrs': config_state(vars(value), depth + 1)}
+    return type(value).__qualname__
+
+
+def module_config(module):
+    """各子module的__dict__中不是tensor和子module的属性，包括不是module的超参数对象，如assigner的阈值"""
+    config = {}
+    for name, each_module in module.named_modules():
+        config[name] = config_state({k: v for k, v in vars(each_module).items()
+                                     if k not in MODULE_INTERNAL_KEYS and not isinstance(v, torch.nn.Module)})
+    return config
+
+
+class GoldenCache:
+    """
+    CPU标杆结果的磁盘缓存，key为module结构和权重、输入以及软件版本的sha256
+    命中时通过tensor store映射文件内容，总大小超过max_bytes时按最近使用时间淘汰
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, module, kind, *input):
+        """
+        :param kind: 缓存内容的类型，例如'acc'、'parameters'
+        """
+        hasher = hashlib.sha256()
+        hasher.update('{0}:{1}:{2}'.format(kind, get_environment(), type(module).__qualname__).encode('utf-8'))
+        # repr包含module结构，module_config包含repr中没有的超参数(如assigner的阈值)
+        hasher.update(repr(module).encode('utf-8'))
+        update_hash(hasher, module_config(module))
+        update_hash(hasher, module.state_dict())
+        update_hash(hasher, input)
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.tstore')
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            value = load_tensors(path)
+            # 更新mtime，用于LRU淘汰
+            os.utime(path)
+        except (OSError, AssertionError, ValueError) as e:
+            logging.warning('golden cache {0} is broken, ignore it: {1}'.format(path, e))
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        save_tensors(value, self.path(key))
+        self.evict()
+
+    def evict(self):
+        files = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.tstore')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logging.info('golden cache evict {0}'.format(path))
+
+
+_golden_cache = {}
+
+
+def get_golden_cache(cache_dir=DEFAULT_CACHE_DIR, max_bytes=10 * 1024 ** 3):
+    if cache_dir not in _golden_cache:
+        _golden_cache[cache_dir] = GoldenCache(cache_dir, max_bytes)
+    _golden_cache[cache_dir].max_bytes = max_bytes
+    return _golden_cache[cache_dir]
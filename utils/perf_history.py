@@ -0,0 +1,256 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import pytz
+
+PROF_SUMMARY_DIR = './data/prof_time_summary'
+DEFAULT_DB_PATH = os.path.join(PROF_SUMMARY_DIR, 'perf_history.db')
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 固定列，其余指标列在第一次写入时通过ALTER TABLE追加
+BASE_COLUMNS = [
+    ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+    ('"case"', 'TEXT NOT NULL'),
+    ('device_info', 'TEXT NOT NULL'),
+    ('environment', 'TEXT NOT NULL'),
+    ('date', 'TEXT NOT NULL'),
+]
+
+
+def now_str():
+    return datetime.now(pytz.timezone('Asia/Shanghai')).strftime(TIME_FORMAT)
+
+
+def get_environment():
+    """返回影响性能的软件版本，作为历史记录的environment字段"""
+    versions = []
+    for pkg in ['torch', 'torch_npu', 'mmcv', 'mmdet']:
+        try:
+            versions.append('{0}={1}'.format(pkg, __import__(pkg).__version__))
+        except (ImportError, AttributeError):
+            continue
+    return ','.join(versions) or 'UNKNOWN'
+
+
+def case_from_path(prof_path, root=PROF_SUMMARY_DIR):
+    """
+    将用例的prof_path转换为历史记录中的case，例如
+    './data/prof_time_summary/heads/ssd_head/ssd_head_prof.csv' -> 'heads/ssd_head/ssd_head_prof'
+    """
+    prof_path = os.path.abspath(prof_path)
+    root = os.path.abspath(root)
+    if prof_path.startswith(root + os.sep):
+        prof_path = os.path.relpath(prof_path, root)
+    else:
+        prof_path = os.path.basename(prof_path)
+    return os.path.splitext(prof_path)[0].replace(os.sep, '/')
+
+
+def column_name(key):
+    """csv的列名转换为数据库列名，例如'one_step_time(s)' -> 'one_step_time'"""
+    return key.replace('(s)', '').replace('(', '_').replace(')', '').replace(' ', '_')
+
+
+def sql_type(value):
+    if isinstance(value, bool) or isinstance(value, int):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    return 'TEXT'
+
+
+class PerfHistory:
+    """
+    基于sqlite的性能历史记录，按(case, device_info, environment, date)建立索引
+    使用WAL模式，多个进程可以同时追加记录
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._pid = None
+        self._columns = set()
+
+    @property
+    def conn(self):
+        # sqlite连接不能跨进程使用，fork之后重新连接
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+            self._create_table()
+        return self._conn
+
+    def _create_table(self):
+        columns = ', '.join('{0} {1}'.format(name, col_type) for name, col_type in BASE_COLUMNS)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS samples ({0})'.format(columns))
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_samples_key '
+                           'ON samples ("case", device_info, environment, date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_samples_device '
+                           'ON samples ("case", device_info, date)')
+        # 已经导入的旧csv，每个case只导入一次
+        self._conn.execute('CREATE TABLE IF NOT EXISTS imported_csv '
+                           '("case" TEXT PRIMARY KEY, path TEXT NOT NULL, count INTEGER NOT NULL, date TEXT NOT NULL)')
+        self._load_columns()
+
+    def _load_columns(self):
+        self._columns = {row[1] for row in self._conn.execute('PRAGMA table_info(samples)')}
+
+    def ensure_column(self, name, col_type):
+        if name in self._columns:
+            return
+        try:
+            self.conn.execute('ALTER TABLE samples ADD COLUMN "{0}" {1}'.format(name, col_type))
+        except sqlite3.OperationalError as e:
+            # 其他进程可能已经添加了该列
+            if 'duplicate column' not in str(e):
+                raise
+        self._load_columns()
+
+    def append(self, case, record, device_info='UNKNOWN', environment=None, date=None):
+        """
+        追加一条记录，返回记录id
+        :param record: dict; key为指标名(如summarize_time返回的各列)，value为指标值
+        """
+        conn = self.conn
+        values = {column_name(k): v for k, v in record.items()}
+        for name, value in values.items():
+            self.ensure_column(name, sql_type(value))
+        values.update({
+            'case': case,
+            'device_info': device_info,
+            'environment': environment or get_environment(),
+            'date': date or now_str(),
+        })
+        names = ', '.join('"{0}"'.format(name) for name in values)
+        marks = ', '.join('?' * len(values))
+        cursor = conn.execute('INSERT INTO samples ({0}) VALUES ({1})'.format(names, marks), list(values.values()))
+        return cursor.lastrowid
+
+    def query(self, case, column='one_step_time', device_info=None, environment=None, limit=None):
+        """按时间顺序返回case最近limit条记录中column列的非空值"""
+        column = column_name(column)
+        conn = self.conn
+        if column not in self._columns:
+            # 其他进程(如性能用例的worker)可能已经添加了该列
+            self._load_columns()
+            if column not in self._columns:
+                return []
+        sql = 'SELECT "{0}" FROM samples WHERE "case" = ? AND "{0}" IS NOT NULL'.format(column)
+        params = [case]
+        if device_info is not None:
+            sql += ' AND device_info = ?'
+            params.append(device_info)
+        if environment is not None:
+            sql += ' AND environment = ?'
+            params.append(environment)
+        sql += ' ORDER BY date DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [row[0] for row in conn.execute(sql, params)][::-1]
+
+    def has_case(self, case):
+        return self.conn.execute('SELECT 1 FROM samples WHERE "case" = ? LIMIT 1', [case]).fetchone() is not None
+
+    def import_csv(self, csv_path, case=None):
+        """
+        导入旧的prof_time_summary csv文件，返回导入的记录数
+        每个case的csv只导入一次，重复导入时返回0，不会产生重复的记录
+        """
+        case = case or case_from_path(csv_path)
+        conn = self.conn
+        count = 0
+        # 检查和导入在同一个事务中，多个进程同时导入时只有一个生效
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM imported_csv WHERE "case" = ?', [case]).fetchone() is not None:
+                conn.execute('ROLLBACK')
+                return 0
+            with open(csv_path, newline='') as f:
+                for row in csv.DictReader(f):
+                    record = {}
+                    for k, v in row.items():
+                        if k in ['date', 'device_info'] or v in (None, ''):
+                            continue
+                        try:
+                            record[k] = float(v)
+                        except ValueError:
+                            record[k] = v
+                    self.append(case, record, device_info=row.get('device_info') or 'UNKNOWN',
+                                environment='UNKNOWN', date=row.get('date') or None)
+                    count += 1
+            conn.execute('INSERT INTO imported_csv ("case", path, count, date) VALUES (?, ?, ?, ?)',
+                         [case, csv_path, count, now_str()])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            # 回滚后事务中添加的列也不存在了
+            self._load_columns()
+            raise
+        return count
+
+    def import_csv_dir(self, root=PROF_SUMMARY_DIR):
+        total = 0
+        for csv_path in sorted(glob.glob(os.path.join(root, '**', '*.csv'), recursive=True)):
+            count = self.import_csv(csv_path, case_from_path(csv_path, root))
+            logging.info('import {0} records from {1}'.format(count, csv_path))
+            total += count
+        return total
+
+
+_perf_history = {}
+
+
+def get_perf_history(db_path=DEFAULT_DB_PATH):
+    if db_path not in _perf_history:
+        _perf_history[db_path] = PerfHistory(db_path)
+    return _perf_history[db_path]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Import the prof_time_summary csv files into the perf history database.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--csv_dir",
+        type=str,
+        default=PROF_SUMMARY_DIR,
+        help="Directory of the csv files to import.",
+    )
+    parser.add_argument(
+        "--db_path",
+        type=str,
+        default=DEFAULT_DB_PATH,
+        help="Path of the perf history database.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = get_parser().parse_args()
+    history = PerfHistory(args.db_path)
+    print('imported {0} records into {1}'.format(history.import_csv_dir(args.csv_dir), args.db_path))
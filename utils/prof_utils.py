@@ -12,39 +12,385 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import csv
+import gc
+import json
+import math
 import os
-
-from utils.base_utils import device_info
-import logging
-import pandas as pd
+import statistics
+import time
+from collections import namedtuple
 from datetime import datetime
+
 import pytz
+import torch
+from utils import base_utils
+from utils.perf_history import get_perf_history, case_from_path
+import logging
 
 
-def save_time(time_to_save, path):
-    local_time = datetime.now(pytz.timezone('Asia/Shanghai'))
-    time_format = "%Y-%m-%d %H:%M:%S"
-    data = {'date': [local_time.strftime(time_format)], 'device_info': device_info, 'one_step_time(s)': [time_to_save]}
-    data = pd.DataFrame(data)
+def get_device_module():
+    if hasattr(torch, 'npu') and torch.npu.is_available():
+        return torch.npu
+    if torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def synchronize():
+    device_module = get_device_module()
+    if device_module is not None:
+        device_module.synchronize()
+
+
+def reset_peak_rss():
+    """通过/proc/self/clear_refs重置VmHWM，不支持时峰值RSS为进程启动以来的峰值"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_memory(step_fn):
+    """
+    执行一次step_fn，返回峰值内存相关的各列:
+    peak_allocated_bytes: device上峰值分配的内存，CPU上为tracemalloc统计的峰值
+    alloc_count: step中内存分配的次数
+    peak_rss_bytes: 进程的峰值RSS
+    """
+    device_module = get_device_module()
+    synchronize()
+    reset_peak_rss()
+    if device_module is not None:
+        device_module.reset_peak_memory_stats()
+        alloc_count_start = device_module.memory_stats().get('allocation.all.allocated', 0)
+        step_fn()
+        synchronize()
+        peak_allocated = device_module.max_memory_allocated()
+        alloc_count = device_module.memory_stats().get('allocation.all.allocated', 0) - alloc_count_start
+    else:
+        import tracemalloc
+        tracemalloc.start()
+        snapshot_start = tracemalloc.take_snapshot()
+        step_fn()
+        _, peak_allocated = tracemalloc.get_traced_memory()
+        alloc_count = sum(max(stat.count_diff, 0)
+                          for stat in tracemalloc.take_snapshot().compare_to(snapshot_start, 'lineno'))
+        tracemalloc.stop()
+    return {
+        'peak_allocated_bytes': int(peak_allocated),
+        'alloc_count': int(alloc_count),
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
 
-    if os.path.exists(path):
+def parse_cpu_list(cpu_list):
+    """'0-3,8' -> [0, 1, 2, 3, 8]"""
+    cpus = []
+    for part in cpu_list.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def apply_run_settings(cpu_affinity=None, intra_threads=None, interop_threads=None):
+    """
+    设置当前进程的CPU亲和性和线程数，需要在进程执行任何算子之前调用
+    :param cpu_affinity: str, 例如'0-7'
+    """
+    if cpu_affinity:
+        os.sched_setaffinity(0, parse_cpu_list(cpu_affinity))
+    if intra_threads:
+        torch.set_num_threads(intra_threads)
+    if interop_threads:
         try:
-            data_ori = pd.read_csv(path)
-            data_to_save = data_ori.append(data)
-            data_to_save.to_csv(path, index=False)
-        except pd.errors.EmptyDataError:
-            data.to_csv(path, index=False)
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logging.warning('set_num_interop_threads failed: {0}'.format(e))
+
+
+def get_run_settings():
+    """返回当前进程实际的CPU亲和性、线程数和负载，随每条性能记录保存"""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    return {
+        'cpu_affinity': cpus,
+        'intra_threads': torch.get_num_threads(),
+        'interop_threads': torch.get_num_interop_threads(),
+        'loadavg': os.getloadavg()[0] if hasattr(os, 'getloadavg') else None,
+    }
+
+
+def wait_for_idle(load_threshold, timeout=300, interval=5):
+    """
+    等待机器空闲后再计时: 1分钟平均负载除以可用CPU数不超过load_threshold
+    超过timeout(s)仍然繁忙时只输出warning，返回最后一次的负载
+    """
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    time_start = time.time()
+    while True:
+        load = os.getloadavg()[0] / cpu_count
+        if load <= load_threshold:
+            return load
+        if time.time() - time_start > timeout:
+            logging.warning('machine is still busy after {0}s, load={1:.2f}, load_threshold={2}'.format(
+                timeout, load, load_threshold))
+            return load
+        logging.info('machine is busy, load={0:.2f}, load_threshold={1}, wait {2}s'.format(
+            load, load_threshold, interval))
+        time.sleep(interval)
+
+
+def time_steps(step_fn, warmup=3, iters=20, disable_gc=True):
+    """
+    执行warmup次预热后，再执行iters次step_fn，返回每次执行的耗时(s)
+    :param step_fn: 无参数的可调用对象，执行一个step
+    :param warmup: 预热次数，不计入耗时
+    :param iters: 计时次数
+    :param disable_gc: 计时期间是否关闭gc
+    """
+    assert iters > 0, "iters must be positive, got {0}".format(iters)
+    for _ in range(warmup):
+        step_fn()
+    synchronize()
+
+    gc_enabled = gc.isenabled()
+    if disable_gc:
+        gc.collect()
+        gc.disable()
+    time_list = []
+    try:
+        for _ in range(iters):
+            time_start = time.perf_counter_ns()
+            step_fn()
+            synchronize()
+            time_list.append((time.perf_counter_ns() - time_start) / 1e9)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return time_list
+
+
+def percentile(values, q):
+    """线性插值计算百分位数，q取值范围为[0, 100]"""
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.0
+    low, high = math.floor(pos), math.ceil(pos)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def summarize_time(time_list):
+    """将多次执行的耗时汇总为csv中保存的各列，one_step_time(s)取中位数"""
+    median = statistics.median(time_list)
+    return {
+        'one_step_time(s)': median,
+        'median(s)': median,
+        'p90(s)': percentile(time_list, 90),
+        'p99(s)': percentile(time_list, 99),
+        'std(s)': statistics.stdev(time_list) if len(time_list) > 1 else 0.0,
+        'iters': len(time_list),
+    }
+
+
+def fit_scaling(rows, super_linear_tolerance=0.15):
+    """
+    对sweep结果拟合log(time) = c + batch_exponent * log(batch) + size_exponent * log(size^2)
+    exponent为1表示耗时随batch/像素数线性增长，超过1 + super_linear_tolerance时认为超线性
+    :param rows: list of dict, 包含'batch'、'size'和'median(s)'
+    :return: dict, 只有一个取值的维度exponent为None
+    """
+    import numpy as np
+    columns = [np.ones(len(rows))]
+    names = []
+    for key, scale in [('batch', 1), ('size', 2)]:
+        values = [row[key] for row in rows]
+        if len(set(values)) > 1:
+            columns.append(scale * np.log(values))
+            names.append(key + '_exponent')
+    solution = np.linalg.lstsq(np.stack(columns, axis=1), np.log([row['median(s)'] for row in rows]), rcond=None)[0]
+
+    result = {'batch_exponent': None, 'size_exponent': None}
+    result.update({name: float(value) for name, value in zip(names, solution[1:])})
+    result['super_linear'] = int(any(v is not None and v > 1 + super_linear_tolerance for v in result.values()))
+    return result
+
+
+def format_scaling_table(rows):
+    lines = ['{0:>6} {1:>6} {2:>12} {3:>12} {4:>16}'.format(
+        'batch', 'size', 'median(ms)', 'p90(ms)', 'per_sample(ms)')]
+    for row in rows:
+        lines.append('{0:>6} {1:>6} {2:>12.4f} {3:>12.4f} {4:>16.4f}'.format(
+            row['batch'], row['size'], row['median(s)'] * 1e3, row['p90(s)'] * 1e3,
+            row['median(s)'] / row['batch'] * 1e3))
+    return '\n'.join(lines)
+
+
+def get_profiler():
+    """返回可用的profiler模块和需要采集的activities，优先使用torch_npu.profiler"""
+    try:
+        import torch_npu
+        profiler = torch_npu.profiler
+        return profiler, [profiler.ProfilerActivity.CPU, profiler.ProfilerActivity.NPU], 'self_npu_time_total'
+    except (ImportError, AttributeError):
+        profiler = torch.profiler
+        if torch.cuda.is_available():
+            return profiler, [profiler.ProfilerActivity.CPU, profiler.ProfilerActivity.CUDA], 'self_cuda_time_total'
+        return profiler, [profiler.ProfilerActivity.CPU], None
+
+
+def artifact_dir_from_path(path):
+    """
+    性能用例的profiler产物目录，和用例的性能历史记录放在一起，例如
+    './data/prof_time_summary/heads/ssd_head/ssd_head_prof.csv' ->
+    './data/prof_time_summary/heads/ssd_head/ssd_head_prof_artifacts/<date>'
+    """
+    local_time = datetime.now(pytz.timezone('Asia/Shanghai'))
+    return os.path.join(os.path.splitext(path)[0] + '_artifacts', local_time.strftime("%Y%m%d_%H%M%S"))
+
+
+def profile_steps(step_fn, artifact_dir, iters=5, top_k=20):
+    """
+    在profiler下执行iters次step_fn，在artifact_dir中保存:
+    trace.json: chrome/perfetto格式的trace
+    top_ops.txt: 按self cpu/device耗时排序的前top_k个算子
+    op_shapes.csv: 算子和输入shape的统计
+    """
+    profiler, activities, device_sort_key = get_profiler()
+    os.makedirs(artifact_dir, exist_ok=True)
+    with profiler.profile(activities=activities, record_shapes=True) as prof:
+        for _ in range(iters):
+            step_fn()
+        synchronize()
+
+    prof.export_chrome_trace(os.path.join(artifact_dir, 'trace.json'))
+    if not hasattr(prof, 'key_averages'):
+        logging.warning('profiler {0} does not support key_averages, only trace is exported.'.format(profiler))
+        return artifact_dir
+
+    with open(os.path.join(artifact_dir, 'top_ops.txt'), 'w') as f:
+        for sort_by in ['self_cpu_time_total', device_sort_key]:
+            if sort_by is None:
+                continue
+            try:
+                table = prof.key_averages().table(sort_by=sort_by, row_limit=top_k)
+            except (AttributeError, KeyError) as e:
+                logging.warning('profiler table sort by {0} failed: {1}'.format(sort_by, e))
+                continue
+            f.write('sort_by={0}\n{1}\n\n'.format(sort_by, table))
+
+    with open(os.path.join(artifact_dir, 'op_shapes.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'input_shapes', 'count', 'self_cpu_time_total(us)'])
+        for evt in prof.key_averages(group_by_input_shape=True):
+            writer.writerow([evt.key, evt.input_shapes, evt.count, evt.self_cpu_time_total])
+    return artifact_dir
+
+
+def save_time(time_to_save, path):
+    """
+    :param time_to_save: 单次耗时(s)，或summarize_time返回的各列
+    :param path: 用例的prof_path，转换为性能历史记录中的case
+    :return: 历史记录的id
+    """
+    if not isinstance(time_to_save, dict):
+        time_to_save = {'one_step_time(s)': time_to_save}
+    return get_perf_history().append(case_from_path(path), time_to_save, device_info=base_utils.device_info)
+
+
+# MAD乘以该系数后，在正态分布下与标准差一致
+MAD_SCALE = 1.4826
+
+RegressionVerdict = namedtuple('RegressionVerdict', ['status', 'baseline', 'current', 'gap', 'effect_size'])
+
+
+def median_abs_deviation(values):
+    center = statistics.median(values)
+    return statistics.median([abs(v - center) for v in values]) * MAD_SCALE
+
+
+def detect_regression(samples, baseline_samples, time_threshold=0.1, z_threshold=3.0):
+    """
+    用中位数/MAD比较当前样本与基线样本，返回RegressionVerdict
+    status为'pass'、'regression'或'improvement'，只有相对差距超过time_threshold且
+    effect_size(以基线和当前样本的MAD合并为尺度的稳健z值)超过z_threshold时才判定为劣化/提升
+    :param samples: 当前多次执行的耗时
+    :param baseline_samples: 最近若干次历史记录的耗时
+    """
+    current = statistics.median(samples)
+    if not baseline_samples:
+        return RegressionVerdict('pass', None, current, 0.0, 0.0)
+
+    baseline = statistics.median(baseline_samples)
+    if baseline > 0:
+        gap = (current - baseline) / baseline
+    else:
+        # 基线耗时为0(如计时精度不足)时没有相对差距，只要当前耗时不为0即视为无穷大的差距
+        gap = math.copysign(math.inf, current - baseline) if current != baseline else 0.0
+    spread = math.sqrt(median_abs_deviation(baseline_samples) ** 2 + median_abs_deviation(samples) ** 2)
+    if spread > 0:
+        effect_size = (current - baseline) / spread
     else:
-        data.to_csv(path, index=False)
+        effect_size = math.copysign(math.inf, current - baseline) if current != baseline else 0.0
+
+    status = 'pass'
+    if gap > time_threshold and effect_size > z_threshold:
+        status = 'regression'
+    elif gap < -time_threshold and effect_size < -z_threshold:
+        status = 'improvement'
+    return RegressionVerdict(status, baseline, current, gap, effect_size)
+
+
+def load_baseline(path, window=20, column='one_step_time(s)'):
+    """
+    读取当前设备最近window次记录中column列的值
+    数据库中还没有该用例的记录时(如新clone的仓库)，先导入仓库中该用例的旧csv作为基线
+    """
+    history = get_perf_history()
+    case = case_from_path(path)
+    if path.endswith('.csv') and os.path.isfile(path) and not history.has_case(case):
+        count = history.import_csv(path, case)
+        logging.info('import {0} records of {1} from {2}'.format(count, case, path))
+    return history.query(case, column, device_info=base_utils.device_info, limit=window)
+
+
+def load_last_breakdown(path):
+    """读取当前设备最近一次保存的breakdown"""
+    breakdown = get_perf_history().query(case_from_path(path), 'breakdown', device_info=base_utils.device_info, limit=1)
+    return json.loads(breakdown[0]) if breakdown else None
+
+
+def compare_with_baseline(time_list, path, time_threshold=0.1, window=20, z_threshold=3.0,
+                          column='one_step_time(s)'):
+    if not isinstance(time_list, (list, tuple)):
+        time_list = [time_list]
+    verdict = detect_regression(time_list, load_baseline(path, window, column), time_threshold, z_threshold)
+    logging.info('====> {0}: baseline={1}, current={2}, gap={3}, effect_size={4}, status={5}, threshold={6}'.format(
+        column, verdict.baseline, verdict.current, verdict.gap, verdict.effect_size, verdict.status, time_threshold))
+    return verdict
 
 
-def compare_with_mean_time(time, path, time_threshold=0.1):
-    assert os.path.exists(path)
-    data_ori = pd.read_csv(path)
-    mean_time = data_ori['one_step_time(s)'].loc[data_ori['device_info'] == device_info].mean()
+def assert_no_regression(verdict, time_threshold, column='one_step_time(s)'):
+    assert verdict.status != 'regression', \
+        "compare_with_baseline {0}, baseline={1}, current={2}, gap={3}, effect_size={4}, threshold={5}".format(
+            column, verdict.baseline, verdict.current, verdict.gap, verdict.effect_size, time_threshold)
 
-    gap = (time - mean_time) / mean_time
-    logging.info('====> mean_time={0}, gap={1}, time_threshold={2}'.format(mean_time, gap, time_threshold))
 
-    assert gap <= time_threshold, \
-        "compare_with_mean_time, mean_time={0}, gap={1}, time_threshold={2}".format(mean_time, gap, time_threshold)
+def compare_with_mean_time(time, path, time_threshold=0.1, window=20, z_threshold=3.0):
+    verdict = compare_with_baseline(time, path, time_threshold, window, z_threshold)
+    assert_no_regression(verdict, time_threshold)
+    return verdict
@@ -11,24 +11,90 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
+import argparse
+import collections
+import concurrent.futures
 import glob
+import json
+import multiprocessing
 import os.path
+import pickle
+import threading
+import time
 
 import torch
 
-
-def module_hook_func(name, module, dump_dict, mode="forward"):
+from utils.tensor_store import save_tensors, load_meta, ObjectStore, TensorMeta, TensorStore, is_tensor_store, \
+    tstore_path
+
+
+SUMMARY_BINS = 32
+SUMMARY_SAMPLES = 64
+
+
+def summarize_tensor(tensor, bins=SUMMARY_BINS, num_samples=SUMMARY_SAMPLES):
+    """
+    只统计tensor的shape、dtype、min/max/mean/std、L2范数、NaN/Inf个数、[min, max]上固定bin数的直方图
+    以及等间隔采样的num_samples个元素，统计量在tensor所在的device上计算，最后一次拷贝到host
+    """
+    summary = {'type': 'tensor_summary', 'shape': list(tensor.shape), 'dtype': str(tensor.dtype).replace('torch.', ''),
+               'numel': tensor.numel()}
+    value = tensor.detach().reshape(-1).float()
+    if value.numel() == 0:
+        return summary
+
+    # 用where代替按mask取值，避免device和host同步
+    finite = torch.isfinite(value)
+    num_finite = finite.sum()
+    num_nan = torch.isnan(value).sum()
+    finite_value = torch.where(finite, value, torch.zeros_like(value))
+    min_value = torch.where(finite, value, torch.full_like(value, float('inf'))).min()
+    max_value = torch.where(finite, value, torch.full_like(value, float('-inf'))).max()
+    # 全部为NaN/Inf时统计量为0
+    min_value = torch.where(num_finite > 0, min_value, torch.zeros_like(min_value))
+    max_value = torch.where(num_finite > 0, max_value, torch.zeros_like(max_value))
+    count = num_finite.clamp(min=1).float()
+    mean = finite_value.sum() / count
+    std = (torch.where(finite, value - mean, finite_value) ** 2).sum().div((count - 1).clamp(min=1)).sqrt()
+    l2 = finite_value.norm()
+    width = (max_value - min_value).clamp(min=torch.finfo(torch.float32).tiny)
+    index = ((finite_value - min_value) / width * bins).long().clamp(0, bins - 1)
+    hist = torch.zeros(bins, dtype=torch.float32, device=value.device).scatter_add_(0, index, finite.float())
+    sample = value[::max(value.numel() // num_samples, 1)][:num_samples]
+
+    stats = torch.stack([min_value, max_value, mean, std, l2, num_nan.float(), value.numel() - num_finite.float() -
+                         num_nan.float()])
+    host_values = torch.cat([stats, hist, sample]).cpu()
+    for i, k in enumerate(['min', 'max', 'mean', 'std', 'l2', 'nan', 'inf']):
+        summary[k] = host_values[i].item()
+    summary['nan'], summary['inf'] = int(summary['nan']), int(summary['inf'])
+    summary['hist'] = host_values[len(stats):len(stats) + bins].clone()
+    summary['sample'] = host_values[len(stats) + bins:].clone()
+    return summary
+
+
+def summarize(value):
+    """将嵌套结构中的tensor替换为summarize_tensor的统计结果"""
+    if isinstance(value, torch.Tensor):
+        return summarize_tensor(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(summarize(each_value) for each_value in value)
+    if isinstance(value, dict):
+        return {k: summarize(each_value) for k, each_value in value.items()}
+    return value
+
+
+def module_hook_func(name, module, dump_dict, mode="forward", summary=False):
     def hook_function(module, inputs, outputs):
-        dump_dict[mode]['inputs'] = inputs
-        dump_dict[mode]['outputs'] = outputs
+        dump_dict[mode]['inputs'] = summarize(inputs) if summary else inputs
+        dump_dict[mode]['outputs'] = summarize(outputs) if summary else outputs
 
     return hook_function
 
 
-def param_hook_func(name, dump_dict):
+def param_hook_func(name, dump_dict, summary=False):
     def hook_function(grad):
-        dump_dict['grads'][name] = grad
+        dump_dict['grads'][name] = summarize(grad) if summary else grad
 
     return hook_function
 
@@ -76,7 +142,11 @@ def check_dump_dict(dump_dict, full_log=False):
         err_str += 'backward::outputs is empty, please check.\n'
 
     try:
-        param_num = sum([len(list(m.parameters())) for m in (dump_dict['config']['model_dict']['_modules'].values())])
+        if 'hparams' in dump_dict['config']['model_dict']:
+            param_num = len(dump_dict['config']['state_dict'])
+        else:
+            param_num = sum([len(list(m.parameters()))
+                             for m in (dump_dict['config']['model_dict']['_modules'].values())])
     except:
         param_num = 0
 
@@ -93,52 +163,383 @@ def check_dump_dict(dump_dict, full_log=False):
     return err_str
 
 
-def check_dump_dict_dir(dir_path, full_log=False):
-    err_str = ""
+def tensor_nbytes(value):
+    """统计嵌套结构中tensor(或TensorMeta)的数据大小"""
+    if isinstance(value, (torch.Tensor, TensorMeta)):
+        return value.element_size() * value.nelement() if isinstance(value, torch.Tensor) else value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(each_value) for each_value in value)
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(each_value) for each_value in value.values())
+    if isinstance(value, torch.nn.Module):
+        return tensor_nbytes(list(value.parameters()) + list(value.buffers()))
+    return 0
+
+
+def check_dump_file(file_path, full_log=False):
+    """
+    只读取dump的结构和元信息检查一个文件，不读取tensor的数据
+    :return: 检查结果，包含文件大小、tensor数据大小、错误信息和耗时
+    """
+    time_start = time.perf_counter()
+    record = {'path': file_path, 'file_bytes': os.path.getsize(file_path)}
+    if is_tensor_store(file_path):
+        record['file_bytes'] = TensorStore(file_path).nbytes()
+    try:
+        dump_dict = load_meta(file_path)
+        record['tensor_bytes'] = tensor_nbytes(dump_dict)
+        record['error'] = check_dump_dict(dump_dict, full_log)
+    except Exception as e:
+        record['tensor_bytes'] = None
+        record['error'] = f"### {file_path} load failed: {e}\n"
+    record['time(s)'] = time.perf_counter() - time_start
+    return record
+
+
+def list_dump_files(dir_path):
+    """目录中的dump文件，同名的.pth和.tstore只检查load_dump实际读取的.tstore"""
+    file_paths = glob.glob(os.path.join(dir_path, '*.tstore'))
     for file_path in glob.glob(os.path.join(dir_path, '*.pth')):
-        dump_list = torch.load(file_path, map_location='cpu')
-        err_str_tmp = check_dump_dict(dump_list, full_log)
-
-        if err_str_tmp:
-            err_str += err_str_tmp
-    return err_str
+        if tstore_path(file_path) not in file_paths:
+            file_paths.append(file_path)
+    return sorted(file_paths)
+
+
+def check_dump_dict_dir(dir_path, full_log=False, workers=None, report_path=None):
+    """
+    在进程池中并行检查目录中的所有dump，只读取header，不读取tensor的数据
+    :param workers: 进程数，默认为CPU数，1表示在当前进程中检查
+    :param report_path: 不为None时将每个文件的检查结果保存为json
+    """
+    time_start = time.perf_counter()
+    file_paths = list_dump_files(dir_path)
+    workers = min(workers or os.cpu_count() or 1, max(len(file_paths), 1))
+    if workers == 1:
+        records = [check_dump_file(file_path, full_log) for file_path in file_paths]
+    else:
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            records = list(executor.map(check_dump_file, file_paths, [full_log] * len(file_paths)))
+
+    if report_path is not None:
+        report = {
+            'dir': dir_path,
+            'num_files': len(records),
+            'num_failed': sum(1 for record in records if record['error']),
+            'time(s)': time.perf_counter() - time_start,
+            'files': records,
+        }
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return ''.join(record['error'] for record in records)
 
 
 def is_torch_module(module):
     return str(type(module)).replace("'", "").split(' ')[1].startswith('torch.')
 
 
-def dump_hook(model, dump_name_list=[], auto=False):
+# nn.Module自身的属性(子module、参数、buffer和各种hook)，不属于超参数
+MODULE_INTERNAL_KEYS = set(torch.nn.Module().__dict__) - {'training'}
+
+
+def module_hparams(module):
+    """module.__dict__中可以pickle的超参数，不包括tensor和子module"""
+    hparams = {}
+    for k, v in module.__dict__.items():
+        if k in MODULE_INTERNAL_KEYS or isinstance(v, (torch.Tensor, torch.nn.Module)):
+            continue
+        try:
+            pickle.dumps(v)
+        except Exception:
+            continue
+        hparams[k] = v
+    return hparams
+
+
+def capture_module_config(module, dump_dict, memo=None, copy=True):
+    """
+    保存module和各个子module的超参数到config::model_dict::hparams中，权重只保存一份到config::state_dict中
+    :param memo: 多个module共享的权重只拷贝一次
+    :param copy: 为False时host上的权重不拷贝，只能用于立即写入文件、之后不再引用的config
+    """
+    dump_dict['config']['model_dict'] = {
+        'hparams': {name: module_hparams(m) for name, m in module.named_modules()},
+    }
+    dump_dict['config']['state_dict'] = to_host(module.state_dict(keep_vars=True), memo, copy=copy)
+
+
+def dump_hook(model, dump_name_list=[], auto=False, summary=False):
+    """
+    :param summary: 为True时只保存每个tensor的统计信息(summarize_tensor)，用于训练中长期开启的数值监控
+    """
     model.dump_dict = dump_dict = {}
+    memo = {}
     for m_name, module in model.named_modules():
         if m_name in dump_name_list or (auto and (not is_torch_module(module))):
             dump_dict[m_name] = init_dump_dict()
             dump_dict[m_name]['name'] = m_name
             dump_dict[m_name]['type'] = str(type(module))
-            dump_dict[m_name]['config']['model_dict'] = copy.deepcopy(module.__dict__)
+            if summary:
+                dump_dict[m_name]['summary'] = True
+            capture_module_config(module, dump_dict[m_name], memo)
             module.register_forward_hook(
-                module_hook_func('[forward]:' + m_name, module, dump_dict[m_name], mode='forward'))
+                module_hook_func('[forward]:' + m_name, module, dump_dict[m_name], mode='forward', summary=summary))
             module.register_full_backward_hook(
-                module_hook_func('[forward]:' + m_name, module, dump_dict[m_name], mode='backward'))
+                module_hook_func('[forward]:' + m_name, module, dump_dict[m_name], mode='backward', summary=summary))
 
             for p_name, p in module.named_parameters():
                 if p.requires_grad:
-                    p.register_hook(param_hook_func(p_name.replace(f"{m_name}", ""), dump_dict[m_name]))
+                    p.register_hook(param_hook_func(p_name.replace(f"{m_name}", ""), dump_dict[m_name], summary))
 
     return model
 
 
-def dump_save(dump_dict, save_dir="./dump"):
+def dump_save(dump_dict, save_dir="./dump", fmt="pth", dedup=True, compression=None):
+    """
+    :param fmt: "pth"使用torch.save保存；"tstore"保存为可以按需读取的tensor store，使用load_dump读取
+    :param dedup: fmt为"tstore"时，所有module的tensor按内容去重保存在save_dir/objects中，
+                  例如前一个module的输出和后一个module的输入只保存一次
+    :param compression: 去重保存的tensor的压缩方式，None/"zstd"/"lz4"/"zlib"
+    """
     os.makedirs(save_dir, exist_ok=True)
+    objects = ObjectStore(os.path.join(save_dir, "objects"), compression) if dedup else None
 
     for k in dump_dict:
         err_str = check_dump_dict(dump_dict[k], True)
         if err_str:
             print(err_str)
-        torch.save(dump_dict[k], os.path.join(save_dir, f"{k}.pth"))
+        if fmt == "tstore":
+            save_tensors(dump_dict[k], os.path.join(save_dir, f"{k}.tstore"), objects=objects)
+        else:
+            torch.save(dump_dict[k], os.path.join(save_dir, f"{k}.pth"))
     exit()
 
 
+def to_host(value, memo=None, non_blocking=False, copy=True):
+    """
+    detach并拷贝到host上，不再引用原始tensor和计算图
+    :param memo: 不为None时同一个tensor只拷贝一次
+    :param non_blocking: 为True时device上的tensor异步拷贝到pinned内存，读取前需要等待拷贝完成(如event.synchronize())
+    :param copy: 为False时host上的tensor只detach不拷贝，和原始tensor共享内存
+    """
+    if isinstance(value, torch.Tensor):
+        if memo is not None and id(value) in memo:
+            return memo[id(value)][1]
+        host_value = value.detach()
+        if host_value.device.type == 'cpu':
+            host_value = host_value.clone() if copy else host_value
+        elif non_blocking:
+            try:
+                pinned = torch.empty(host_value.shape, dtype=host_value.dtype, pin_memory=True)
+                host_value = pinned.copy_(host_value, non_blocking=True)
+            except RuntimeError:
+                host_value = host_value.to('cpu')
+        else:
+            host_value = host_value.to('cpu')
+        if memo is not None:
+            # 同时引用原tensor，保证id不会被复用
+            memo[id(value)] = (value, host_value)
+        return host_value
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_host(each_value, memo, non_blocking, copy) for each_value in value)
+    if isinstance(value, dict):
+        return {k: to_host(each_value, memo, non_blocking, copy) for k, each_value in value.items()}
+    return value
+
+
+def to_host_async(value):
+    return to_host(value, non_blocking=True)
+
+
+class StreamingDumpWriter:
+    """
+    后台线程将捕获的数据写入save_dir/<module名称>/<name>.tstore
+    待写入的数据按iteration为单位提交，最多保留max_pending个iteration、共max_pending_bytes字节，
+    超过时丢弃最早的整个iteration，不阻塞训练，写入的iteration中所有module的数据都是完整的
+    dedup为True时tensor按内容去重保存在save_dir/objects中，各iteration之间不变的数据只保存一次
+    """
+
+    def __init__(self, save_dir, max_pending=2, dedup=True, compression=None, max_pending_bytes=2 * 1024 ** 3):
+        self.save_dir = save_dir
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.objects = ObjectStore(os.path.join(save_dir, "objects"), compression) if dedup else None
+        self.dropped = 0
+        self.written = 0
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._cond = threading.Condition()
+        # 写文件和去重缓存只在一个线程中使用，不占用_cond，写入时不阻塞submit
+        self._io_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='StreamingDumpWriter', daemon=True)
+        self._thread.start()
+
+    def _save(self, m_name, name, value):
+        save_tensors(value, os.path.join(self.save_dir, m_name, f"{name}.tstore"), objects=self.objects)
+        if self.objects is not None:
+            self.objects.clear_cache()
+
+    def write(self, m_name, name, value):
+        """在调用的线程中同步写入，用于只保存一次、不能丢弃的数据(如config)"""
+        with self._io_lock:
+            self._save(m_name, name, value)
+
+    def submit(self, name, dumps, event=None):
+        """
+        提交一个iteration的数据
+        :param dumps: dict, module名称 -> dump
+        :param event: 数据异步拷贝到host之后记录的event，写入前等待该event，为None时不等待
+        """
+        nbytes = tensor_nbytes(dumps)
+        with self._cond:
+            # 至少保留最新的iteration
+            while self._pending and (len(self._pending) >= self.max_pending or
+                                     self._pending_bytes + nbytes > self.max_pending_bytes):
+                dropped_name, _, _, dropped_bytes = self._pending.popleft()
+                self._pending_bytes -= dropped_bytes
+                self.dropped += 1
+                print(f"### StreamingDumpWriter is full, drop {dropped_name}.")
+            self._pending.append((name, dumps, event, nbytes))
+            self._pending_bytes += nbytes
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                name, dumps, event, nbytes = self._pending.popleft()
+                self._pending_bytes -= nbytes
+            if event is not None:
+                event.synchronize()
+            with self._io_lock:
+                for m_name, dump in dumps.items():
+                    self._save(m_name, name, dump)
+            self.written += 1
+
+    def close(self):
+        """等待所有数据写入后结束后台线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class StreamingDumpHook:
+    """
+    按采样策略捕获多个iteration的数据，每个module每个被采样的iteration保存为一个文件:
+    save_dir/<module名称>/config.tstore: module的配置，安装hook时同步写入
+    save_dir/<module名称>/iter_<iteration>.tstore: 除config外和dump_hook相同结构的dump
+    model的每次前向为一个iteration，采样满足start <= iteration < end且(iteration - start) % every_k == 0的iteration
+    device上的tensor在hook中异步拷贝到pinned内存，iteration结束时记录event，后台线程等待event之后写入
+    待写入的iteration超过max_pending个或max_pending_bytes字节时丢弃最早的整个iteration
+    summary为True时只保存每个tensor的统计信息(summarize_tensor)
+    state_dict为True时每个iteration同时保存module前向时的state_dict，用于回放时比较精度，不变的权重去重后只保存一次
+    """
+
+    def __init__(self, model, save_dir, dump_name_list=[], auto=False, every_k=1, start=0, end=None,
+                 max_pending=2, dedup=True, compression=None, summary=False, state_dict=False,
+                 max_pending_bytes=2 * 1024 ** 3):
+        from utils.prof_utils import get_device_module
+        self.device_module = get_device_module()
+        self.capture = summarize if summary else to_host_async
+        self.summary = summary
+        self.with_state_dict = state_dict
+        self.every_k = every_k
+        self.start = start
+        self.end = end
+        self.iteration = -1
+        self.writer = StreamingDumpWriter(save_dir, max_pending, dedup, compression, max_pending_bytes)
+        self.dumps = {}
+        self.handles = [model.register_forward_pre_hook(self._next_iteration)]
+
+        for m_name, module in model.named_modules():
+            if m_name in dump_name_list or (auto and (not is_torch_module(module))):
+                config = init_dump_dict()
+                config['name'] = m_name
+                config['type'] = str(type(module))
+                # config立即写入文件，host上的权重直接写入不拷贝，device上的权重只在写入期间保留host上的拷贝，
+                # 多个module共享的权重由ObjectStore按内容去重
+                capture_module_config(module, config, copy=False)
+                self.writer.write(m_name, 'config', config)
+                del config
+                self.handles.append(module.register_forward_hook(self._module_hook(m_name, 'forward')))
+                self.handles.append(module.register_full_backward_hook(self._module_hook(m_name, 'backward')))
+                for p_name, p in module.named_parameters():
+                    if p.requires_grad:
+                        self.handles.append(p.register_hook(self._param_hook(m_name, p_name)))
+
+    def sampled(self):
+        if self.iteration < self.start or (self.end is not None and self.iteration >= self.end):
+            return False
+        return (self.iteration - self.start) % self.every_k == 0
+
+    def _flush(self):
+        if not self.dumps:
+            return
+        event = None
+        if self.device_module is not None:
+            # 异步拷贝都在当前stream上，event完成时这个iteration的数据已经全部拷贝到host
+            event = self.device_module.Event()
+            event.record()
+        self.writer.submit('iter_{0:06d}'.format(self.iteration), self.dumps, event)
+        self.dumps = {}
+
+    def _next_iteration(self, module, inputs):
+        # 上一个iteration的反向已经结束，提交上一个iteration的数据
+        self._flush()
+        self.iteration += 1
+
+    def _get_dump(self, m_name):
+        if m_name not in self.dumps:
+            dump = init_dump_dict()
+            dump['name'] = m_name
+            del dump['config']
+            dump['iteration'] = self.iteration
+            if self.summary:
+                dump['summary'] = True
+            self.dumps[m_name] = dump
+        return self.dumps[m_name]
+
+    def _module_hook(self, m_name, mode):
+        def hook_function(module, inputs, outputs):
+            if self.sampled():
+                dump = self._get_dump(m_name)
+                if mode == 'forward' and self.with_state_dict and 'state_dict' not in dump:
+                    dump['state_dict'] = to_host_async(module.state_dict(keep_vars=True))
+                dump[mode]['inputs'] = self.capture(inputs)
+                dump[mode]['outputs'] = self.capture(outputs)
+
+        return hook_function
+
+    def _param_hook(self, m_name, p_name):
+        def hook_function(grad):
+            if self.sampled():
+                self._get_dump(m_name)['grads'][p_name] = self.capture(grad)
+
+        return hook_function
+
+    def close(self):
+        """训练结束后调用，提交最后一个iteration的数据并等待写入完成"""
+        self._flush()
+        for handle in self.handles:
+            handle.remove()
+        self.writer.close()
+        print(f"### StreamingDumpHook written={self.writer.written}, dropped={self.writer.dropped}.")
+
+
+def stream_dump_hook(model, save_dir="./dump", dump_name_list=[], auto=False, every_k=1, start=0, end=None,
+                     max_pending=2, dedup=True, compression=None, summary=False, state_dict=False,
+                     max_pending_bytes=2 * 1024 ** 3):
+    """dump_hook的流式版本，训练结束后需要调用model.stream_dump.close()"""
+    model.stream_dump = StreamingDumpHook(model, save_dir, dump_name_list, auto, every_k, start, end, max_pending,
+                                          dedup, compression, summary, state_dict, max_pending_bytes)
+    return model
+
+
 def diff_error(inputs, targets):
     diff_abs = (inputs - targets).abs()
     return diff_abs.max(), diff_abs.sum() / torch.count_nonzero(diff_abs)
@@ -153,8 +554,40 @@ def state_dict_remove_prefix(state_dict, prefix):
     return new_state_dict
 
 
-print('==================================>model')
-print(model.modules)
-
-dump_name_list = ["backbone.layer1", "backbone.layer2", "backbone.layer3", "backbone.layer4", "rpn_head.loss_cls"]
-model = dump_hook(model, dump_name_list, auto=False)
+# 在训练脚本中构建model后添加:
+# print('==================================>model')
+# print(model.modules)
+#
+# dump_name_list = ["backbone.layer1", "backbone.layer2", "backbone.layer3", "backbone.layer4", "rpn_head.loss_cls"]
+# model = dump_hook(model, dump_name_list, auto=False)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Check the real data dumps in a directory without loading the tensor data.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--dump_dir",
+        type=str,
+        default='./data/pt_dump',
+        help="Directory of the .pth/.tstore dumps.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of checking processes, the cpu count by default.",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Path of the json report with the size, time and error of each dump.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    print(check_dump_dict_dir(args.dump_dir, full_log=True, workers=args.workers, report_path=args.report))
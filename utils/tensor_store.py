@@ -0,0 +1,550 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+tensor store文件格式:
+    MAGIC(8 bytes) | header长度(8 bytes, little endian) | header(json) | 对齐填充 | blob
+header描述了保存对象的嵌套结构，tensor的数据按ALIGNMENT字节对齐保存在blob中，读取时通过np.memmap直接映射，不需要拷贝
+blob超过max_shard_bytes时拆分为多个分片，第i(i>0)个分片保存在'<path>.<i>'中，header中记录每个数据所在的分片
+指定objects_dir时tensor按内容hash保存在objects_dir中，相同内容的tensor只保存一次，header中只记录hash
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import io
+import json
+import os
+import pickle
+import struct
+import warnings
+import zipfile
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+MAGIC = b'TSTORE01'
+ALIGNMENT = 64
+
+# numpy不支持bfloat16，按相同宽度的int16保存
+DTYPE_TO_NUMPY = {
+    torch.float64: np.float64,
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.int16: np.int16,
+    torch.int8: np.int8,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+NAME_TO_DTYPE = {str(dtype).replace('torch.', ''): dtype for dtype in DTYPE_TO_NUMPY}
+
+
+def dtype_name(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def tensor_to_numpy(tensor):
+    """返回和tensor共享内存(cpu上且连续时)的一维numpy数组"""
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def numpy_to_tensor(array, dtype, shape):
+    tensor = torch.from_numpy(array)
+    if dtype == torch.bfloat16:
+        tensor = tensor.view(torch.bfloat16)
+    return tensor.reshape(shape)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def shard_path(path, shard):
+    return path if shard == 0 else '{0}.{1}'.format(path, shard)
+
+
+def get_codec(compression):
+    """返回(压缩函数, 解压函数)，zstd和lz4需要安装对应的python包，zlib为标准库"""
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression == 'zlib':
+        import zlib
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    raise NotImplementedError('[tensor_store] compression {0} is currently not supported. '.format(compression))
+
+
+class ObjectStore:
+    """
+    按内容hash保存tensor数据的目录，文件为<root>/<hash前2位>/<hash>.<codec>
+    未压缩(codec为'raw')的数据可以直接映射
+    """
+
+    def __init__(self, root, compression=None):
+        self.root = root
+        self.compression = compression
+        self.codec = compression or 'raw'
+        # 共享内存的tensor只计算一次hash，同时引用tensor，保证data_ptr在clear_cache前不会被复用
+        self.hash_cache = {}
+
+    def path(self, ref, codec):
+        return os.path.join(self.root, ref[:2], '{0}.{1}'.format(ref, codec))
+
+    def content_hash(self, tensor, array):
+        key = None
+        if tensor.device.type == 'cpu':
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tuple(tensor.stride()), tensor._version)
+            if key in self.hash_cache:
+                return self.hash_cache[key][1]
+        ref = hashlib.blake2b(array.data, digest_size=20).hexdigest()
+        if key is not None:
+            self.hash_cache[key] = (tensor, ref)
+        return ref
+
+    def clear_cache(self):
+        self.hash_cache = {}
+
+    def put(self, tensor, array):
+        """保存tensor的数据，已存在时跳过，返回(hash, codec)"""
+        ref = self.content_hash(tensor, array)
+        path = self.path(ref, self.codec)
+        if not os.path.exists(path):
+            data = array.data if self.compression is None else get_codec(self.compression)[0](array.data)
+            write_file(path, [data])
+        return ref, self.codec
+
+    def read(self, ref, codec):
+        path = self.path(ref, codec)
+        if codec == 'raw':
+            return open_blob(path)
+        with open(path, 'rb') as f:
+            return np.frombuffer(bytearray(get_codec(codec)[1](f.read())), dtype=np.uint8)
+
+
+class _Writer:
+    def __init__(self, max_shard_bytes=None, objects=None):
+        self.max_shard_bytes = max_shard_bytes
+        self.objects = objects
+        self.shards = [[]]
+        self.size = 0
+
+    def add(self, data):
+        """data为bytes或numpy数组，返回(分片序号, 在分片blob中的offset)"""
+        nbytes = data.nbytes if isinstance(data, np.ndarray) else len(data)
+        if self.max_shard_bytes and self.size > 0 and align(self.size) + nbytes > self.max_shard_bytes:
+            self.shards.append([])
+            self.size = 0
+        offset = align(self.size)
+        if offset > self.size:
+            self.shards[-1].append(b'\0' * (offset - self.size))
+        self.shards[-1].append(data)
+        self.size = offset + nbytes
+        return len(self.shards) - 1, offset
+
+    def encode(self, value):
+        if value is None:
+            return {'type': 'none'}
+        if isinstance(value, torch.Tensor) and value.dtype in DTYPE_TO_NUMPY:
+            array = tensor_to_numpy(value)
+            node = {'type': 'tensor', 'dtype': dtype_name(value.dtype), 'shape': list(value.shape),
+                    'nbytes': int(array.nbytes)}
+            if self.objects is not None:
+                node['ref'], node['codec'] = self.objects.put(value, array)
+            else:
+                node['shard'], node['offset'] = self.add(array)
+            if isinstance(value, torch.nn.Parameter):
+                node['parameter'] = True
+            if value.requires_grad:
+                node['requires_grad'] = True
+            return node
+        if type(value) in (list, tuple):
+            return {'type': type(value).__name__, 'items': [self.encode(v) for v in value]}
+        if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+            return {'type': 'dict', 'keys': list(value), 'items': [self.encode(v) for v in value.values()]}
+        if isinstance(value, (bool, int, float, str)):
+            return {'type': 'value', 'value': value}
+        data = pickle.dumps(value)
+        shard, offset = self.add(data)
+        return {'type': 'pickle', 'shard': shard, 'offset': offset, 'nbytes': len(data)}
+
+
+def write_file(path, chunks, header=None):
+    """写入一个文件，header不为None时写在blob之前"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        if header is not None:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (align(f.tell()) - f.tell()))
+        for chunk in chunks:
+            f.write(chunk.data if isinstance(chunk, np.ndarray) else chunk)
+    os.replace(tmp_path, path)
+
+
+def save_tensors(value, path, max_shard_bytes=None, objects=None):
+    """
+    保存由tensor/list/tuple/dict/None/标量组成的嵌套结构，其他对象使用pickle保存
+    先写入临时文件再重命名，多个进程同时写同一路径时不会产生不完整的文件
+    :param max_shard_bytes: 每个分片blob的大小上限，None表示不分片
+    :param objects: ObjectStore，不为None时tensor去重保存在其中
+    """
+    writer = _Writer(max_shard_bytes, objects)
+    root = writer.encode(value)
+    header = {'root': root, 'num_shards': len(writer.shards)}
+    if objects is not None:
+        header['objects_dir'] = os.path.relpath(objects.root, os.path.dirname(os.path.abspath(path)))
+    header = json.dumps(header).encode('utf-8')
+    # 先写分片，最后写带header的主文件，读取者不会看到缺少分片的文件
+    for shard in range(len(writer.shards) - 1, 0, -1):
+        write_file(shard_path(path, shard), writer.shards[shard])
+    write_file(path, writer.shards[0], header)
+
+
+def read_header(path):
+    """只读取header，返回(header, blob在文件中的起始位置)"""
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, "{0} is not a tensor store file.".format(path)
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, align(len(MAGIC) + 8 + header_len)
+
+
+def is_tensor_store(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def open_blob(path, offset=0):
+    """以copy-on-write方式映射blob，修改返回的tensor不会影响文件和其他读取者"""
+    if os.path.getsize(path) <= offset:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='c', offset=offset)
+
+
+class TensorStore:
+    """
+    按需读取tensor store中的数据，只读取header，分片在第一次访问时才映射
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header, self.blob_start = read_header(path)
+        self.root = header['root']
+        self.num_shards = header['num_shards']
+        self.objects = None
+        if 'objects_dir' in header:
+            self.objects = ObjectStore(os.path.join(os.path.dirname(os.path.abspath(path)), header['objects_dir']))
+        self._blobs = {}
+
+    def blob(self, shard):
+        if shard not in self._blobs:
+            offset = self.blob_start if shard == 0 else 0
+            self._blobs[shard] = open_blob(shard_path(self.path, shard), offset)
+        return self._blobs[shard]
+
+    def data(self, node):
+        if 'ref' in node:
+            key = (node['ref'], node['codec'])
+            if key not in self._blobs:
+                self._blobs[key] = self.objects.read(node['ref'], node['codec'])
+            return self._blobs[key]
+        return self.blob(node.get('shard', 0))[node['offset']:node['offset'] + node['nbytes']]
+
+    def reopen(self):
+        """复用已经读取的header，重新映射数据，和原来的TensorStore之间互不影响"""
+        store = copy.copy(self)
+        store._blobs = {}
+        return store
+
+    def nbytes(self):
+        return sum(os.path.getsize(shard_path(self.path, shard)) for shard in range(self.num_shards))
+
+    def resolve(self, key, node=None):
+        """
+        按'.'分隔的key查找节点，例如'forward.inputs'、'grads.fpn_convs.0.conv.weight'
+        dict的key本身可以包含'.'，优先匹配最长的key
+        """
+        node = self.root if node is None else node
+        parts = key.split('.') if key else []
+        while parts:
+            if node['type'] == 'dict':
+                for i in range(len(parts), 0, -1):
+                    if '.'.join(parts[:i]) in node['keys']:
+                        node = node['items'][node['keys'].index('.'.join(parts[:i]))]
+                        parts = parts[i:]
+                        break
+                else:
+                    raise KeyError(key)
+            elif node['type'] in ['list', 'tuple']:
+                node, parts = node['items'][int(parts[0])], parts[1:]
+            else:
+                raise KeyError(key)
+        return node
+
+    def decode(self, node):
+        node_type = node['type']
+        if node_type == 'none':
+            return None
+        if node_type == 'tensor':
+            dtype = NAME_TO_DTYPE[node['dtype']]
+            tensor = numpy_to_tensor(self.data(node).view(DTYPE_TO_NUMPY[dtype]), dtype, node['shape'])
+            if node.get('parameter'):
+                return torch.nn.Parameter(tensor, requires_grad=node.get('requires_grad', False))
+            if node.get('requires_grad'):
+                tensor.requires_grad_(True)
+            return tensor
+        if node_type == 'list':
+            return [self.decode(item) for item in node['items']]
+        if node_type == 'tuple':
+            return tuple(self.decode(item) for item in node['items'])
+        if node_type == 'dict':
+            return {k: self.decode(item) for k, item in zip(node['keys'], node['items'])}
+        if node_type == 'value':
+            return node['value']
+        if node_type == 'pickle':
+            return pickle.load(io.BytesIO(self.data(node).tobytes()))
+        raise NotImplementedError('[tensor_store] unknown node type {0}. '.format(node_type))
+
+    def meta(self, node):
+        """和decode相同，但tensor替换为TensorMeta"""
+        node_type = node['type']
+        if node_type == 'tensor':
+            return TensorMeta(NAME_TO_DTYPE[node['dtype']], node['shape'], node.get('parameter', False),
+                              node.get('requires_grad', False))
+        if node_type == 'list':
+            return [self.meta(item) for item in node['items']]
+        if node_type == 'tuple':
+            return tuple(self.meta(item) for item in node['items'])
+        if node_type == 'dict':
+            return {k: self.meta(item) for k, item in zip(node['keys'], node['items'])}
+        if node_type == 'pickle':
+            return MetaUnpickler(io.BytesIO(self.data(node).tobytes())).load()
+        return self.decode(node)
+
+    def get(self, key=''):
+        return self.decode(self.resolve(key))
+
+    def lazy(self, key=''):
+        """返回LazyDict，dict节点在访问时才读取"""
+        node = self.resolve(key)
+        return LazyDict(self, node) if node['type'] == 'dict' else self.decode(node)
+
+
+class LazyDict(Mapping):
+    """tensor store中dict节点的只读视图，取值时才读取对应的数据，可以代替torch.load得到的dump dict"""
+
+    def __init__(self, store, node):
+        self._store = store
+        self._node = node
+
+    def __getitem__(self, key):
+        if key not in self._node['keys']:
+            raise KeyError(key)
+        node = self._node['items'][self._node['keys'].index(key)]
+        return LazyDict(self._store, node) if node['type'] == 'dict' else self._store.decode(node)
+
+    def __iter__(self):
+        return iter(self._node['keys'])
+
+    def __len__(self):
+        return len(self._node['keys'])
+
+    def to_dict(self):
+        return self._store.decode(self._node)
+
+
+class TensorMeta:
+    """只包含元信息的tensor占位对象，用于不读取数据地检查dump的结构"""
+
+    def __init__(self, dtype, shape, parameter=False, requires_grad=False):
+        self.dtype = dtype
+        self.shape = list(shape)
+        self.parameter = parameter
+        self.requires_grad = requires_grad
+
+    @property
+    def nbytes(self):
+        numel = 1
+        for size in self.shape:
+            numel *= size
+        return numel * torch._utils._element_size(self.dtype)
+
+    def __repr__(self):
+        return 'TensorMeta(dtype={0}, shape={1})'.format(dtype_name(self.dtype), self.shape)
+
+
+class StorageMeta:
+    def __init__(self, dtype):
+        self.dtype = dtype
+
+
+def _rebuild_tensor_meta(storage, storage_offset, size, stride, requires_grad=False, *args):
+    return TensorMeta(storage.dtype, size, requires_grad=requires_grad)
+
+
+def _rebuild_parameter_meta(data, requires_grad, *args):
+    data.parameter = True
+    data.requires_grad = requires_grad
+    return data
+
+
+def _rebuild_from_type_meta(func, new_type, args, state):
+    return func(*args)
+
+
+def _load_storage_meta(data):
+    return load_pth_meta(io.BytesIO(data))
+
+
+class MetaUnpickler(pickle.Unpickler):
+    """
+    只恢复对象结构的unpickler，tensor替换为TensorMeta，不读取也不反序列化tensor的数据
+    支持torch.save(storage为persistent id)和pickle.dumps(storage为_load_from_bytes)两种方式保存的tensor
+    """
+
+    rebuild_functions = {
+        ('torch._utils', '_rebuild_tensor_v2'): _rebuild_tensor_meta,
+        ('torch._utils', '_rebuild_parameter'): _rebuild_parameter_meta,
+        ('torch._utils', '_rebuild_parameter_with_state'): _rebuild_parameter_meta,
+        ('torch._tensor', '_rebuild_from_type_v2'): _rebuild_from_type_meta,
+        ('torch.storage', '_load_from_bytes'): _load_storage_meta,
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.rebuild_functions:
+            return self.rebuild_functions[(module, name)]
+        return super().find_class(module, name)
+
+    def persistent_load(self, pid):
+        # ('storage', storage_type, key, location, numel)
+        if pid[0] != 'storage':
+            raise pickle.UnpicklingError('unsupported persistent id {0}'.format(pid[0]))
+        with warnings.catch_warnings():
+            # 旧的FloatStorage等类型在访问dtype时会提示TypedStorage已废弃
+            warnings.simplefilter('ignore')
+            return StorageMeta(pid[1].dtype)
+
+
+def load_pth_meta(f):
+    """
+    读取torch.save保存的对象的结构，zip格式只读取zip中的data.pkl
+    旧格式依次为magic number、协议版本、系统信息和对象的pickle，之后的tensor数据不读取
+    """
+    if isinstance(f, str):
+        with open(f, 'rb') as opened_file:
+            return load_pth_meta(opened_file)
+    if zipfile.is_zipfile(f):
+        f.seek(0)
+        with zipfile.ZipFile(f) as zip_file:
+            pkl_name = [name for name in zip_file.namelist() if name.endswith('/data.pkl') or name == 'data.pkl'][0]
+            with zip_file.open(pkl_name) as pkl_file:
+                return MetaUnpickler(pkl_file).load()
+    f.seek(0)
+    for _ in range(3):
+        pickle.load(f)
+    return MetaUnpickler(f).load()
+
+
+def load_meta(path):
+    """
+    读取dump的结构，tensor替换为TensorMeta，不读取tensor的数据
+    .tstore只读取header(pickle节点除外)，.pth只读取zip中的data.pkl
+    """
+    for each_path in [path, tstore_path(path)]:
+        if is_tensor_store(each_path):
+            store = TensorStore(each_path)
+            return store.meta(store.root)
+    return load_pth_meta(path)
+
+
+def load_tensors(path):
+    """读取save_tensors保存的对象，tensor直接映射文件内容，不需要拷贝"""
+    return TensorStore(path).get()
+
+
+def tstore_path(pth_path):
+    return os.path.splitext(pth_path)[0] + '.tstore'
+
+
+def load_dump(path):
+    """
+    读取real data的dump，path对应的tensor store文件(.tstore)存在时按需读取，否则使用torch.load读取.pth
+    :return: LazyDict或dict，两者的访问方式相同
+    """
+    for each_path in [path, tstore_path(path)]:
+        if is_tensor_store(each_path):
+            return TensorStore(each_path).lazy()
+    return torch.load(path, map_location='cpu')
+
+
+def convert_pth_dump(pth_path, out_path=None, max_shard_bytes=None, objects=None):
+    """将torch.save保存的dump转换为tensor store，默认保存在同目录下的.tstore文件中"""
+    out_path = out_path or tstore_path(pth_path)
+    save_tensors(torch.load(pth_path, map_location='cpu'), out_path, max_shard_bytes, objects)
+    return out_path
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Convert the real data dumps saved by torch.save(.pth) into tensor store files(.tstore).',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--dump_dir",
+        type=str,
+        default='./data/pt_dump',
+        help="Directory of the .pth dumps, searched recursively.",
+    )
+    parser.add_argument(
+        "--max_shard_mb",
+        type=int,
+        default=None,
+        help="Max size(MB) of each shard, no sharding by default.",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store each unique tensor once in <dump_dir>/objects, keyed by its content hash.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        choices=["zstd", "lz4", "zlib"],
+        help="Compression of the deduplicated tensors, zstd/lz4 need the python package installed.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    max_shard_bytes = args.max_shard_mb * 1024 ** 2 if args.max_shard_mb else None
+    objects = ObjectStore(os.path.join(args.dump_dir, 'objects'), args.compression) if args.dedup else None
+    for pth_path in sorted(glob.glob(os.path.join(args.dump_dir, '**', '*.pth'), recursive=True)):
+        out_path = convert_pth_dump(pth_path, max_shard_bytes=max_shard_bytes, objects=objects)
+        print('convert {0} -> {1}'.format(pth_path, out_path))
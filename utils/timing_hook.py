@@ -0,0 +1,276 @@
+# Copyright 2023 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+训练中使用的低开销module计时hook，和dump_hook选择相同的module:
+
+    model = timing_hook(model, dump_name_list, auto=False, sample_every=100, save_path='./module_timing.jsonl')
+    ...
+    model.timing_hook.close()
+
+只在每sample_every个iteration中计时一次，其余iteration的hook只做一次判断
+device上通过event计时，不在每个hook中同步，被采样的iteration结束后才统一计算耗时
+"""
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from utils.breakdown_hook import ROOT_NAME, merge_child_spans, module_tree, register_grad_hooks, \
+    register_parameter_hooks, select_tree
+from utils.perf_history import now_str
+from utils.prof_utils import get_device_module
+from utils.real_data_hook import is_torch_module
+
+# 对数分桶，每个2倍区间分为BUCKETS_PER_OCTAVE个桶，最小的桶为1us
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = BUCKETS_PER_OCTAVE * 30
+
+
+class LatencyHistogram:
+    """耗时(ms)的对数分桶直方图"""
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    @staticmethod
+    def bucket_index(ms):
+        us = max(ms * 1e3, 1.0)
+        return min(int(math.log2(us) * BUCKETS_PER_OCTAVE), NUM_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_upper(index):
+        return 2 ** ((index + 1) / BUCKETS_PER_OCTAVE) / 1e3
+
+    def add(self, ms):
+        self.buckets[self.bucket_index(ms)] += 1
+        self.count += 1
+        self.sum += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """返回第q百分位所在桶的上界，误差不超过一个桶的宽度"""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for index, bucket in enumerate(self.buckets):
+            cumulative += bucket
+            if bucket and cumulative >= rank:
+                return min(self.bucket_upper(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        return OrderedDict(count=self.count, mean_ms=self.sum / max(self.count, 1),
+                           min_ms=self.min if self.count else 0.0, max_ms=self.max, p50_ms=self.percentile(50),
+                           p90_ms=self.percentile(90), p99_ms=self.percentile(99),
+                           buckets={index: bucket for index, bucket in enumerate(self.buckets) if bucket})
+
+
+class CpuClock:
+    def mark(self):
+        return time.perf_counter_ns()
+
+    def elapsed_ms(self, start, end):
+        return (end - start) / 1e6
+
+    def wait(self, mark):
+        pass
+
+
+class EventClock:
+    """在当前stream上记录event，不阻塞host"""
+
+    def __init__(self, device_module):
+        self.device_module = device_module
+
+    def mark(self):
+        event = self.device_module.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def elapsed_ms(self, start, end):
+        return start.elapsed_time(end)
+
+    def wait(self, mark):
+        mark.synchronize()
+
+
+class ModuleTimingHook:
+    """
+    按采样统计各module每个iteration的前向和反向耗时(ms)，累积到直方图中，每flush_every个被采样的iteration输出一次
+    前向为一个iteration中该module所有调用的耗时之和；反向为梯度到达module的输出到module的输入和参数的梯度计算完成的时间跨度
+    model的每次前向为一个iteration
+    """
+
+    def __init__(self, model, dump_name_list=[], auto=False, sample_every=100, flush_every=10, save_path=None,
+                 top_k=10):
+        device_module = get_device_module()
+        self.clock = EventClock(device_module) if device_module is not None else CpuClock()
+        self.sample_every = max(int(sample_every), 1)
+        self.flush_every = flush_every
+        self.save_path = save_path
+        self.top_k = top_k
+        self.modules = OrderedDict()
+        for m_name, module in model.named_modules():
+            if m_name in dump_name_list or (auto and (not is_torch_module(module))):
+                self.modules[m_name] = module
+        # 被选中的module之间的父子关系，父module的反向跨度包含子module的反向跨度
+        _, children = module_tree(model)
+        tree_names = {name or ROOT_NAME: name for name in self.modules}
+        self.children = OrderedDict((tree_names[name], [tree_names[child] for child in each_children])
+                                    for name, each_children in select_tree(children, tree_names).items())
+        self.histograms = {}
+        self.reset()
+        self.iteration = -1
+        self.sampled = False
+        self.sampled_since_flush = 0
+        self._marks = {}
+        self._forward_start = {}
+        self._last_mark = None
+        self._backward_base = None
+        self._handles = [model.register_forward_pre_hook(self._next_iteration)]
+        for name, module in self.modules.items():
+            self._handles.append(module.register_forward_pre_hook(self._forward_pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._forward_hook(name)))
+            # 未选中的子module的参数归入最近的被选中的祖先module
+            self._handles.extend(
+                register_parameter_hooks(module, self._backward_hook(name, 'backward_end'), recurse=True))
+
+    def reset(self):
+        self.histograms = {name: {'forward': LatencyHistogram(), 'backward': LatencyHistogram()}
+                           for name in self.modules}
+
+    def _mark(self, name, kind):
+        mark = self.clock.mark()
+        self._marks.setdefault(name, {'forward': [], 'backward_start': [], 'backward_end': []})[kind].append(mark)
+        self._last_mark = mark
+        if kind != 'forward' and self._backward_base is None:
+            self._backward_base = mark
+        return mark
+
+    def _next_iteration(self, module, inputs):
+        if self.sampled:
+            self._resolve()
+        self.iteration += 1
+        self.sampled = self.iteration % self.sample_every == 0
+
+    def _forward_pre_hook(self, name):
+        def hook_function(module, inputs):
+            if not self.sampled:
+                return
+            register_grad_hooks(inputs, self._backward_hook(name, 'backward_end'))
+            self._forward_start.setdefault(name, []).append(self.clock.mark())
+
+        return hook_function
+
+    def _forward_hook(self, name):
+        def hook_function(module, inputs, outputs):
+            if not self.sampled:
+                return
+            end = self._mark(name, 'forward')
+            self._marks[name]['forward'][-1] = (self._forward_start[name].pop(), end)
+            register_grad_hooks(outputs, self._backward_hook(name, 'backward_start'))
+
+        return hook_function
+
+    def _backward_hook(self, name, kind):
+        def hook_function(grad):
+            if self.sampled:
+                self._mark(name, kind)
+
+        return hook_function
+
+    def _resolve(self):
+        """被采样的iteration结束后计算耗时，只等待最后一个event"""
+        if self._last_mark is not None:
+            self.clock.wait(self._last_mark)
+
+        def elapsed(mark):
+            # event之间不能直接比较先后，以本iteration中的第一个反向event为起点换算
+            return self.clock.elapsed_ms(self._backward_base, mark)
+
+        spans = {}
+        for name, marks in self._marks.items():
+            if marks['forward']:
+                self.histograms[name]['forward'].add(
+                    sum(self.clock.elapsed_ms(start, end) for start, end in marks['forward']))
+            if marks['backward_start'] and marks['backward_end']:
+                spans[name] = (min(map(elapsed, marks['backward_start'])), max(map(elapsed, marks['backward_end'])))
+        for name, (start, end) in merge_child_spans(spans, self.children).items():
+            if end > start:
+                self.histograms[name]['backward'].add(end - start)
+        self._marks = {}
+        self._forward_start = {}
+        self._last_mark = None
+        self._backward_base = None
+        self.sampled = False
+        self.sampled_since_flush += 1
+        if self.flush_every and self.sampled_since_flush >= self.flush_every:
+            self.flush()
+
+    def report(self):
+        """返回按前向+反向平均耗时降序排列的列表"""
+        rows = []
+        for name, histograms in self.histograms.items():
+            row = OrderedDict(name=name, type=type(self.modules[name]).__name__)
+            for mode in ['forward', 'backward']:
+                row[mode] = histograms[mode].to_dict()
+            rows.append(row)
+        rows.sort(key=lambda r: r['forward']['mean_ms'] + r['backward']['mean_ms'], reverse=True)
+        return rows
+
+    def flush(self):
+        """输出并清空当前的直方图，save_path不为None时追加一行json"""
+        if self.sampled_since_flush == 0:
+            return
+        rows = self.report()
+        logging.info('module timing of {0} sampled iterations before iteration {1}:\n{2}'.format(
+            self.sampled_since_flush, self.iteration, format_timing(rows, self.top_k)))
+        if self.save_path is not None:
+            with open(self.save_path, 'a') as f:
+                f.write(json.dumps({'date': now_str(), 'iteration': self.iteration,
+                                    'sampled_iterations': self.sampled_since_flush, 'modules': rows}) + '\n')
+        self.reset()
+        self.sampled_since_flush = 0
+
+    def close(self):
+        """训练结束后调用，统计最后一个被采样的iteration，输出剩余的数据并移除hook"""
+        if self.sampled:
+            self._resolve()
+        self.flush()
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+
+def format_timing(rows, top_k=None):
+    lines = ['{0:<48} {1:<24} {2:>6} {3:>12} {4:>12} {5:>12} {6:>12}'.format(
+        'name', 'type', 'count', 'fwd_p50(ms)', 'fwd_p99(ms)', 'bwd_p50(ms)', 'bwd_p99(ms)')]
+    for row in rows[:top_k]:
+        lines.append('{0:<48} {1:<24} {2:>6} {3:>12.4f} {4:>12.4f} {5:>12.4f} {6:>12.4f}'.format(
+            row['name'], row['type'], row['forward']['count'], row['forward']['p50_ms'], row['forward']['p99_ms'],
+            row['backward']['p50_ms'], row['backward']['p99_ms']))
+    return '\n'.join(lines)
+
+
+def timing_hook(model, dump_name_list=[], auto=False, sample_every=100, flush_every=10, save_path=None, top_k=10):
+    """在和dump_hook相同的module上安装计时hook，训练结束后需要调用model.timing_hook.close()"""
+    model.timing_hook = ModuleTimingHook(model, dump_name_list, auto, sample_every, flush_every, save_path, top_k)
+    return model